@@ -221,12 +221,17 @@
  channels at each edge of the spectral window must be discaded.
  Values that are too small will make your TSys values be smaller than
  they really are; unfortunately, I do not think it is possible to
- quantify just what "too small" is. This smoothing does not compensate
- for flagged channels or different spectral windows, so
- discontinuities in the spectral data will worsen the results of the
- smoothing. Data means are calculated before subtraction of the
- smoothed component, so the "flux" keyword should behave identically
- regardless of the value of this parameter.
+ quantify just what "too small" is. Each contiguous run of unflagged
+ channels is smoothed separately and, like the spectral window as a
+ whole, loses (hann/2) channels at each end; runs with fewer than hann
+ channels contribute nothing to the noise estimate. Flagged channels
+ at the edges of the window therefore give the same results as
+ trimming the window, but flagged channels in its interior also cost
+ data. The smoothing does not compensate for different spectral
+ windows, so discontinuities in the spectral data will worsen the
+ results of the smoothing. Data means are calculated before
+ subtraction of the smoothed component, so the "flux" keyword should
+ behave identically regardless of the value of this parameter.
 
 @ quant
  The nature of the quantization in the correlator. Two integer values
@@ -253,6 +258,14 @@
  will likely need to specify non-default values for the "maxtsys" and
  "maxresid" keywords to prevent all the data from being flagged.
 
+@ workers
+ The number of threads used to compute solutions. If zero (the
+ default), the solution for each averaging interval is computed as soon
+ as its data have been read. If positive, completed intervals are
+ handed to this many worker threads and solved while the rest of the
+ data are read. The results and printed output are the same either
+ way. The plotting options force the default behavior.
+
 @ options
  Multiple options can be specified, separated by commas. Minimum-match
  is used.
@@ -293,115 +306,7 @@ from mirtask import keys, util
 __version_info__ = (1, 0)
 IDENT = '$Id$'
 
-## quickutil: arraygrower statsacc words
-#- snippet: arraygrower.py (2012 Mar 29)
-#- SHA1: 0524398a658fe9cbf9b3ba557e16018f89e5027d
-class ArrayGrower (object):
-    __slots__ = 'dtype ncols chunkSize _nextIdx _arr'.split ()
-
-    def __init__ (self, ncols, dtype=None, chunkSize=128):
-        if dtype is None:
-            import numpy as np
-            dtype = np.float
-
-        self.dtype = dtype
-        self.ncols = ncols
-        self.chunkSize = chunkSize
-        self.clear ()
-
-    def clear (self):
-        self._nextIdx = 0
-        self._arr = None
-        return self
-
-    def __len__ (self):
-        return self._nextIdx
-
-    def addLine (self, line):
-        from numpy import asarray, ndarray
-
-        line = asarray (line, dtype=self.dtype)
-        if line.size != self.ncols:
-            raise ValueError ('line is wrong size')
-
-        if self._arr is None:
-            self._arr = ndarray ((self.chunkSize, self.ncols),
-                                 dtype=self.dtype)
-        elif self._arr.shape[0] <= self._nextIdx:
-            self._arr.resize ((self._arr.shape[0] + self.chunkSize,
-                               self.ncols))
-
-        self._arr[self._nextIdx] = line
-        self._nextIdx += 1
-        return self
-
-    def add (self, *args):
-        self.addLine (args)
-        return self
-
-    def finish (self):
-        if self._arr is None:
-            from numpy import ndarray
-            ret = ndarray ((0, self.ncols), dtype=self.dtype)
-        else:
-            self._arr.resize ((self._nextIdx, self.ncols))
-            ret = self._arr
-
-        self.clear ()
-        return ret
-#- snippet: statsacc.py (2012 Mar 29)
-#- SHA1: dd61a34a90a30faf9accb67a1f685c2015c4a958
-class StatsAccumulator (object):
-    __slots__ = 'xtot xsqtot n _shape'.split ()
-
-    def __init__ (self, shape=None):
-        self._shape = shape
-        self.clear ()
-
-    def clear (self):
-        if self._shape is None:
-            self.xtot = 0.
-            self.xsqtot = 0.
-        else:
-            from numpy import zeros
-            self.xtot = zeros (self.shape)
-            self.xsqtot = zeros (self.shape)
-        self.n = 0
-        return self
-
-    def add (self, x):
-        if self._shape is not None:
-            from numpy import asarray
-            x = asarray (x)
-            if x.shape != self._shape:
-                raise ValueError ('x has wrong shape')
-        self.xtot += x
-        self.xsqtot += x**2
-        self.n += 1
-        return self
-
-    def num (self):
-        return self.n
-
-    def mean (self):
-        return self.xtot / self.n
-
-    def rms (self):
-        if self._shape is None:
-            from math import sqrt
-        else:
-            from numpy import sqrt
-        return sqrt (self.xsqtot / self.n)
-
-    def std (self):
-        if self._shape is None:
-            from math import sqrt
-        else:
-            from numpy import sqrt
-        return sqrt (self.var ())
-
-    def var (self):
-        return self.xsqtot / self.n - (self.xtot / self.n)**2
+## quickutil: words
 #- snippet: words.py (2012 Mar 29)
 #- SHA1: 5ba0c8c0085d1800ba46e7d5f5dd1dff9cd43a24
 def words (linegen):
@@ -448,13 +353,155 @@ SECOND = 1. / 24 / 3600
 
 reallyBadTSys = 9999
 
+# Preallocated per-basepol integration buffers
+
+class BaselineAccumulator (object):
+    """Time-integrated spectra for a set of basepols. The sums are stored
+    as rows of preallocated (nbp, nchan) arrays and each basepol is
+    assigned a row the first time it is seen. Rows survive clear (), so
+    the same arrays are reused from one averaging interval to the
+    next."""
+
+    __slots__ = 'nchan chunkSize bps _rows _dt _times _scratch _cscratch'.split ()
+
+    def __init__ (self, chunkSize=64):
+        self.chunkSize = chunkSize
+        self.nchan = None
+        self.bps = []
+        self._rows = {}
+        self._dt = None
+        self._times = None
+
+    def clear (self):
+        if self._dt is not None:
+            self._dt.fill (0)
+            self._times.fill (0)
+        return self
+
+    def __len__ (self):
+        return len (self.bps)
+
+    def _checkSize (self, nchan):
+        if self.nchan is None:
+            self.nchan = nchan
+            self._dt = np.zeros ((self.chunkSize, nchan), dtype=np.complex)
+            self._times = np.zeros ((self.chunkSize, nchan))
+            self._scratch = np.empty (nchan)
+            self._cscratch = np.empty (nchan, dtype=np.complex)
+        elif nchan != self.nchan:
+            raise ValueError ('data are wrong size')
+
+    def _row (self, bp):
+        row = self._rows.get (bp)
+        if row is not None:
+            return row
+
+        row = len (self.bps)
+
+        if row >= self._dt.shape[0]:
+            n = row + self.chunkSize
+            dt = np.zeros ((n, self.nchan), dtype=self._dt.dtype)
+            dt[:row] = self._dt
+            times = np.zeros ((n, self.nchan))
+            times[:row] = self._times
+            self._dt, self._times = dt, times
+
+        self._rows[bp] = row
+        self.bps.append (bp)
+        return row
+
+    def accumulate (self, bp, data, flags, inttime):
+        self._checkSize (data.size)
+        row = self._row (bp)
+
+        w = self._scratch
+        cw = self._cscratch
+        np.multiply (flags, inttime, w)
+        self._times[row] += w
+        np.multiply (data, w, cw)
+        self._dt[row] += cw
+        return self
+
+    def accumulateMany (self, bps, data, flags, inttime):
+        data = np.atleast_2d (data)
+        self._checkSize (data.shape[1])
+        rows = np.fromiter ((self._row (bp) for bp in bps), dtype=np.intp,
+                            count=data.shape[0])
+
+        times = np.asarray (inttime, dtype=np.double)
+        if times.ndim == 1:
+            times = times[:,None]
+        times = flags * times
+        dt = data * times
+
+        if np.unique (rows).size == rows.size:
+            self._times[rows] += times
+            self._dt[rows] += dt
+        else:
+            np.add.at (self._times, rows, times)
+            np.add.at (self._dt, rows, dt)
+        return self
+
+    def spawn (self):
+        """Return a new, empty accumulator that shares this one's
+assignment of basepols to rows, so that data accumulated into it are
+laid out exactly as they would have been in this one."""
+        other = BaselineAccumulator (self.chunkSize)
+        other.bps = list (self.bps)
+        other._rows = dict (self._rows)
+
+        if self.nchan is not None:
+            other._checkSize (self.nchan)
+            other._dt = np.zeros_like (self._dt)
+            other._times = np.zeros_like (self._times)
+
+        return other
+
+    def arrays (self):
+        """Return (bps, dt, times), where dt and times are (nbp, nchan)
+views of the integrated data*time and time sums for the basepols in
+bps, in row order."""
+        n = len (self.bps)
+        if n == 0:
+            return self.bps, np.zeros ((0, 0), dtype=np.complex), np.zeros ((0, 0))
+        return self.bps, self._dt[:n], self._times[:n]
+
+
+def _convolveRows (a, window):
+    """Convolve each row of the 2D array a with window, keeping only
+the fully-overlapping ('valid') part, like np.convolve."""
+    n = a.shape[1] - window.size + 1
+    out = np.zeros ((a.shape[0], n), dtype=a.dtype)
+
+    for i, w in enumerate (window[::-1]):
+        out += w * a[:,i:i+n]
+
+    return out
+
+
+def _normalTerms (ants, vals, nap):
+    """Compute the normal matrix and right-hand side contributed by the
+basepols with antpol indices ants (a k-by-2 array) and log-space values
+vals to the antpol log-TSys solve."""
+    a1 = ants[:,0]
+    a2 = ants[:,1]
+    diag = np.bincount (a1, minlength=nap) + np.bincount (a2, minlength=nap)
+    normal = np.bincount (a1 * nap + a2, minlength=nap * nap).reshape ((nap, nap))
+    normal = normal + normal.T
+    normal.flat[::nap+1] = diag
+    rhs = (np.bincount (a1, vals, minlength=nap) +
+           np.bincount (a2, vals, minlength=nap))
+    return normal, rhs
+
+
 # Iterative averaging TSys computer
 
 class SysTemps (object):
     def __init__ (self, flux, etaQ, hann, maxtsys, maxresid,
                   showpre, showall, showfinal):
-        self.integData = {}
+        self.accum = BaselineAccumulator ()
         self.tmin = None
+        self.out = None # print >>None goes to sys.stdout
         self.flux = flux
         self.etaQ = etaQ
         self.hann = hann
@@ -464,85 +511,112 @@ class SysTemps (object):
         self.showall = showall
         self.showfinal = showfinal
 
-    def accumulate (self, time, bp, data, flags, inttime):
+    def detach (self):
+        """Return a new SysTemps holding the data accumulated so far, and
+start accumulating afresh. The returned object can be flushed
+independently of this one, e.g. in another thread; it writes its
+messages to its 'out' attribute."""
+        import copy
+        other = copy.copy (self)
+        self.accum = self.accum.spawn ()
+        self.tmin = None
+        return other
+
+    def _noteTime (self, time):
         if self.tmin is None:
             self.tmin = time
         else:
             self.tmin = min (self.tmin, time)
 
-        times = flags * inttime
-        dt = data * times
-
-        tup = self.integData.get (bp)
-
-        if tup is not None:
-            d0, t0 = tup
-            times += t0
-            dt += d0
+    def accumulate (self, time, bp, data, flags, inttime):
+        self._noteTime (time)
+        self.accum.accumulate (bp, data, flags, inttime)
 
-        self.integData[bp] = dt, times
+    def accumulateMany (self, time, bps, data, flags, inttime):
+        """Accumulate the records of one integration at once. bps is a
+sequence of k basepols, data and flags are k-by-nchan arrays, and inttime
+is a scalar or a k-vector."""
+        self._noteTime (time)
+        self.accum.accumulateMany (bps, data, flags, inttime)
 
     def _flatten (self):
-        # Flatten out data into arrays of values we'll need
-
-        seenAps = set ()
-        aginfo = ArrayGrower (6, np.double)
-        agants = ArrayGrower (2, np.int)
-
-        doHann = self.hann > 1
-        if doHann:
-            window = np.hanning (self.hann) * 2 / (self.hann - 1)
-
-        for bp, (dt, times) in self.integData.iteritems ():
-            w = np.where (times > 0)
-            if len (w[0]) < self.hann + 2:
-                # if only 1 item after smoothing, can't calc meaningful std
-                continue
-            tw = times[w]
-            dt = dt[w] / tw
-
-            r = dt.real
-            i = dt.imag
-
-            mreal = r.mean ()
-            mimag = i.mean ()
-
-            if doHann:
-                r = r[self.hann / 2 : -self.hann / 2 + 1]
-                i = i[self.hann / 2 : -self.hann / 2 + 1]
-                r -= np.convolve (dt.real, window, mode='valid')
-                i -= np.convolve (dt.imag, window, mode='valid')
-                tw = np.convolve (tw, window, mode='valid')
-
-            sreal = r.std ()
-            simag = i.std ()
-
-            agants.add (bp[0], bp[1])
-            aginfo.add (mreal, sreal, mimag, simag, tw.mean (), 0.)
-            seenAps.add (bp[0])
-            seenAps.add (bp[1])
-
-        del self.integData
-
-        self.aps = sorted (seenAps)
-        self.info = aginfo.finish ()
-        assert len (self.info) > 0, 'No data accepted!'
-        self.ants = agants.finish ()
-        self.tsyses = self.info[:,5]
+        # Flatten out data into arrays of values we'll need. This works on
+        # the stacked (nbp, nchan) arrays of the accumulator all at once;
+        # flagged channels are carried along with zero weight.
+
+        hann = self.hann
+        bps, dt, times = self.accum.arrays ()
+
+        # if only 1 item after smoothing, can't calc meaningful std
+        valid = times > 0
+        idx = np.flatnonzero (valid.sum (axis=1) >= hann + 2)
+        assert idx.size > 0, 'No data accepted!'
+
+        dt = dt[idx]
+        times = times[idx]
+        valid = valid[idx]
+        nvalid = valid.sum (axis=1)
+
+        avg = np.zeros_like (dt)
+        np.divide (dt, times, out=avg, where=valid)
+        mreal = avg.real.sum (axis=1) / nvalid
+        mimag = avg.imag.sum (axis=1) / nvalid
+
+        if hann > 1:
+            # Normalized convolution: smooth the weighted data and the
+            # weights, so that flagged channels do not drag the smoothed
+            # value toward zero. Only channels whose entire window falls
+            # on valid data are used, so that each run of valid channels
+            # loses (hann/2) channels at either end, just like the edges
+            # of the spectral window.
+            window = np.hanning (hann) * 2 / (hann - 1)
+            mask = valid.astype (np.double)
+            num = _convolveRows (avg, window)
+            den = _convolveRows (mask, window)
+            cover = _convolveRows (mask, np.ones (hann))
+            center = slice (hann / 2, hann / 2 + num.shape[1])
+
+            valid = valid[:,center] & (cover > hann - 0.5)
+            smooth = np.zeros_like (num)
+            np.divide (num, den, out=smooth, where=valid)
+            avg = avg[:,center] - smooth
+            tsmooth = np.zeros_like (den)
+            np.divide (_convolveRows (times, window), den, out=tsmooth, where=valid)
+            times = tsmooth
+
+        n = valid.sum (axis=1)
+        keep = n >= 2
+        assert keep.any (), 'No data accepted!'
+
+        if not keep.all ():
+            idx, avg, times, valid, n = idx[keep], avg[keep], times[keep], valid[keep], n[keep]
+            mreal, mimag = mreal[keep], mimag[keep]
+
+        def rowstd (x):
+            d = x - (x * valid).sum (axis=1)[:,None] / n[:,None]
+            d *= valid
+            return np.sqrt ((d**2).sum (axis=1) / n)
+
+        self.info = info = np.empty ((idx.size, 6))
+        info[:,0] = mreal
+        info[:,1] = rowstd (avg.real)
+        info[:,2] = mimag
+        info[:,3] = rowstd (avg.imag)
+        info[:,4] = (times * valid).sum (axis=1) / n
+        info[:,5] = 0.
+
+        self.ants = np.array ([bps[i] for i in idx], dtype=np.int)
+        self.aps = list (np.unique (self.ants))
+        self.tsyses = info[:,5]
 
-        self.nbp = len (self.info)
-        self.nap = len (seenAps)
+        self.nbp = len (info)
+        self.nap = len (self.aps)
         self.idxs = xrange (0, self.nbp)
 
         self._flattenAps ()
 
     def _flattenAps (self):
-        index = self.aps.index
-
-        for i in self.idxs:
-            row = self.ants[i]
-            row[0] = index (row[0])
-            row[1] = index (row[1])
+        self.ants = np.searchsorted (self.aps, self.ants)
 
     def _computeBPSysTemps (self, jyperk, sdf):
         # Compute per-baseline tsyses
@@ -569,97 +643,95 @@ class SysTemps (object):
 
             tsyses[i] = tsys
 
-    def _reflattenFiltered (self, skipAps, skipBps):
-        # prefix: o = old, n = new
-
-        seenAps = set ()
-        naginfo = ArrayGrower (6, np.double)
-        nagants = ArrayGrower (2, np.int)
-        oAnts = self.ants
-        oAps = self.aps
-
-        # Copy old data
-
-        for i in self.idxs:
-            oa1, oa2 = oAnts[i]
-            a1, a2 = oAps[oa1], oAps[oa2]
-            if (a1, a2) in skipBps: continue
-            if a1 in skipAps or a2 in skipAps: continue
-
-            naginfo.addLine (self.info[i])
-            nagants.add (a1, a2)
-            seenAps.add (a1)
-            seenAps.add (a2)
-
-        info = naginfo.finish ()
-        ants = nagants.finish ()
-
-        assert len (info) > 0, 'Skipped all antpols!'
-
-        self.aps = aps = sorted (seenAps)
-        self.nbp = len (info)
-        self.nap = len (seenAps)
-        self.idxs = idxs = xrange (0, self.nbp)
-        self.info = info
-        self.ants = ants
-        self.tsyses = info[:,5]
-
-        self._flattenAps ()
-
-    def _solve (self):
-        from mirtask.util import linLeastSquares
-
-        idxs = self.idxs
-        ants = self.ants
-        tsyses = self.tsyses
-
+    def _initSolve (self):
+        # Set up the state for the iterative solve. The full set of
+        # basepols from _flatten () is kept, and rejected basepols and
+        # antpols are dropped by clearing entries in _bpmask and
+        # downdating the normal equations, so that a rejection round
+        # does not rebuild anything.
+        #
         # T_ij = sqrt (T_i T_j)
         # square and take logarithm:
         # 2 * log (T_ij) = log (T_i) + log (T_j)
         #
-        # transform problem into log space and populate
-        # the data matrices for the solver.
-
-        coeffs = np.zeros ((self.nap, self.nbp))
+        # transform problem into log space. Each row of the design
+        # matrix has exactly two unit entries, so the normal equations
+        # can be built directly: the diagonal counts the baselines of
+        # each antpol and the off-diagonal terms count the baselines
+        # shared by each pair of antpols.
+
+        self._allAps = self.aps
+        self._allAnts = self.ants
+        self._allInfo = self.info
+        self._bpmask = np.ones (self.nbp, dtype=np.bool)
+        self._vals = 2 * np.log (self.tsyses)
+        self._normal, self._rhs = _normalTerms (self._allAnts, self._vals, self.nap)
+
+    def _reject (self, skipAps, skipBps):
+        aps = self._allAps
+        ants = self._allAnts
+        drop = np.zeros (ants.shape[0], dtype=np.bool)
+
+        if len (skipAps):
+            apidxs = np.searchsorted (aps, skipAps)
+            drop |= np.in1d (ants[:,0], apidxs)
+            drop |= np.in1d (ants[:,1], apidxs)
+
+        for a1, a2 in skipBps:
+            drop |= ((ants[:,0] == aps.index (a1)) &
+                     (ants[:,1] == aps.index (a2)))
+
+        drop &= self._bpmask
+        self._bpmask &= ~drop
+        assert self._bpmask.any (), 'Skipped all antpols!'
+
+        normal, rhs = _normalTerms (ants[drop], self._vals[drop], len (aps))
+        self._normal -= normal
+        self._rhs -= rhs
 
-        for i in idxs:
-            a1, a2 = ants[i]
-            coeffs[a1,i] = 1
-            coeffs[a2,i] = 1
-
-        vals = 2 * np.log (tsyses)
-
-        logTs = linLeastSquares (coeffs, vals)
+    def _solve (self):
+        # Solve for the antpols that still have baselines, then expose the
+        # surviving basepols and antpols as compact arrays for the
+        # flagging logic and the printing and plotting routines.
+
+        apidx = np.flatnonzero (self._normal.diagonal () > 0)
+        bpidx = np.flatnonzero (self._bpmask)
+        apmap = np.zeros (len (self._allAps), dtype=np.int)
+        apmap[apidx] = np.arange (apidx.size)
+
+        self.aps = [self._allAps[i] for i in apidx]
+        self.ants = ants = apmap[self._allAnts[bpidx]]
+        self.info = self._allInfo[bpidx]
+        self.tsyses = tsyses = self.info[:,5]
+        self.nbp = nbp = bpidx.size
+        self.nap = nap = apidx.size
+        self.idxs = xrange (0, nbp)
+        a1 = ants[:,0]
+        a2 = ants[:,1]
+
+        normal = self._normal[apidx[:,None],apidx]
+        rhs = self._rhs[apidx]
+
+        try:
+            logTs = np.linalg.solve (normal, rhs)
+        except np.linalg.LinAlgError:
+            # Degenerate baseline coverage; fall back to the
+            # minimum-norm solution.
+            logTs = np.linalg.lstsq (normal, rhs)[0]
 
         self.soln = soln = np.exp (logTs)
 
         # Populate useful arrays.
 
-        self.model = model = np.ndarray (self.nbp)
-
-        for i in idxs:
-            a1, a2 = ants[i]
-            model[i] = soln[a1] * soln[a2]
-
-        np.sqrt (model, model)
+        self.model = model = np.sqrt (soln[a1] * soln[a2])
+        self.resid = resid = tsyses - model
+        self.rchisq = (resid**2).sum () / (nbp - nap)
+        print >>self.out, '   Pseudo-RChiSq:', self.rchisq
 
-        self.resid = tsyses - model
-        self.rchisq = (self.resid**2).sum () / (self.nbp - self.nap)
-        print '   Pseudo-RChiSq:', self.rchisq
-
-        self.rms = rms = np.ndarray (self.nap)
-        self.ncontrib = ncontrib = np.zeros (self.nap)
-
-        sa = StatsAccumulator ()
-
-        for i in xrange (self.nap):
-            sa.clear ()
-            for j in self.idxs:
-                if i not in ants[j]:
-                    continue
-                sa.add (self.resid[j])
-                ncontrib[i] += 1
-            rms[i] = sa.rms ()
+        rsq = resid**2
+        sqtot = np.bincount (a1, rsq, minlength=nap) + np.bincount (a2, rsq, minlength=nap)
+        self.ncontrib = ncontrib = normal.diagonal ().astype (np.double)
+        self.rms = np.sqrt (sqtot / ncontrib)
 
 
     def _print (self):
@@ -671,22 +743,22 @@ class SysTemps (object):
         resid = self.resid
         ants = self.ants
 
-        print 'Solutions:'
+        print >>self.out, 'Solutions:'
 
         col = 0
 
         for i in xrange (0, self.nap):
-            if col == 0: print ' ',
+            if col == 0: print >>self.out, ' ',
             if col < 3:
-                print ' %3s %#.4g (%#.3g)' % (util.fmtAP (aps[i]), soln[i], rms[i]),
+                print >>self.out, ' %3s %#.4g (%#.3g)' % (util.fmtAP (aps[i]), soln[i], rms[i]),
                 col += 1
             else:
-                print ' %3s %#.4g (%#.3g)' % (util.fmtAP (aps[i]), soln[i], rms[i])
+                print >>self.out, ' %3s %#.4g (%#.3g)' % (util.fmtAP (aps[i]), soln[i], rms[i])
                 col = 0
 
         # Make sure we end with a newline
-        print
-        print 'Worst residuals:'
+        print >>self.out
+        print >>self.out, 'Worst residuals:'
 
         idxs = np.abs (resid).argsort ()
         col = 0
@@ -697,17 +769,17 @@ class SysTemps (object):
             a1, a2 = ants[idx]
             bp = util.fmtBP ((aps[a1], aps[a2])).rjust (8)
 
-            if col == 0: print ' ',
+            if col == 0: print >>self.out, ' ',
             if col < 4:
-                print '%s % #6g' % (bp, resid[idx]),
+                print >>self.out, '%s % #6g' % (bp, resid[idx]),
                 col += 1
             else:
-                print '%s % #6g' % (bp, resid[idx])
+                print >>self.out, '%s % #6g' % (bp, resid[idx])
                 col = 0
 
         # Make sure we end with a newline
-        print
-        print 'Best dual-pol antennas:'
+        print >>self.out
+        print >>self.out, 'Best dual-pol antennas:'
 
         jtsyses = {}
         lastant = None
@@ -724,12 +796,12 @@ class SysTemps (object):
 
         sjtsys = sorted (jtsyses.iteritems (), key=lambda t: t[1])
 
-        print '   ',
+        print >>self.out, '   ',
         for ant, jtsys in sjtsys[:5]:
-            print '%d (%#.4g)' % (ant, jtsys),
+            print >>self.out, '%d (%#.4g)' % (ant, jtsys),
 
         # Make sure we end with a newline
-        print
+        print >>self.out
 
     def _show (self, haveModel):
         import omega
@@ -776,10 +848,11 @@ class SysTemps (object):
     def flush (self, jyperk, sdf):
         self._flatten ()
         self._computeBPSysTemps (jyperk, sdf)
+        self._initSolve ()
 
         if self.showpre: self._show (False)
 
-        print 'Iteratively flagging ...'
+        print >>self.out, 'Iteratively flagging ...'
         allBadBps = set ()
 
         while True:
@@ -818,16 +891,16 @@ class SysTemps (object):
             badAps = badAps[0:3]
 
             for bp, resid in badBps:
-                print '      Flagging basepol %s: resid |%#4g| > %#4g' % \
+                print >>self.out, '      Flagging basepol %s: resid |%#4g| > %#4g' % \
                       (util.fmtBP (bp), resid, self.maxresid)
             for ap, soln in badAps:
-                print '      Flagging antpol %s: TSys %#4g > %#4g' % \
+                print >>self.out, '      Flagging antpol %s: TSys %#4g > %#4g' % \
                       (util.fmtAP (ap), soln, self.maxtsys)
 
-            self._reflattenFiltered ([t[0] for t in badAps],
-                                     [t[0] for t in badBps])
+            self._reject ([t[0] for t in badAps],
+                          [t[0] for t in badBps])
 
-        print
+        print >>self.out
         self._print ()
 
         # If showall, we already showed this solution up above.
@@ -835,7 +908,7 @@ class SysTemps (object):
 
         tmin = self.tmin
 
-        self.integData = {}
+        self.accum.clear ()
         self.tmin = None
 
         return (tmin, self.aps, self.soln, allBadBps, jyperk, self.rms,
@@ -845,10 +918,22 @@ class SysTemps (object):
 
 class DataProcessor (object):
     def __init__ (self, interval, flux, etaQ, hann, fjyperk, maxtsys,
-                  maxresid, showpre=False, showall=False, showfinal=False):
+                  maxresid, showpre=False, showall=False, showfinal=False,
+                  workers=0):
         self.interval = interval
         self.fjyperk = fjyperk
 
+        # If workers > 0, completed intervals are solved on a pool of
+        # that many threads while reading continues. Each interval
+        # buffers its messages, and they are printed in time order as
+        # the solutions come back. Plotting has to happen in the main
+        # thread, so it forces serial operation.
+        if showpre or showall or showfinal:
+            workers = 0
+        self.workers = workers
+        self._pool = None
+        self._pending = []
+
         self.sts = SysTemps (flux, etaQ, hann, maxtsys, maxresid,
                              showpre, showall, showfinal)
         self.first = True
@@ -856,24 +941,86 @@ class DataProcessor (object):
         self.warnedFluxAndCrossPols = False
         self.solutions = []
 
-    def _jyperk (self, rawval):
+    def _jyperk (self, rawval, out):
         if self.fjyperk == 1.:
-            print 'Computing SEFDs in Jy.'
+            print >>out, 'Computing SEFDs in Jy.'
             return 1.
 
         if self.fjyperk > 0:
-            print 'Computing temps in Kelvin, using Jy/K =', self.fjyperk, '(from task arguments)'
+            print >>out, 'Computing temps in Kelvin, using Jy/K =', self.fjyperk, '(from task arguments)'
             return self.fjyperk
 
         if self.fjyperk == -1.:
-            print 'Computing temps in Kelvin, using Jy/K =', rawval, '(from "jyperk" in dataset)'
+            print >>out, 'Computing temps in Kelvin, using Jy/K =', rawval, '(from "jyperk" in dataset)'
             return rawval
 
         v = -self.fjyperk * rawval
-        print 'Computing temps in Kelvin, using Jy/K =', v, \
+        print >>out, 'Computing temps in Kelvin, using Jy/K =', v, \
               '(%g * "jyperk" in dataset)' % (-self.fjyperk)
         return v
 
+    def _flush (self, rawjyperk, sdf):
+        if self.workers <= 0:
+            self.solutions.append (self.sts.flush (self._jyperk (rawjyperk, sys.stdout), sdf))
+            return
+
+        if self._pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._pool = ThreadPoolExecutor (self.workers)
+
+        from cStringIO import StringIO
+        sts = self.sts.detach ()
+        sts.out = StringIO ()
+        jyperk = self._jyperk (rawjyperk, sts.out)
+
+        try:
+            self._pending.append ((self._pool.submit (sts.flush, jyperk, sdf), sts.out))
+
+            # Don't let the queue of accumulated intervals grow without
+            # bound if reading outpaces solving.
+            self._collect (len (self._pending) - 2 * self.workers)
+        except:
+            self._shutdown ()
+            raise
+
+    def _collect (self, nwait):
+        # Gather finished solutions in submission order, waiting for at
+        # least the first nwait of them. If a solve failed, its
+        # exception is raised here, after its messages are printed.
+
+        while len (self._pending):
+            future, out = self._pending[0]
+            if nwait <= 0 and not future.done ():
+                break
+
+            try:
+                soln = future.result ()
+            finally:
+                sys.stdout.write (out.getvalue ())
+                del self._pending[0]
+
+            self.solutions.append (soln)
+            nwait -= 1
+
+    def _shutdown (self):
+        # Shut down the pool. Normally nothing is pending by now; after
+        # a failure, the intervals that haven't started are cancelled,
+        # and whatever the others printed is still shown.
+
+        if self._pool is None:
+            return
+
+        for future, out in self._pending:
+            future.cancel ()
+
+        self._pool.shutdown ()
+        self._pool = None
+
+        for future, out in self._pending:
+            sys.stdout.write (out.getvalue ())
+
+        self._pending = []
+
     def process (self, inp, preamble, data, flags):
         time = preamble[3]
 
@@ -937,7 +1084,7 @@ class DataProcessor (object):
         # drop both (eg) 6X-6X and 6X-6Y baselines.
         if ants[0] != ants[1] and not fcpdiscard:
             if (time - tmin) > self.interval or (tmax - time) > self.interval:
-                self.solutions.append (self.sts.flush (self._jyperk (jyperk), sdf))
+                self._flush (jyperk, sdf)
                 tmin = tmax = time
 
             self.sts.accumulate (time, bp, data, flags, inttime)
@@ -946,7 +1093,12 @@ class DataProcessor (object):
         self.jyperk, self.inttime, self.sdf = jyperk, inttime, sdf
 
     def finish (self):
-        self.solutions.append (self.sts.flush (self._jyperk (self.jyperk), self.sdf))
+        try:
+            self._flush (self.jyperk, self.sdf)
+            self._collect (len (self._pending))
+        finally:
+            self._shutdown ()
+
         self.solutions.sort (key = lambda t: t[0])
 
         # Sentinel entry to make rewriteData algorithm simpler.
@@ -1387,6 +1539,7 @@ def taskCalc (args):
     ks.keyword ('hann', 'i', 1)
     ks.keyword ('jyperk', 'd', -1.0)
     ks.keyword ('select', 'a', '')
+    ks.keyword ('workers', 'i', 0)
     ks.option ('showpre', 'showfinal', 'showall', 'dualpol',
                  'nocal', 'nopass', 'nopol')
     args = ks.process (args)
@@ -1425,6 +1578,10 @@ def taskCalc (args):
         print >>sys.stderr, 'Error: jyperk argument may not be zero.'
         sys.exit (1)
 
+    if args.workers < 0:
+        print >>sys.stderr, 'Error: invalid number of workers', args.workers
+        sys.exit (1)
+
     inputArgs = {}
 
     if args.nocal:
@@ -1506,11 +1663,14 @@ def taskCalc (args):
         else:
             print '  Rewriting tsys variable; single-pol data only.'
 
+    if args.workers > 0:
+        print '  Solving intervals on %d worker threads.' % args.workers
+
     # Let's go!
 
     dp = DataProcessor (interval, args.flux, etaQ, args.hann, args.jyperk,
                         args.maxtsys, args.maxresid, args.showpre, args.showall,
-                        args.showfinal)
+                        args.showfinal, args.workers)
 
     for tup in vis.readLowlevel ('3', False, **inputArgs):
         dp.process (*tup)
@@ -1578,5 +1738,299 @@ def taskApply (args):
     return 0
 
 
+# Quickie testing infrastructure. These tests exercise the solver
+# directly, without any UV data I/O; run them with "calctsys.py test".
+
+_testfuncs = []
+
+def test (f): # a decorator
+    _testfuncs.append (f)
+    return f
+
+def _runtests (namefilt=None):
+    for f in _testfuncs:
+        if namefilt is not None and f.__name__ != namefilt:
+            continue
+        n = f.__name__
+        if n[0] == '_':
+            n = n[1:]
+        print n, '...'
+        f ()
+
+
+def _testRecords (seed, nchan=64, flagfunc=None):
+    # Synthetic single-integration records for 10 antennas with two
+    # feeds each. Antpol 25 is bad and the noise on basepol 9-56 is
+    # inflated, so that the iterative solve has to reject both.
+
+    rng = np.random.RandomState (seed)
+    aps = [a * 8 + p for a in xrange (1, 11) for p in (0, 1)]
+    truth = dict ((ap, rng.uniform (40, 80)) for ap in aps)
+    truth[25] = 900.
+    recs = []
+
+    for i, a1 in enumerate (aps):
+        for a2 in aps[i+1:]:
+            if a1 >> 3 == a2 >> 3:
+                continue
+
+            # With the SDF and jyperk used below, this makes the
+            # baseline TSys come out near sqrt (T1 * T2).
+            sigma = np.sqrt (truth[a1] * truth[a2]) / np.sqrt (2e8 * 10)
+            if (a1, a2) == (9, 56):
+                sigma *= 3
+            data = (rng.normal (size=nchan) + 1j * rng.normal (size=nchan)) * sigma
+            data += 1e-4 * np.arange (nchan)
+            flags = np.ones (nchan, dtype=np.int32)
+            if flagfunc is not None:
+                flagfunc (len (recs), flags)
+            recs.append (((a1, a2), data.astype (np.complex64), flags))
+
+    return recs
+
+
+def _testSysTemps (hann, recs, maxresid=30.):
+    from cStringIO import StringIO
+    sts = SysTemps (None, 1., hann, 350., maxresid, False, False, False)
+    sts.out = StringIO ()
+
+    for bp, data, flags in recs:
+        sts.accumulate (0., bp, data, flags, 10.)
+
+    return sts
+
+
+def _refFlatten (hann, dt, times):
+    # Per-basepol, per-channel reference for the noise estimate of
+    # _flatten: smoothed values are used only where the whole window
+    # falls on valid channels.
+
+    valid = times > 0
+    avg = np.zeros_like (dt)
+    avg[valid] = dt[valid] / times[valid]
+
+    if hann == 1:
+        r = avg[valid]
+        t = times[valid]
+    else:
+        window = np.hanning (hann) * 2 / (hann - 1)
+        r = []
+        t = []
+
+        for lo in xrange (dt.size - hann + 1):
+            if not valid[lo:lo+hann].all ():
+                continue
+            r.append (avg[lo + hann / 2] - np.dot (window, avg[lo:lo+hann]) / window.sum ())
+            t.append (np.dot (window, times[lo:lo+hann]) / window.sum ())
+
+        r = np.array (r)
+        t = np.array (t)
+
+    return (avg[valid].real.mean (), r.real.std (), avg[valid].imag.mean (),
+            r.imag.std (), t.mean ())
+
+
+def _legacyFlatten (hann, dt, times):
+    # The original per-basepol computation, which squeezed out flagged
+    # channels before smoothing. It agrees with _refFlatten when the
+    # valid channels are contiguous.
+
+    w = np.where (times > 0)
+    tw = times[w]
+    dt = dt[w] / tw
+    r = dt.real
+    i = dt.imag
+    mreal = r.mean ()
+    mimag = i.mean ()
+
+    if hann > 1:
+        window = np.hanning (hann) * 2 / (hann - 1)
+        r = r[hann / 2 : -hann / 2 + 1]
+        i = i[hann / 2 : -hann / 2 + 1]
+        r -= np.convolve (dt.real, window, mode='valid')
+        i -= np.convolve (dt.imag, window, mode='valid')
+        tw = np.convolve (tw, window, mode='valid')
+
+    return mreal, r.std (), mimag, i.std (), tw.mean ()
+
+
+@test
+def _flatten_vs_reference ():
+    def flagfunc (i, flags):
+        kind = i % 4
+        if kind == 1:
+            # Band edges, as is typical.
+            flags[:5] = 0
+            flags[-7:] = 0
+        elif kind == 2:
+            # Interior flags: a block and an isolated channel.
+            flags[20:24] = 0
+            flags[40] = 0
+        elif kind == 3:
+            flags[:3] = 0
+            flags[30:33] = 0
+
+    recs = _testRecords (1, flagfunc=flagfunc)
+
+    for hann in (1, 4, 5):
+        sts = _testSysTemps (hann, recs)
+        bps, dt, times = sts.accum.arrays ()
+        ref = np.array ([_refFlatten (hann, dt[i], times[i]) for i in xrange (len (bps))])
+        sts._flatten ()
+
+        assert sts.info.shape[0] == len (recs)
+        assert np.allclose (sts.info[:,:5], ref, rtol=1e-10, atol=0)
+        assert np.allclose (sts.info[:,4], 10., rtol=1e-12, atol=0)
+
+        # Without interior gaps, the old squeeze-out computation should
+        # be reproduced.
+        for i in range (0, len (recs), 4) + range (1, len (recs), 4):
+            legacy = _legacyFlatten (hann, dt[i], times[i])
+            assert np.allclose (sts.info[i,:5], legacy, rtol=1e-10, atol=0)
+
+
+def _testSolve (sts):
+    sts._flatten ()
+    sts._computeBPSysTemps (1., 0.1)
+    sts._initSolve ()
+    sts._solve ()
+    return sts
+
+
+@test
+def _rejection_downdate ():
+    recs = _testRecords (2)
+    skipAps = [25]
+    skipBps = [(9, 56), (16, 41)]
+
+    # Downdated normal equations versus a solve that never saw the
+    # rejected data.
+
+    sts = _testSolve (_testSysTemps (5, recs))
+    sts._reject (skipAps, skipBps)
+    sts._solve ()
+
+    kept = [r for r in recs
+            if r[0] not in skipBps and r[0][0] not in skipAps
+            and r[0][1] not in skipAps]
+    fresh = _testSolve (_testSysTemps (5, kept))
+
+    assert sts.aps == fresh.aps
+    assert (sts.ants == fresh.ants).all ()
+    assert sts.nbp == len (kept) and sts.nap == len (fresh.aps)
+    assert (sts.ncontrib == fresh.ncontrib).all ()
+
+    for attr in 'soln model resid rms'.split ():
+        assert np.allclose (getattr (sts, attr), getattr (fresh, attr),
+                            rtol=1e-10, atol=0)
+
+    # The closed-form normal equations versus a dense least-squares
+    # solve of the log-space problem.
+
+    coeffs = np.zeros ((sts.nbp, sts.nap))
+    coeffs[np.arange (sts.nbp),sts.ants[:,0]] = 1
+    coeffs[np.arange (sts.nbp),sts.ants[:,1]] = 1
+    logTs = np.linalg.lstsq (coeffs, 2 * np.log (sts.tsyses))[0]
+    assert np.allclose (sts.soln, np.exp (logTs), rtol=1e-10, atol=0)
+
+    # And the full iteration should find the bad antpol and basepol.
+
+    soln = _testSysTemps (5, recs).flush (1., 0.1)
+    assert 25 not in soln[1]
+    assert (9, 56) in soln[3]
+
+
+@test
+def _pool_matches_serial ():
+    from cStringIO import StringIO
+
+    def run (workers):
+        dp = DataProcessor (1., None, 1., 5, 1., 350., 30., workers=workers)
+        dp.jyperk, dp.sdf = 1., 0.1
+        so = sys.stdout
+        sys.stdout = StringIO ()
+
+        try:
+            for interval in xrange (5):
+                recs = _testRecords (10 + interval)
+                # Vary the set and order of basepols between intervals.
+                rng = np.random.RandomState (interval)
+                recs = [recs[i] for i in rng.permutation (len (recs))
+                        if i % 5 != interval]
+
+                for bp, data, flags in recs:
+                    dp.sts.accumulate (interval, bp, data, flags, 10.)
+                if interval < 4:
+                    dp._flush (1., 0.1)
+
+            dp.finish ()
+            return dp.solutions, sys.stdout.getvalue ()
+        finally:
+            sys.stdout = so
+
+    serial, stext = run (0)
+    pooled, ptext = run (2)
+    assert stext == ptext
+    assert len (serial) == len (pooled) == 6
+    assert [s[0] for s in pooled] == range (5) + [5]
+
+    for s, p in zip (serial[:-1], pooled[:-1]):
+        for a, b in zip (s, p):
+            if isinstance (a, np.ndarray):
+                assert (a == b).all ()
+            else:
+                assert a == b
+
+
+@test
+def _pool_failure_cleanup ():
+    from cStringIO import StringIO
+
+    # An interval in which everything is flagged can't be solved.
+    good = _testRecords (20)
+    bad = [(bp, data, np.zeros_like (flags)) for bp, data, flags in good]
+
+    def run (flushes):
+        dp = DataProcessor (1., None, 1., 5, 1., 350., 30., workers=1)
+        dp.jyperk, dp.sdf = 1., 0.1
+        so = sys.stdout
+        sys.stdout = StringIO ()
+
+        try:
+            for i, recs in enumerate (flushes):
+                for bp, data, flags in recs:
+                    dp.sts.accumulate (i, bp, data, flags, 10.)
+                if i < len (flushes) - 1:
+                    dp._flush (1., 0.1)
+                    # Let the solve finish so that the next _flush ()
+                    # collects it.
+                    dp._pending[-1][0].exception ()
+            dp.finish ()
+        except AssertionError:
+            pass
+        else:
+            assert False, 'failed solve should have raised'
+        finally:
+            text = sys.stdout.getvalue ()
+            sys.stdout = so
+
+        assert dp._pool is None and dp._pending == []
+        return dp, text
+
+    # The failure surfaces in process () -> _flush () ...
+    dp, text = run ([good, bad, good, good])
+    assert len (dp.solutions) == 1
+    # The messages of the good and failed intervals are not lost.
+    assert text.count ('Computing SEFDs') >= 2
+
+    # ... or in finish ().
+    dp, text = run ([good, bad])
+    assert len (dp.solutions) == 1
+
+
 if __name__ == '__main__':
+    if len (sys.argv) > 1 and sys.argv[1] == 'test':
+        _runtests (*sys.argv[2:3])
+        sys.exit (0)
+
     sys.exit (taskCalc (sys.argv[1:]))
@@ -137,6 +137,32 @@ Basic usage::
     p = Problem (npar, nout, yfunc, jfunc=None)
     solution = p.solve (guess)
 
+    def byfunc (params, vecs): # "batched": params is k-by-npar, vecs k-by-nout
+        vecs[k] = {stuff with params[k]}
+    p.setFunc (nout, byfunc, jfunc, batched=True)
+
+    def cyfunc (params, vec, start): # "chunked": memory use independent of nout
+        vec[:] = {outputs start through start+len(vec)-1}
+    p.setFunc (nout, cyfunc, cjfunc, chunksize=10000) # cjfunc (params, jac, start)
+
+    def vyfunc (iprob, params, vecs):
+        vecs[k] = {stuff with params[k], for problem number iprob[k]}
+    solutions = p.solveMany (guesses, vyfunc, vjfunc=None) # one row of guesses per problem
+    solution2 = p.solve (warm=solution, warmjac=False) # continue from a previous solution
+
+    plan = p.freeze (dtype=np.float) # precompute the setup for many solves
+    solution = plan.solve (guess, warm=None, warmjac=False)
+    plan.setData (yobs, errinv) # residual problems only; see below
+    p.workspace = p.makeWorkspace (dtype=np.float) # reuse work arrays in solve()
+
+    svc = FitService (max_workers=4, max_queue=64) # shared pool for async fits
+    future = svc.submit (p, guess, data=(yobs, errinv), timeout=None)
+    solution = future.result (); svc.cancel (future); svc.stats ()
+    nbytes = p.workspace.nbytes ()
+
+    solutions = p.solveMultiStart (nstart, executor=None, target_fnorm=None, seed=None)
+    best = solutions[0] # distinct solutions from random starts within pLimit, best first
+
     p2 = Problem ()
     p2.setNPar (npar) # enables configuration of parameter meta-info
     p2.setFunc (nout, yfunc, jfunc)
@@ -151,6 +177,9 @@ Main Solution properties:
    fnorm - final norm of function output
     fvec - final vector of function outputs
     fjac - final Jacobian matrix of d(fvec)/d(params)
+  njfull - number of Jacobians computed in full
+njupdate - number of Jacobians obtained by Broyden updates (see Problem.broyden)
+   trace - a SolveTrace of the progress of the solve, if Problem.trace is set
 
 Automatic least-squares model-fitting (subtracts "observed" Y values
 and multiplies by inverse errors):
@@ -159,16 +188,19 @@ and multiplies by inverse errors):
         modelyvalues[:] = {stuff with params}
     def yjfunc (params, modelyjac):
         jac[i,j] = {deriv of modelyvalue[j] w.r.t. params[i]}
-    p.setResidualFunc (yobs, errinv, yrfunc, jrfunc, reckless=False)
-    p = ResidualProblem (npar, yobs, errinv, yrfunc, jrfunc=None, reckless=False)
+    p.setResidualFunc (yobs, errinv, yrfunc, jrfunc, reckless=False, batched=False)
+    p = ResidualProblem (npar, yobs, errinv, yrfunc, jrfunc=None, reckless=False, batched=False)
+    {if yobs is complex, yrfunc and yjfunc fill in complex arrays; soln.fvec.view (complex)}
+    for soln in p.solveSequence ([(yobs1, errinv1), ...], guess, warmjac=False):
+        {each solve is warm-started from the previous one}
 
 Parameter meta-information:
 
     p.pValue (paramindex, value, fixed=False)
     p.pLimit (paramindex, lower=-inf, upper=+inf)
     p.pStep (paramindex, stepsize, maxstep=info, isrel=False)
-    p.pSide (paramindex, sidedness) # one of 'auto', 'pos', 'neg', 'two'
-    p.pTie (paramindex, tiefunc) # pval = tiefunc (params)
+    p.pSide (paramindex, sidedness) # one of 'auto', 'pos', 'neg', 'two', 'complex'
+    p.pTie (paramindex, tiefunc, vectorized=False) # pval = tiefunc (params)
 
 solve() status codes:
 
@@ -218,8 +250,8 @@ from __future__ import division
 import numpy as np
 
 __all__ = ('enorm_fast enorm_mpfit_careful enorm_minpack '
-           'Problem Solution ResidualProblem '
-           'checkDerivative').split ()
+           'Problem Solution ResidualProblem SolvePlan SolveTrace '
+           'Workspace FitService checkDerivative').split ()
 
 
 # Quickie testing infrastructure
@@ -260,10 +292,12 @@ PI_F_STEP = 3 # fixed parameter step size to use (abs or rel), 0. for unspecifie
 PI_F_MAXSTEP = 4 # maximum step to take
 PI_NUM_F = 5
 
-# Four bits of data
+# Six bits of data
 PI_M_SIDE = 0x3 # sidedness of derivative - two bits
 PI_M_FIXED = 0x4 # fixed value
 PI_M_RELSTEP = 0x8 # whether the specified stepsize is relative
+PI_M_CSTEP = 0x10 # complex-step derivative; overrides sidedness
+PI_M_VECTIE = 0x20 # tie function is vectorized
 
 # And one object
 PI_O_TIEFUNC = 0 # fixed to be a function of other parameters
@@ -280,6 +314,7 @@ _dside_names = {
     'pos': DSIDE_POS,
     'neg': DSIDE_NEG,
     'two': DSIDE_TWO,
+    'complex': PI_M_CSTEP,
 }
 
 
@@ -476,23 +511,24 @@ appeared in Linpack."""
     return pmut, rdiag, acnorm
 
 
-def _manual_qr_factor_packed (a, dtype=np.float):
+def _manual_qr_factor_packed (a, dtype=np.float, factor=_qr_factor_packed):
     # This testing function gives sensible defaults to _qr_factor_packed
     # and makes a copy of its input to make comparisons easier.
 
     a = np.array (a, dtype)
-    pmut, rdiag, acnorm = _qr_factor_packed (a, enorm_mpfit_careful,
-                                             np.finfo (dtype))
+    pmut, rdiag, acnorm = factor (a, enorm_mpfit_careful, np.finfo (dtype))
     return a, pmut, rdiag, acnorm
 
 
-def _qr_factor_full (a, dtype=np.float):
+def _qr_factor_full (a, dtype=np.float, factor=_qr_factor_packed):
     """Compute the QR factorization of a matrix, with pivoting.
 
 Parameters:
 a     - An n-by-m arraylike, m >= n.
 dtype - (optional) The data type to use for computations.
         Default is np.float.
+factor - (optional) The packed factorization function to use.
+        Default is _qr_factor_packed.
 
 Returns:
 q    - An m-by-m orthogonal matrix (q q^T = ident)
@@ -517,7 +553,7 @@ pmut[i]'th row of 'a' has the i'th biggest norm."""
     # Compute the packed Q and R matrix information.
 
     packed, pmut, rdiag, acnorm = \
-        _manual_qr_factor_packed (a, dtype)
+        _manual_qr_factor_packed (a, dtype, factor)
 
     # Now we unpack. Start with the R matrix, which is easy: we just
     # have to piece it together from the strict lower triangle of 'a'
@@ -542,7 +578,11 @@ pmut[i]'th row of 'a' has the i'th biggest norm."""
         v[:] = packed[i]
         v[:i] = 0
 
-        hhm = np.eye (m) - 2 * np.outer (v, v) / np.dot (v, v)
+        vv = np.dot (v, v)
+        if vv == 0:
+            continue # H_i is the identity; LAPACK can produce these
+
+        hhm = np.eye (m) - 2 * np.outer (v, v) / vv
         q = np.dot (hhm, q)
 
     return q, r, pmut
@@ -1060,6 +1100,288 @@ where dxnorm = enorm (D x).
     return par, x, dxnorm, relnormdiff
 
 
+# LAPACK-backed versions of the above. These take and return exactly the
+# same data structures as the pure-Python MINPACK implementations, so
+# that the two can be swapped freely (see Problem.linalg). The
+# arithmetic is not identical -- in particular, LAPACK's pivoting
+# strategy for the QR factorization recomputes the partial column norms
+# with a different tolerance -- so results agree only to within
+# rounding. They require scipy.
+
+def _qr_factor_packed_lapack (a, enorm, finfo):
+    """Compute the packed pivoting Q-R factorization of a matrix with LAPACK.
+
+This is a drop-in replacement for _qr_factor_packed(); see its
+docstring for the meaning of the parameters and return values.
+
+LAPACK's xGEQP3 computes the same kind of factorization as MINPACK,
+with the same sign convention for the diagonal of R, but represents
+each Householder transformation as H_i = I - tau_i u u^T with u_i = 1
+rather than as H_i = I - (v v^T) / v_i. Since v = tau_i u, converting
+to the MINPACK packed form is just a matter of scaling."""
+
+    from scipy.linalg.lapack import get_lapack_funcs
+
+    n, m = a.shape
+
+    if m < n:
+        raise ValueError ('"a" must be at least as tall as it is wide')
+
+    acnorm = np.empty (n, finfo.dtype)
+    for j in xrange (n):
+        acnorm[j] = enorm (a[j], finfo)
+
+    # a.T is the Fortran-ordered m-by-n matrix that LAPACK expects.
+    geqp3, = get_lapack_funcs (('geqp3', ), (a, ))
+    qr, jpvt, tau, work, info = geqp3 (a.T)
+
+    if info != 0:
+        raise RuntimeError ('LAPACK geqp3 failed (info = %d)' % info)
+
+    a[:] = qr.T
+    rdiag = a.diagonal ().copy ()
+    a[np.arange (n),np.arange (n)] = tau
+    a *= np.where (np.arange (m) > np.arange (n)[:,np.newaxis],
+                   tau[:,np.newaxis], 1.)
+
+    return jpvt - 1, rdiag, acnorm
+
+
+def _qrd_solve_lapack (r, pmut, ddiag, bqt, sdiag):
+    """Solve an equation given a QR factored matrix and a diagonal, with LAPACK.
+
+This is a drop-in replacement for _qrd_solve(); see its docstring for
+the meaning of the parameters and return values. Rather than
+eliminating D with Givens rotations one element at a time, we compute
+the Q-R factorization of the stacked 2n-by-(n+1) matrix
+
+ [ R   B Q^T ]
+ [ D P   0   ]
+
+whose triangular factor contains S in its first n columns and the
+right-hand side of the triangular system S z = (...) in its last
+column. S is only determined up to the signs of its rows, which does
+not matter to any of its consumers."""
+
+    from scipy.linalg import qr, solve_triangular
+
+    n = r.shape[0]
+    w = np.zeros ((2 * n, n + 1), dtype=r.dtype)
+    w[:n,:n] = r[:,:n].T
+    w[:n,:n] = np.triu (w[:n,:n])
+    w[:n,n] = bqt
+    w[np.arange (n, 2 * n),np.arange (n)] = ddiag[pmut]
+
+    s = qr (w, mode='r', overwrite_a=True, check_finite=False)[0]
+
+    sdiag[:] = s.diagonal ()[:n]
+    iu = np.triu_indices (n, 1)
+    r[iu] = s[iu]
+
+    # "Solve the triangular system for z.  If the system is singular
+    # then obtain a least squares solution."
+
+    nsing = n
+    wh = np.where (sdiag == 0)[0]
+    if wh.size:
+        nsing = wh[0]
+
+    zwork = np.zeros (n, dtype=r.dtype)
+    if nsing > 0:
+        zwork[:nsing] = solve_triangular (s[:nsing,:nsing], s[:nsing,n],
+                                          check_finite=False)
+
+    x = np.empty (n, dtype=r.dtype)
+    x[pmut] = zwork
+    return x
+
+
+def _lm_solve_lapack (r, pmut, ddiag, bqt, delta, par0, enorm, finfo):
+    """Compute the Levenberg-Marquardt parameter and solution vector with LAPACK.
+
+This is a drop-in replacement for _lm_solve(); see its docstring for
+the meaning of the parameters and return values. The iteration is the
+same, but the triangular solves are done with LAPACK and
+_qrd_solve_lapack() is used in place of _qrd_solve()."""
+
+    from scipy.linalg import solve_triangular
+
+    dwarf = finfo.tiny
+    n = r.shape[0]
+    rn = r[:,:n]
+    sdiag = np.empty_like (bqt)
+
+    # "Compute and store x in the Gauss-Newton direction. If the
+    # Jacobian is rank-deficient, obtain a least-squares solution."
+
+    nnonsingular = n
+    wh = np.where (rn.diagonal () == 0)[0]
+    if wh.size:
+        nnonsingular = wh[0]
+
+    wa1 = np.zeros_like (bqt)
+    if nnonsingular > 0:
+        k = nnonsingular
+        wa1[:k] = solve_triangular (rn[:k,:k], bqt[:k], trans='T', lower=True,
+                                    check_finite=False)
+
+    x = np.empty_like (bqt)
+    x[pmut] = wa1
+
+    # Initial function evaluation. Check if the Gauss-Newton direction
+    # was good enough.
+
+    wa2 = ddiag * x
+    dxnorm = enorm (wa2, finfo)
+    normdiff = dxnorm - delta
+
+    if normdiff <= 0.1 * delta:
+        return 0, x
+
+    # If the Jacobian is not rank deficient, the Newton step provides
+    # a lower bound for the zero of the function.
+
+    par_lower = 0.
+
+    if nnonsingular == n:
+        wa1 = solve_triangular (rn, ddiag[pmut] * wa2[pmut] / dxnorm,
+                                lower=True, check_finite=False)
+        temp = enorm (wa1, finfo)
+        par_lower = normdiff / delta / temp**2
+
+    # We can always find an upper bound.
+
+    wa1 = np.dot (np.tril (rn), bqt) / ddiag[pmut]
+    gnorm = enorm (wa1, finfo)
+    par_upper = gnorm / delta
+    if par_upper == 0:
+        par_upper = dwarf / min (delta, 0.1)
+
+    # Now iterate our way to victory.
+
+    par = np.clip (par0, par_lower, par_upper)
+    if par == 0:
+        par = gnorm / dxnorm
+
+    itercount = 0
+
+    while True:
+        itercount += 1
+
+        if par == 0:
+            par = max (dwarf, par_upper * 0.001)
+
+        temp = np.sqrt (par)
+        wa1 = temp * ddiag
+        x = _qrd_solve_lapack (rn, pmut, wa1, bqt, sdiag) # sdiag is an output arg here
+        wa2 = ddiag * x
+        dxnorm = enorm (wa2, finfo)
+        olddiff = normdiff
+        normdiff = dxnorm - delta
+
+        if abs (normdiff) < 0.1 * delta:
+            break # converged
+        if par_lower == 0 and normdiff <= olddiff and olddiff < 0:
+            break # overshot, I guess?
+        if itercount == 10:
+            break # this is taking too long
+
+        # Compute and apply the Newton correction. S^T has sdiag on
+        # its diagonal and the transpose of the strict upper triangle
+        # of r below it.
+
+        wa1 = ddiag[pmut] * wa2[pmut] / dxnorm
+        s = np.triu (rn, 1)
+        s[np.arange (n),np.arange (n)] = sdiag
+
+        if np.all (sdiag != 0):
+            wa1 = solve_triangular (s, wa1, trans='T', check_finite=False)
+        else:
+            # Let the division by zero happen as it does in _lm_solve.
+            for j in xrange (n - 1):
+                wa1[j] /= sdiag[j]
+                wa1[j+1:n] -= s[j,j+1:n] * wa1[j]
+            wa1[n-1] /= sdiag[n-1]
+
+        par_delta = normdiff / delta / enorm (wa1, finfo)**2
+
+        if normdiff > 0:
+            par_lower = max (par_lower, par)
+        elif normdiff < 0:
+            par_upper = min (par_upper, par)
+
+        par = max (par_lower, par + par_delta)
+
+    return par, x
+
+
+# The available linear-algebra backends for Problem.linalg. Each maps
+# to a pair of functions (packed QR factorization, LM solver).
+
+_linalg_backends = {
+    'minpack': (_qr_factor_packed, _lm_solve),
+    'lapack': (_qr_factor_packed_lapack, _lm_solve_lapack),
+}
+
+
+@test
+def _lapack_qr_examples ():
+    try:
+        import scipy.linalg
+    except ImportError:
+        return
+
+    # For a wide matrix with well-separated column norms, the packed
+    # factorizations should agree with the reference one exactly.
+
+    a = np.asarray ([[9., 2, 6], [4, 8, 7]])
+    ref = _manual_qr_factor_packed (a)
+    lap = _manual_qr_factor_packed (a, factor=_qr_factor_packed_lapack)
+
+    for x, y in zip (ref, lap):
+        Taaae (x, y)
+
+    # For a square matrix, LAPACK skips the final, trivial Householder
+    # reflection, so the last row of R may have a different sign. Check
+    # that the factorization is valid.
+
+    a = np.asarray ([[12., 6, -4], [-51, 167, 24], [4, -68, -41]])
+    q, r, pmut = _qr_factor_full (a, factor=_qr_factor_packed_lapack)
+    Taaae (np.dot (r, q), a[pmut])
+    Taaae (np.dot (q, q.T), np.eye (3))
+
+    # The Givens and LAPACK versions of the R-with-diagonal solve should
+    # give the same solutions and the same S, up to the signs of its
+    # rows.
+
+    rng = np.random.RandomState (1)
+    a = rng.normal (size=(4, 7))
+    packed, pmut, rdiag, acnorm = _manual_qr_factor_packed (a)
+    r = packed[:,:4].copy ()
+    r[np.arange (4),np.arange (4)] = rdiag
+    ddiag = rng.uniform (0.5, 2, size=4)
+    bqt = rng.normal (size=4)
+
+    r1, sdiag1 = r.copy (), np.empty (4)
+    x1 = _qrd_solve (r1, pmut, ddiag, bqt, sdiag1)
+    r2, sdiag2 = r.copy (), np.empty (4)
+    x2 = _qrd_solve_lapack (r2, pmut, ddiag, bqt, sdiag2)
+
+    Taaae (x1, x2)
+    sign = np.sign (sdiag1 * sdiag2)
+    Taaae (sdiag1, sign * sdiag2)
+    Taaae (np.triu (r1, 1), sign[:,np.newaxis] * np.triu (r2, 1))
+    Taaae (np.tril (r1), np.tril (r)) # lower triangle is preserved
+    Taaae (np.tril (r2), np.tril (r))
+
+    p1, x1 = _lm_solve (r.copy (), pmut, ddiag, bqt, 0.1, 0.,
+                        enorm_mpfit_careful, np.finfo (np.float))
+    p2, x2 = _lm_solve_lapack (r.copy (), pmut, ddiag, bqt, 0.1, 0.,
+                               enorm_mpfit_careful, np.finfo (np.float))
+    Taae (p1, p2)
+    Taaae (x1, x2)
+
+
 def _calc_covariance (r, pmut, tol=1e-14):
     """Calculate the covariance matrix of the fitted parameters
 
@@ -1095,70 +1417,439 @@ A. We use a tolerance, 'tol', to define the numerical rank of A. If j
 is the largest integer such that |R[j,j]| > tol*|R[0,0]|, then we
 compute the covariance matrix for the first j columns of R. For k > j,
 the corresponding covariance entries (pmut[k]) are set to zero.
-"""
-    # This routine could save an allocation by operating on r in-place,
-    # which might be worthwhile for large n, and is what the original
-    # Fortran does.
 
+The inverse of the leading j-by-j block of R is computed with the
+LAPACK routine xTRTRI if scipy is available, and with numpy's general
+inverse otherwise.
+"""
     n = r.shape[1]
     assert r.shape[0] >= n
-    r = r.copy ()
+    cov = np.zeros ((n, n), dtype=r.dtype)
 
-    # Form the inverse of R in the full lower triangle of R.
+    if n == 0:
+        return cov
 
-    jrank = -1
-    abstol = tol * abs(r[0,0])
+    # The numerical rank: the columns before the first one whose
+    # diagonal element is negligible. (The diagonal is nonincreasing
+    # in magnitude, but we stop at the first small element, as the
+    # original Fortran does.)
 
-    for i in xrange (n):
-        if abs (r[i,i]) <= abstol:
-            break
+    small = np.nonzero (np.abs (r.diagonal ()[:n]) <= tol * abs (r[0,0]))[0]
+    jrank = small[0] if small.size else n
 
-        r[i,i] **= -1
+    if jrank == 0:
+        return cov
 
-        for j in xrange (i):
-            temp = r[i,i] * r[i,j]
-            r[i,j] = 0.
-            r[i,:j+1] -= temp * r[j,:j+1]
+    rinv = r[:jrank,:jrank]
 
-        jrank = i
+    try:
+        from scipy.linalg.lapack import get_lapack_funcs
+    except ImportError:
+        rinv = np.linalg.inv (np.tril (rinv))
+    else:
+        trtri, = get_lapack_funcs (('trtri', ), (rinv, ))
+        rinv, info = trtri (rinv, lower=1)
+        if info != 0:
+            raise RuntimeError ('xTRTRI failed: info = %d' % info)
+        rinv = np.tril (rinv)
 
-    # Form the full lower triangle of the inverse(R^T R) in the full
-    # lower triangle of R.
+    # With the transposed layout that we use, the covariance in the
+    # pivoted order is inverse(R R^T) = inverse(R)^T inverse(R),
+    # which we scatter back to the original order.
 
-    for i in xrange (jrank + 1):
-        for j in xrange (i):
-            r[j,:j+1] += r[i,j] * r[i,:j+1]
-        r[i,:i+1] *= r[i,i]
+    ip = pmut[:jrank]
+    cov[ip[:,np.newaxis],ip] = np.dot (rinv.T, rinv)
+    return cov
 
-    # Form the full upper triangle of the covariance matrix in the
-    # strict upper triangle of R and in wa.
 
-    wa = np.empty (n)
-    wa.fill (r[0,0])
+# Grouping of parameters for sparse finite-difference Jacobians.
 
-    for i in xrange (n):
-        pi = pmut[i]
-        sing = i > jrank
+def _cpr_groups (pattern, split):
+    """Group parameters so that each group can be perturbed at once.
 
-        for j in xrange (i + 1):
-            if sing:
-                r[i,j] = 0.
+Parameters:
+pattern - An n-by-m boolean array, laid out like the Jacobian:
+          pattern[i,j] is True if output j depends on parameter i.
+split   - An n-element array. Parameters with different values are
+          never put in the same group.
 
-            pj = pmut[j]
-            if pj > pi:
-                r[pi,pj] = r[i,j]
-            elif pj < pi:
-                r[pj,pi] = r[i,j]
+Returns:
+groups  - An n-element integer array giving the group number of each
+          parameter. Group numbers run from 0 to ngroups - 1.
+
+No two parameters in the same group affect the same output, so the
+derivatives of all members of a group can be read off from one
+function evaluation with all of them perturbed. This is the grouping
+of Curtis, Powell, and Reid (1974, J. Inst. Maths Applics, 13, 117),
+computed greedily, with the densest parameters placed first."""
+
+    n = pattern.shape[0]
+    groups = np.empty (n, dtype=np.int)
+    unions = []
+    kinds = []
+
+    for i in np.argsort (-pattern.sum (axis=1), kind='mergesort'):
+        for g in xrange (len (unions)):
+            if kinds[g] == split[i] and not np.any (unions[g] & pattern[i]):
+                unions[g] |= pattern[i]
+                break
+        else:
+            g = len (unions)
+            unions.append (pattern[i].copy ())
+            kinds.append (split[i])
 
-        wa[pi] = r[i,i]
+        groups[i] = g
 
-    # Symmetrize.
+    return groups
 
-    for i in xrange (n):
-        r[i,:i+1] = r[:i+1,i]
-        r[i,i] = wa[i]
 
-    return r
+def _jacobian_work (nrows, ncrows, npar, nout, dtype):
+    # Allocate the perturbed parameter vectors and function values
+    # used to compute an automatic Jacobian; see
+    # Problem._jacobian_rows. The complex-step rows get the complex
+    # type matching dtype.
+
+    ctype = np.result_type (dtype, np.complex64)
+    return (np.empty ((nrows, npar), dtype=dtype),
+            np.empty ((nrows, nout), dtype=dtype),
+            np.empty ((ncrows, npar), dtype=ctype),
+            np.empty ((ncrows, nout), dtype=ctype))
+
+
+# Complex-step derivatives. A yfunc that does not support complex
+# input usually either fails with a TypeError (e.g., math.exp of a
+# complex number) or silently discards the imaginary part, which
+# numpy reports with a ComplexWarning. Both are caught while the
+# complex-step rows are being evaluated. In the remaining cases,
+# the imaginary parts of the outputs come back as exactly zero,
+# which is caught after the fact.
+
+class _complex_step_guard (object):
+    def __enter__ (self):
+        import warnings
+        self._catcher = warnings.catch_warnings ()
+        self._catcher.__enter__ ()
+        warnings.simplefilter ('error', np.ComplexWarning)
+
+
+    def __exit__ (self, etype, value, tb):
+        self._catcher.__exit__ (etype, value, tb)
+
+        if etype is not None and issubclass (etype, (TypeError, np.ComplexWarning)):
+            raise _complex_step_error (str (value))
+
+
+def _complex_step_error (detail):
+    return ValueError ('complex-step derivatives are enabled (see pSide), but '
+                       'yfunc does not seem to support complex parameters: '
+                       + detail)
+
+
+_nonimag_detail = ('it returned no imaginary parts (or none of the '
+                   'complex-step parameters affects it)')
+
+
+# Function-evaluation requests yielded by Problem._solve_steps. Each
+# request is a tuple (kind, params, out). Whoever services the request
+# must apply any parameter ties to 'params', in place, and then:
+#
+# _REQ_Y     - fill the nout-vector 'out' with the function value at 'params'
+# _REQ_YROWS - 'params' is k-by-npar; fill each row of the k-by-nout array
+#              'out' with the function value at that row of 'params'
+# _REQ_J     - fill the npar-by-nout array 'out' with the Jacobian at 'params'
+#
+# In chunked mode (see Problem.setFunc), the full function vector is
+# never stored, and instead:
+#
+# _REQ_NORM  - set out[0] to the norm of the function value at 'params'
+# _REQ_CJAC  - 'out' is a tuple (fjac, fvec, jinfo, rows, fc, jc). Fill
+#              in the n-by-n 'fjac' and n-vector 'fvec' with a compressed
+#              Jacobian and function value at 'params'; see
+#              Problem._chunked_jacobian.
+
+_REQ_Y = 0
+_REQ_YROWS = 1
+_REQ_J = 2
+_REQ_NORM = 3
+_REQ_CJAC = 4
+
+
+class SolveTrace (object):
+    """A record of the progress of one solve; see Problem.trace.
+
+There is one record per trial step of the Levenberg-Marquardt
+iteration, with the fields listed in 'fields':
+
+iter      - the iteration number
+accepted  - whether the step was accepted
+fnorm     - the norm of the function before the step
+fnorm1    - the norm of the function after the step
+delta     - the step bound, after being updated according to the step
+par       - the Levenberg-Marquardt parameter
+ratio     - the ratio of the actual to the predicted reduction
+pnorm     - the norm of the scaled step
+t_yfunc   - time spent evaluating the function for this step
+t_jac     - time spent computing the Jacobian for this step, if any
+t_qr      - time spent in the QR factorization for this step, if any
+t_lmsolve - time spent computing the step
+t_wall    - wall-clock time since the start of the solve
+
+Times are in seconds. The time of the initial and final function
+evaluations is only included in 'totals', which gives the total time
+spent in each category as well as in the whole solve ('wall')."""
+
+    fields = ('iter accepted fnorm fnorm1 delta par ratio pnorm t_yfunc '
+              't_jac t_qr t_lmsolve t_wall').split ()
+    _timenames = ('yfunc', 'jac', 'qr', 'lmsolve')
+
+    def __init__ (self, callback=None):
+        from time import time
+        self.clock = time
+        self.callback = callback
+        self.records = []
+        self.totals = dict ((n, 0.) for n in self._timenames + ('wall', ))
+        self._t0 = time ()
+        self._times = [0.] * len (self._timenames)
+
+
+    def _addtime (self, which, dt):
+        self._times[which] += dt
+
+
+    def _reqtime (self, kind, dt):
+        # Time spent servicing a request from Problem._solve_steps.
+        if kind == _REQ_Y or kind == _REQ_NORM:
+            self._times[0] += dt
+        else:
+            self._times[1] += dt
+
+
+    def _timed (self, func, which):
+        clock = self.clock
+
+        def timed (*args):
+            t0 = clock ()
+            result = func (*args)
+            self._times[which] += clock () - t0
+            return result
+
+        return timed
+
+
+    def _record (self, *values):
+        for i, n in enumerate (self._timenames):
+            self.totals[n] += self._times[i]
+
+        rec = ((int (values[0]), bool (values[1])) +
+               tuple (float (v) for v in values[2:]) +
+               tuple (self._times) + (self.clock () - self._t0, ))
+        self._times = [0.] * len (self._timenames)
+        self.records.append (rec)
+
+        if self.callback is not None:
+            self.callback (dict (zip (self.fields, rec)))
+
+
+    def _finish (self):
+        for i, n in enumerate (self._timenames):
+            self.totals[n] += self._times[i]
+        self._times = [0.] * len (self._timenames)
+        self.totals['wall'] = self.clock () - self._t0
+
+
+    def toRecArray (self):
+        """Return the records as a numpy record array."""
+        dtype = [(n, np.float) for n in self.fields]
+        dtype[0] = ('iter', np.int)
+        dtype[1] = ('accepted', np.bool)
+        return np.array (self.records, dtype=dtype).view (np.recarray)
+
+
+    def toJSON (self, **kwargs):
+        """Return the records and totals as a JSON string.
+
+The keyword arguments are passed to json.dumps()."""
+        import json
+        recs = [dict (zip (self.fields, r)) for r in self.records]
+        return json.dumps ({'records': recs, 'totals': self.totals}, **kwargs)
+
+
+def _pool_ycall (yfunc, batched, params, nout, dtype):
+    # Evaluate a yfunc on behalf of Problem._ycall_pool. This needs to
+    # be a module-level function so that it can be pickled to be sent
+    # to worker processes.
+
+    vec = np.empty (nout, dtype=dtype)
+
+    if batched:
+        yfunc (params[np.newaxis], vec[np.newaxis])
+    else:
+        yfunc (params, vec)
+
+    return vec
+
+
+def _latin_hypercube (npoints, lower, upper, rstate):
+    """Draw a Latin-hypercube sample of *npoints* points in a box.
+
+Along each axis, the range from *lower* to *upper* is divided into
+*npoints* equal intervals, and each interval is used by exactly one
+point, at a uniformly random position within it. *rstate* is a
+numpy.random.RandomState. Returns an npoints-by-ndim array."""
+
+    ndim = lower.size
+    u = np.empty ((npoints, ndim))
+
+    for i in xrange (ndim):
+        u[:,i] = rstate.permutation (npoints) + rstate.uniform (size=npoints)
+
+    return lower + u / npoints * (upper - lower)
+
+
+def _multistart_solve (prob, guess, dtype):
+    # One solve on behalf of Problem.solveMultiStart. Module-level so
+    # that it can be sent to worker processes. Numerical failures from
+    # bad starting points are expected, and just reported as None.
+
+    try:
+        return prob.solve (guess, dtype)
+    except RuntimeError:
+        return None
+
+
+def _service_solve (prob, initial_params, dtype, timeout, cancel):
+    # One solve on behalf of FitService. Module-level so that it can
+    # be sent to worker processes. The timeout and cancellation are
+    # checked before each function evaluation; 'cancel' is a
+    # threading.Event, or None if the solve runs in another process.
+
+    from time import time
+    from concurrent.futures import CancelledError, TimeoutError
+
+    deadline = None if timeout is None else time () + timeout
+
+    def checked (steps):
+        for req in steps:
+            if cancel is not None and cancel.is_set ():
+                raise CancelledError ()
+            if deadline is not None and time () > deadline:
+                raise TimeoutError ('fit did not finish within %g s' % timeout)
+            yield req
+
+    prob._fixupCheck (dtype)
+    soln = prob._new_solution ()
+    prob._drive (soln, checked (prob._solve_steps (soln, initial_params, dtype,
+                                                   prob._jfunc is not None)))
+    soln.nfev = prob._nfev
+    soln.njev = prob._njev
+    return soln
+
+
+def _complex_view (a):
+    # View a real array, whose last axis is contiguous and of even
+    # length, as complex, without copying.
+
+    return a.view (np.result_type (a.dtype, np.complex64))
+
+
+def _residual_data (yobs, errinv):
+    """Prepare data for Problem.setResidualFunc().
+
+Returns (yobs, errinv, iscomplex). If *yobs* is complex, the returned
+arrays are real, with the real and imaginary parts interleaved, so
+that the residuals can be computed and stored as a real vector of
+twice the length that the user's functions see as complex. A complex
+*errinv* gives the inverse errors of the real and imaginary parts
+separately; a real one applies to both."""
+
+    if anynotfinite (errinv):
+        raise ValueError ('some inverse errors are nonfinite')
+
+    if not np.iscomplexobj (yobs):
+        if np.iscomplexobj (errinv):
+            raise ValueError ('complex inverse errors require complex yobs')
+        return yobs, errinv, False
+
+    yobs = np.ascontiguousarray (yobs)
+    ryobs = yobs.view (yobs.real.dtype)
+
+    if np.iscomplexobj (errinv):
+        cerrinv = np.empty_like (yobs)
+        cerrinv[:] = errinv
+        errinv = cerrinv.view (ryobs.dtype)
+    elif np.ndim (errinv):
+        errinv = np.repeat (errinv, 2)
+
+    return ryobs, errinv, True
+
+
+class _ResidualYFunc (object):
+    # The function created by Problem.setResidualFunc(). This is a class
+    # rather than a closure so that it can be pickled (see
+    # Problem.executor). If 'cplx' is True, yobs and errinv are real
+    # views of complex data (see _residual_data) and yfunc is given a
+    # complex view of the residual vector to fill in.
+
+    def __init__ (self, yobs, errinv, yfunc, reckless, cplx=False):
+        self.yobs = yobs
+        self.errinv = errinv
+        self.yfunc = yfunc
+        self.reckless = reckless
+        self.cplx = cplx
+
+    def __call__ (self, pars, nresids, start=None):
+        from numpy import subtract, multiply
+
+        yobs, errinv = self.yobs, self.errinv
+        mvals = nresids
+
+        if self.cplx:
+            if nresids.dtype.kind == 'c':
+                raise ValueError ('complex-step derivatives cannot be used '
+                                  'with complex residuals')
+            mvals = _complex_view (nresids)
+
+        if start is None:
+            self.yfunc (pars, mvals) # model Y values => nresids
+        else:
+            # Chunked protocol: nresids covers outputs [start:start+k].
+            self.yfunc (pars, mvals, start // 2 if self.cplx else start)
+            yobs = yobs[start:start+nresids.size]
+            if np.ndim (errinv):
+                errinv = errinv[start:start+nresids.size]
+
+        if not self.reckless and anynotfinite (nresids):
+            raise RuntimeError ('function returned nonfinite values')
+        subtract (yobs, nresids, nresids) # abs. residuals => nresids
+        multiply (nresids, errinv, nresids)
+
+
+class _ResidualJFunc (object):
+    # The Jacobian counterpart of _ResidualYFunc.
+
+    def __init__ (self, errinv, jfunc, reckless, cplx=False):
+        self.errinv = errinv
+        self.jfunc = jfunc
+        self.reckless = reckless
+        self.cplx = cplx
+
+    def __call__ (self, pars, jac, start=None):
+        from numpy import multiply
+
+        errinv = self.errinv
+        mjac = _complex_view (jac) if self.cplx else jac
+
+        if start is None:
+            self.jfunc (pars, mjac)
+        else:
+            self.jfunc (pars, mjac, start // 2 if self.cplx else start)
+            if np.ndim (errinv):
+                errinv = errinv[start:start+jac.shape[1]]
+
+        if not self.reckless and anynotfinite (jac):
+            raise RuntimeError ('jacobian returned nonfinite values')
+        multiply (jac, -1, jac)
+        jac *= errinv # broadcasts how we want
 
 
 # The actual user interface to the problem-solving machinery:
@@ -1168,22 +1859,80 @@ class Solution (object):
     prob = None
     status = None
     niter = None
-    perror = None
     params = None
-    covar = None
     fnorm = None
     fvec = None
     fjac = None
     nfev = -1
     njev = -1
+    njfull = -1
+    njupdate = -1
+    nstarts = None # see Problem.solveMultiStart
+    trace = None # see Problem.trace
+
+    # State passed on to a warm-started solve (see Problem.solve):
+    # (delta, diag, jac), where jac may be None.
+    _warmstate = None
+
+    # The covariance matrix and parameter errors are only computed
+    # when first accessed. Until then, _covarstate holds what is
+    # needed to compute them: (r, pmut, ifree, npar), where r is a
+    # copy of the triangular factor and pmut its permutation, as
+    # passed to _calc_covariance().
+    _covar = None
+    _perror = None
+    _covarstate = None
 
     def __init__ (self, prob):
         self.prob = prob
 
 
+    def _detach (self):
+        # Copy fvec and fjac out of the solver's work arrays, when
+        # those are reused (see SolvePlan and Workspace).
+        if self.fvec is not None:
+            self.fvec = self.fvec.copy ()
+        self.fjac = self.fjac.copy ()
+
+
+    @property
+    def covar (self):
+        if self._covarstate is not None:
+            r, pmut, ifree, npar = self._covarstate
+            covar = np.zeros ((npar, npar), r.dtype)
+            covar[ifree[:,np.newaxis],ifree] = _calc_covariance (r, pmut)
+            self._covar = covar
+            self._covarstate = None
+        return self._covar
+
+    @covar.setter
+    def covar (self, value):
+        self._covar = value
+        self._covarstate = None
+
+
+    @property
+    def perror (self):
+        # Errors in parameters from the diagonal of covar.
+        if self._perror is None and self.covar is not None:
+            covar = self.covar
+            perror = np.zeros (covar.shape[0], covar.dtype)
+            d = covar.diagonal ()
+            wh = np.where (d >= 0)
+            perror[wh] = np.sqrt (d[wh])
+            self._perror = perror
+        return self._perror
+
+    @perror.setter
+    def perror (self, value):
+        self._perror = value
+
+
 class Problem (object):
     _yfunc = None
     _jfunc = None
+    _ybatched = False
+    _chunksize = None
     _npar = None
     _nout = None
 
@@ -1194,6 +1943,11 @@ class Problem (object):
     # These ones are set in _fixupCheck
     _ifree = None
     _anytied = None
+    _ties = None
+    _jgroups = None
+    _jlayout = None
+
+    _jsparsity = None
 
     # Public fields, settable by user at will
 
@@ -1209,11 +1963,47 @@ class Problem (object):
     maxiter = 200
     normfunc = None
 
+    # If positive, the Jacobian is not recomputed after every
+    # successful step: instead, the previous one is brought up to date
+    # with a Broyden rank-one update, for up to this many consecutive
+    # iterations. A full recomputation is forced whenever a step
+    # fails or makes poor progress, and before convergence is
+    # declared. Worthwhile when the function is expensive.
+    broyden = 0
+
+    # The linear-algebra backend: 'minpack' for the reference pure-Python
+    # implementation, or 'lapack' for one built on scipy's LAPACK
+    # wrappers, which is much faster when there are more than a handful
+    # of free parameters.
+    linalg = 'minpack'
+
     diag = None
 
     debugCalls = False
     debugJac = False
 
+    # If not None, a concurrent.futures-style executor (anything with a
+    # submit() method returning futures) used to evaluate the perturbed
+    # parameter vectors of automatic Jacobians concurrently. With a
+    # process pool, yfunc must be picklable: a module-level function, or
+    # an instance of a module-level class, whose closed-over data are
+    # picklable too. (The wrappers created by setResidualFunc() are
+    # picklable if the model function is.)
+    executor = None
+
+    # If not None, each solve records a SolveTrace in the 'trace' field
+    # of its Solution, with statistics on every step and the time spent
+    # in the various parts of the solver. If this is a callable
+    # rather than True, it is also called with a dict of the values of
+    # each record as it is made. When None, the cost is negligible.
+    trace = None
+
+    # If not None, a Workspace (see makeWorkspace()) whose arrays are
+    # reused by every solve() of this Problem, rather than allocated
+    # afresh. It is not copied by copy() or pickled, and must not be
+    # used by more than one solve at once.
+    workspace = None
+
 
     def __init__ (self, npar=None, nout=None, yfunc=None, jfunc=None,
                   solclass=Solution):
@@ -1317,22 +2107,40 @@ class Problem (object):
 
     def pSide (self, idx, sidedness):
         """Acceptable values for *sidedness* are "auto", "pos",
-        "neg", and "two"."""
+        "neg", "two", and "complex".
+
+        "complex" selects complex-step differentiation: the derivative
+        is computed as Im (f (x + ih)) / h with a tiny h, which is
+        accurate to machine precision and takes one call per
+        parameter. This requires that yfunc (and any tie functions)
+        accept complex parameters and compute their outputs with
+        complex arithmetic, so it is only suitable for models that
+        are analytic in these parameters: no abs(), comparisons,
+        or conversions to float. An error is raised if yfunc is
+        found not to support complex input."""
         dsideval = _dside_names.get (sidedness)
         if dsideval is None:
             raise ValueError ('unrecognized sidedness "%s"' % sidedness)
 
         p = self._pinfob
-        p[idx] = (p[idx] & ~PI_M_SIDE) | dsideval
+        p[idx] = (p[idx] & ~(PI_M_SIDE | PI_M_CSTEP)) | dsideval
         return self
 
 
-    def pTie (self, idx, tiefunc):
+    def pTie (self, idx, tiefunc, vectorized=False):
+        """Ties are applied in order of parameter index, so a tie
+        function may depend on the values of tied parameters with
+        lower indices. If *vectorized* is True, *tiefunc* is called
+        with a k-by-npar array of parameter vectors and must return
+        the k tied values; single vectors are passed as 1-by-npar
+        arrays. Batched, pooled and solveMany() evaluations then tie
+        all of their parameter vectors in one call."""
         t1 = np.atleast_1d (tiefunc)
         if not np.all ([x is None or callable (x) for x in t1]):
             raise ValueError ('tiefunc')
 
         self._pinfoo[PI_O_TIEFUNC,idx] = tiefunc
+        self._setBit (idx, PI_M_VECTIE, vectorized)
         return self
 
 
@@ -1374,6 +2182,37 @@ class Problem (object):
         self._anytied = np.any (tied)
         self._ifree = np.where (-(self._getBits (PI_M_FIXED) | tied))[0]
 
+        # The ties as applied by _apply_ties(): (index, function,
+        # vectorized) in order of index.
+
+        vectied = self._getBits (PI_M_VECTIE)
+        self._ties = [(i, self._pinfoo[PI_O_TIEFUNC,i], vectied[i])
+                      for i in np.where (tied)[0]]
+
+
+    def setJacSparsity (self, pattern):
+        """Declare which function outputs depend on which parameters.
+
+*pattern* is an npar-by-nout boolean array laid out like the
+Jacobian: pattern[i,j] should be True if output j can depend on
+parameter i, whether directly or through a tied parameter. Automatic
+derivatives then perturb structurally independent parameters together
+(see _cpr_groups), using one function evaluation per group of
+parameters rather than one per parameter, and entries outside of the
+pattern are set to exactly zero. Pass None to go back to assuming
+that every output depends on every parameter."""
+
+        if pattern is None:
+            self._jsparsity = None
+            return self
+
+        pattern = np.asarray (pattern, dtype=np.bool)
+        if pattern.ndim != 2:
+            raise ValueError ('pattern must be two-dimensional')
+
+        self._jsparsity = pattern
+        return self
+
 
     def getNFree (self):
         self._checkParamConfig ()
@@ -1382,7 +2221,29 @@ class Problem (object):
 
     # Now, the function and the constraint values
 
-    def setFunc (self, nout, yfunc, jfunc):
+    def setFunc (self, nout, yfunc, jfunc, batched=False, chunksize=None):
+        """If *batched* is True, *yfunc* follows the batched protocol: it
+        is called as yfunc (params, vecs) where params is a k-by-npar
+        array of parameter vectors and vecs is a k-by-nout array to be
+        filled with the function values at each of them. All of the
+        evaluations needed for an automatic Jacobian are then made in
+        one call. *jfunc* is unaffected.
+
+        If *chunksize* is not None, the problem is solved in chunked
+        mode, in which memory use scales with npar**2 and *chunksize*
+        rather than with *nout*. *yfunc* and *jfunc* are then called as
+        yfunc (params, vec, start) and jfunc (params, jac, start), and
+        should compute only outputs start through start + k - 1, where
+        vec has k <= chunksize elements and jac is npar-by-k. Rather
+        than storing the Jacobian, the solver accumulates the
+        triangular factor of its QR factorization, one chunk at a time.
+        The results agree with the unchunked ones to within rounding,
+        but every Jacobian costs one extra pass of function
+        evaluations, the 'fvec' of the Solution is None, and its 'fjac'
+        has one column per free parameter rather than per output, like
+        the compressed Jacobian it comes from. Chunked mode cannot
+        be combined with *batched*, the Problem's executor,
+        Broyden updates, solveMany(), or solve_scipy()."""
         try:
             nout = int (nout)
             assert nout > 0
@@ -1402,52 +2263,81 @@ class Problem (object):
                 raise ValueError ('jfunc')
             self._get_jacobian = self._get_jacobian_explicit
 
+        if chunksize is not None:
+            chunksize = int (chunksize)
+            if chunksize < 1:
+                raise ValueError ('chunksize')
+            if batched:
+                raise ValueError ('chunked mode cannot be combined with the '
+                                  'batched protocol')
+
         self._nout = nout
         self._yfunc = yfunc
         self._jfunc = jfunc
+        self._ybatched = bool (batched)
+        self._chunksize = chunksize
         self._nfev = 0
         self._njev = 0
         return self
 
 
-    def setResidualFunc (self, yobs, errinv, yfunc, jfunc, reckless=False):
-        from numpy import subtract, multiply
-
+    def setResidualFunc (self, yobs, errinv, yfunc, jfunc, reckless=False,
+                         batched=False, chunksize=None):
+        """If *yobs* is complex, the residuals are complex too: *yfunc*
+        fills in a complex vector of model values and *jfunc* a complex
+        npar-by-nout Jacobian, and *errinv* may be real, or complex to
+        give separate inverse errors for the real and imaginary parts.
+        The solver works on a real view of the residuals with the real
+        and imaginary parts interleaved, so nothing is copied, and the
+        'fvec' and 'fjac' of Solutions are such views; use
+        soln.fvec.view (complex) to recover the complex values. In
+        chunked mode, *chunksize* and the *start* passed to the
+        functions count complex outputs. Complex residuals cannot be
+        combined with complex-step derivatives (see pSide)."""
         self._checkParamConfig ()
         npar = self._npar
 
-        if anynotfinite (errinv):
-            raise ValueError ('some inverse errors are nonfinite')
+        # FIXME: handle yobs.ndim != 1
+        #
+        # Note that the wrappers work unchanged for the batched
+        # protocol, since yobs and errinv broadcast against a stack of
+        # model vectors.
 
-        # FIXME: handle yobs.ndim != 1 and/or yobs being complex
-
-        if reckless:
-            def ywrap (pars, nresids):
-                yfunc (pars, nresids) # model Y values => nresids
-                subtract (yobs, nresids, nresids) # abs. residuals => nresids
-                multiply (nresids, errinv, nresids)
-            def jwrap (pars, jac):
-                jfunc (pars, jac)
-                multiply (jac, -1, jac)
-                jac *= errinv # broadcasts how we want
-        else:
-            def ywrap (pars, nresids):
-                yfunc (pars, nresids)
-                if anynotfinite (nresids):
-                    raise RuntimeError ('function returned nonfinite values')
-                subtract (yobs, nresids, nresids)
-                multiply (nresids, errinv, nresids)
-            def jwrap (pars, jac):
-                jfunc (pars, jac)
-                if anynotfinite (jac):
-                    raise RuntimeError ('jacobian returned nonfinite values')
-                multiply (jac, -1, jac)
-                jac *= errinv
+        yobs, errinv, cplx = _residual_data (yobs, errinv)
+        ywrap = _ResidualYFunc (yobs, errinv, yfunc, reckless, cplx)
 
         if jfunc is None:
             jwrap = None
+        else:
+            jwrap = _ResidualJFunc (errinv, jfunc, reckless, cplx)
+
+        if cplx and chunksize is not None:
+            chunksize = 2 * int (chunksize)
 
-        return self.setFunc (yobs.size, ywrap, jwrap)
+        return self.setFunc (yobs.size, ywrap, jwrap, batched, chunksize)
+
+
+    def _setResidualData (self, yobs, errinv):
+        # Swap new data into the wrappers created by setResidualFunc(),
+        # without touching anything else.
+
+        if not isinstance (self._yfunc, _ResidualYFunc):
+            raise ValueError ('problem was not set up with setResidualFunc()')
+
+        ywrap = self._yfunc
+        yobs, errinv, cplx = _residual_data (yobs, errinv)
+
+        if cplx != ywrap.cplx:
+            raise ValueError ('cannot switch between real and complex data')
+        if yobs.size != self._nout:
+            raise ValueError ('expected %d observations, got %d'
+                              % (self._nout, yobs.size))
+
+        self._yfunc = _ResidualYFunc (yobs, errinv, ywrap.yfunc, ywrap.reckless, cplx)
+
+        if self._jfunc is not None:
+            jwrap = self._jfunc
+            self._jfunc = _ResidualJFunc (errinv, jwrap.jfunc, jwrap.reckless, cplx)
 
 
     def _fixupCheck (self, dtype):
@@ -1459,6 +2349,42 @@ class Problem (object):
         if self._nout < self._npar - self._ifree.size:
             raise RuntimeError ('too many free parameters')
 
+        # Lay out the perturbed parameter vectors of automatic
+        # Jacobians. Note that the sidedness is indexed by free
+        # parameter number here, not parameter number; this matches
+        # the historical behavior. (The complex-step flag, which is
+        # newer, is indexed properly.) Without a sparsity pattern, each
+        # parameter is in a group of its own. _jacobian_rows() puts the
+        # perturbations of real group i in row rowp[i], and for
+        # two-sided groups, the negative perturbations in the row after
+        # that. The perturbations of complex-step groups go in row
+        # rowp[i] of a separate, complex, array.
+
+        n = self._ifree.size
+        cplx = (self._pinfob[self._ifree] & PI_M_CSTEP) != 0
+        two = ((self._pinfob & PI_M_SIDE)[:n] == DSIDE_TWO) & ~cplx
+        kind = two + 2 * cplx
+
+        if self._jsparsity is None:
+            self._jgroups = None
+            groups = np.arange (n)
+            gkind = kind
+            spmask = None
+        else:
+            if self._jsparsity.shape != (self._npar, self._nout):
+                raise ValueError ('Jacobian sparsity pattern must have shape '
+                                  '(npar, nout) = (%d, %d)' % (self._npar, self._nout))
+
+            self._jgroups = groups = _cpr_groups (self._jsparsity[self._ifree], kind)
+            gkind = np.zeros (groups.max () + 1 if n else 0, dtype=np.int)
+            gkind[groups] = kind
+            spmask = self._jsparsity[self._ifree]
+
+        gcplx = gkind == 2
+        gnrows = (gkind == 0) + 2 * (gkind == 1)
+        growp = np.where (gcplx, np.cumsum (gcplx) - gcplx, np.cumsum (gnrows) - gnrows)
+        self._jlayout = (growp[groups], two, cplx, spmask, gnrows.sum (), gcplx.sum ())
+
         # Coerce parameters to desired types
 
         self.ftol = float (self.ftol)
@@ -1473,9 +2399,16 @@ class Problem (object):
             self.epsilon = float (self.epsilon)
 
         self.maxiter = int (self.maxiter)
+        self.broyden = int (self.broyden)
         self.debugCalls = bool (self.debugCalls)
         self.debugJac = bool (self.debugJac)
 
+        if self.executor is not None and not callable (getattr (self.executor, 'submit', None)):
+            raise ValueError ('executor must have a submit() method or be None')
+
+        if self.trace is not None and self.trace is not True and not callable (self.trace):
+            raise ValueError ('trace must be None, True, or a callable')
+
         if self.diag is not None:
             self.diag = np.atleast_1d (np.asarray (self.diag, dtype=np.float))
 
@@ -1489,6 +2422,9 @@ class Problem (object):
         elif not callable (self.normfunc):
             raise ValueError ('normfunc must be a callable or None')
 
+        if self.linalg not in _linalg_backends:
+            raise ValueError ('unrecognized linalg backend "%s"' % self.linalg)
+
         # Bounds and type checks
 
         if not issubclass (self.solclass, Solution):
@@ -1509,6 +2445,9 @@ class Problem (object):
         if self.maxiter < 1:
             raise ValueError ('maxiter')
 
+        if self.broyden < 0:
+            raise ValueError ('broyden')
+
         if self.factor <= 0.:
             raise ValueError ('factor')
 
@@ -1518,15 +2457,43 @@ class Problem (object):
             raise ValueError ('damping factor not allowed when using '
                               'explicit derivatives')
 
+        if self._chunksize is not None:
+            if self.broyden > 0:
+                raise ValueError ('Broyden updates not allowed in chunked mode')
+            if self.executor is not None:
+                raise ValueError ('executor not allowed in chunked mode')
+
 
     def getNDOF (self):
         self._fixupCheck (np.float) # dtype is irrelevant here
         return self._nout - self._ifree.size
 
 
+    def __getstate__ (self):
+        # Support pickling, for process pools. Bound methods and
+        # executors can't be pickled; _get_jacobian is recreated below.
+        state = self.__dict__.copy ()
+        state.pop ('_get_jacobian', None)
+        state.pop ('executor', None)
+        state.pop ('workspace', None)
+        return state
+
+
+    def __setstate__ (self, state):
+        self.__dict__.update (state)
+
+        if self._jfunc is None:
+            self._get_jacobian = self._get_jacobian_automatic
+        else:
+            self._get_jacobian = self._get_jacobian_explicit
+
+
     def copy (self):
         n = Problem (self._npar, self._nout, self._yfunc, self._jfunc,
                      self.solclass)
+        n._ybatched = self._ybatched
+        n._chunksize = self._chunksize
+        n._jsparsity = self._jsparsity
 
         if self._pinfof is not None:
             n._pinfof = self._pinfof.copy ()
@@ -1543,14 +2510,26 @@ class Problem (object):
         n.factor = self.factor
         n.epsilon = self.epsilon
         n.maxiter = self.maxiter
+        n.broyden = self.broyden
         n.normfunc = self.normfunc
+        n.linalg = self.linalg
         n.debugCalls = self.debugCalls
         n.debugJac = self.debugJac
+        n.executor = self.executor
+        n.trace = self.trace
 
         return n
 
 
     # Actual implementation code!
+    #
+    # The core of the algorithm lives in _solve_steps(), a generator that
+    # yields requests for function evaluations rather than performing
+    # them itself. See the comments above the _REQ_* constants for the
+    # protocol. solve() services the requests one at a time using the
+    # user's yfunc and jfunc; solveMany() runs one generator per problem
+    # in lockstep and services all of the outstanding requests in a single
+    # call to a vectorized function.
 
     def _ycall (self, params, vec):
         if self._anytied:
@@ -1560,7 +2539,10 @@ class Problem (object):
 
         if self.debugCalls:
             print 'Call: #%4d f(%s) ->' % (self._nfev, params),
-        self._yfunc (params, vec)
+        if self._ybatched:
+            self._yfunc (params[np.newaxis], vec[np.newaxis])
+        else:
+            self._yfunc (params, vec)
         if self.debugCalls:
             print vec
 
@@ -1568,14 +2550,689 @@ class Problem (object):
             np.tanh (vec / self.damp, vec)
 
 
-    def solve (self, initial_params=None, dtype=np.float):
-        from numpy import any, clip, dot, isfinite, sqrt, where
+    def _jcall (self, params, jac):
+        self._njev += 1
+
+        if self.debugCalls:
+            print 'Call: #%4d j(%s) ->' % (self._njev, params),
+        self._jfunc (params, jac)
+        if self.debugCalls:
+            print jac
+
+
+    def _serve (self, req):
+        kind, params, out = req
+
+        if kind == _REQ_Y:
+            self._ycall (params, out)
+        elif kind == _REQ_J:
+            self._jcall (params, out)
+        elif kind == _REQ_NORM:
+            out[0] = self._chunked_norm (params)
+        elif kind == _REQ_CJAC:
+            if out[2] is not None and out[3][2].shape[0]:
+                with _complex_step_guard ():
+                    self._chunked_jacobian (params, *out)
+            else:
+                self._chunked_jacobian (params, *out)
+        elif params.dtype.kind == 'c':
+            with _complex_step_guard ():
+                self._serve_rows (params, out)
+        else:
+            self._serve_rows (params, out)
+
+
+    def _serve_rows (self, params, out):
+        if self.executor is not None:
+            self._ycall_pool (params, out)
+        elif not self._ybatched:
+            for i in xrange (params.shape[0]):
+                self._ycall (params[i], out[i])
+        elif params.shape[0]:
+            self._ycall_rows (params, out)
+
+
+    def _chunked_norm (self, params):
+        # Compute the norm of the function value at params in chunked
+        # mode, without storing the whole function vector.
+
+        if self._anytied:
+            self._apply_ties (params)
+
+        self._nfev += 1
+
+        if self.debugCalls:
+            print 'Call: #%4d f(%s) (chunked)' % (self._nfev, params)
+
+        finfo = np.finfo (params.dtype)
+        vec = np.empty (min (self._chunksize, self._nout), dtype=params.dtype)
+        sumsq = 0.
+
+        for start in xrange (0, self._nout, self._chunksize):
+            fc = vec[:min (self._chunksize, self._nout - start)]
+            self._yfunc (params, fc, start)
+            if self.damp > 0:
+                np.tanh (fc / self.damp, fc)
+            sumsq += self.normfunc (fc, finfo)**2
+
+        return np.sqrt (sumsq)
+
+
+    def _chunked_jacobian (self, params, fjac, fvec, jinfo, rows, fc, jc):
+        """Compute a compressed Jacobian and function value in chunked mode.
+
+Say that the function value at *params* is f and that its Jacobian,
+restricted to the n free parameters, is J, in the usual (nout-by-n)
+orientation. Factor the augmented nout-by-(n+1) matrix [J f] as Q R,
+with Q orthogonal and R upper triangular. Then this sets *fjac* to the
+transpose of the top left n-by-n block of R, and *fvec* to the first
+n elements of its last column. J^T J = fjac fjac^T and J^T f = fjac
+fvec, so the Levenberg-Marquardt step, the predicted reduction, and
+the gradient test all come out as they would with J and f, while only
+the (n+1)-by-(n+1) factor R is ever stored. R is accumulated one chunk
+of outputs at a time.
+
+If *jinfo* is None, the Jacobian is computed with jfunc; otherwise
+automatically, with *jinfo* and *rows* from _jacobian_rows().
+*fc* and *jc* are work arrays of chunksize and npar-by-chunksize
+elements."""
+
+        if jinfo is not None:
+            xps, fps, cxps, cfps = rows
+            anyimag = False
+
+        if self._anytied:
+            self._apply_ties (params)
+            if jinfo is not None:
+                self._apply_ties_rows (xps)
+                self._apply_ties_rows (cxps)
+
+        ifree = self._ifree
+        n = ifree.size
+        chunk = fc.size
+        raug = np.zeros ((n + 1, n + 1), dtype=fjac.dtype)
+        stack = np.empty ((n + 1 + chunk, n + 1), dtype=fjac.dtype)
+
+        for start in xrange (0, self._nout, chunk):
+            k = min (chunk, self._nout - start)
+            f = fc[:k]
+            # Keep the chunk of the Jacobian contiguous; see _complex_view.
+            j = jc.reshape (-1)[:jc.shape[0]*k].reshape ((jc.shape[0], k))
+
+            self._yfunc (params, f, start)
+            if self.damp > 0:
+                np.tanh (f / self.damp, f)
+
+            if jinfo is None:
+                self._jfunc (params, j, start)
+                j[:n] = j[ifree]
+            else:
+                h, rowp, two, cplx, spmask = jinfo
+                fp = fps[:,:k]
+                cfp = cfps[:,:k]
+
+                for i in xrange (xps.shape[0]):
+                    self._yfunc (xps[i], fp[i], start)
+                for i in xrange (cxps.shape[0]):
+                    self._yfunc (cxps[i], cfp[i], start)
+                if self.damp > 0:
+                    np.tanh (fp / self.damp, fp)
+                    np.tanh (cfp / self.damp, cfp)
+                if spmask is not None:
+                    spmask = spmask[:,start:start+k]
+
+                # Individual chunks may legitimately have no imaginary
+                # parts, so check them all together below.
+                anyimag = anyimag or np.any (cfp.imag)
+                self._jacobian_from_rows (f, (fp, fp, cfp, cfp),
+                                          (h, rowp, two, cplx, spmask), j, False)
+
+            stack[:n+1] = raug
+            stack[n+1:n+1+k,:n] = j[:n].T
+            stack[n+1:n+1+k,n] = f
+            raug = np.linalg.qr (stack[:n+1+k], mode='r')
+
+        self._nfev += 1
+        if jinfo is None:
+            self._njev += 1
+        else:
+            self._nfev += xps.shape[0] + cxps.shape[0]
+            if cxps.shape[0] and not anyimag:
+                raise _complex_step_error (_nonimag_detail)
+
+        fjac[:] = raug[:n,:n].T
+        fvec[:] = raug[:n,n]
+
+        if self.debugJac:
+            for i in xrange (n):
+                print 'Jac :', fjac[i]
+
+
+    def _ycall_rows (self, params, vecs):
+        # Evaluate a batched yfunc on all of the rows of params at once.
+
+        if self._anytied:
+            self._apply_ties_rows (params)
+
+        self._nfev += params.shape[0]
+
+        if self.debugCalls:
+            print 'Call: #%4d-%d f(%s) ->' % (self._nfev - params.shape[0] + 1,
+                                              self._nfev, params),
+        self._yfunc (params, vecs)
+        if self.debugCalls:
+            print vecs
+
+        if self.damp > 0:
+            np.tanh (vecs / self.damp, vecs)
+
+
+    def _ycall_pool (self, params, vecs):
+        # Evaluate yfunc on the rows of params concurrently using
+        # self.executor. Ties, damping and call counting are handled
+        # here, in the calling process, so that the results are the
+        # same as those of the serial path.
+
+        if self._anytied:
+            self._apply_ties_rows (params)
+
+        futures = [self.executor.submit (_pool_ycall, self._yfunc, self._ybatched,
+                                         row, self._nout, vecs.dtype)
+                   for row in params]
+
+        try:
+            for i in xrange (len (futures)):
+                vecs[i] = futures[i].result ()
+                self._nfev += 1
+
+                if self.debugCalls:
+                    print 'Call: #%4d f(%s) ->' % (self._nfev, params[i]), vecs[i]
+        except:
+            for f in futures:
+                f.cancel ()
+            raise
+
+        if self.damp > 0:
+            np.tanh (vecs / self.damp, vecs)
+
+
+    def solve (self, initial_params=None, dtype=np.float, warm=None,
+               warmjac=False):
+        """If *warm* is a Solution from an earlier solve of a problem with
+        the same parameter configuration, the iteration is continued from
+        it: its parameters are the default starting point, and its
+        diagonal scaling and trust-region size are carried over rather
+        than being derived afresh. If *warmjac* is True, its final
+        Jacobian is also used as the initial one, if it kept it, and this
+        solve keeps its own for the same purpose. A reused Jacobian is
+        treated like a Broyden update (see Problem.broyden): it is
+        recomputed in full before convergence is declared. See also
+        solveSequence()."""
+
+        self._fixupCheck (dtype)
+        return self._solve_warm (initial_params, dtype, warm, warmjac)
+
+
+    def _solve_warm (self, initial_params, dtype, warm, warmjac):
+        work = None
+        if self.workspace is not None:
+            work = self.workspace._arrays_for (self, dtype)
+
+        soln = self._new_solution ()
+        self._drive (soln, self._solve_steps (soln, initial_params, dtype,
+                                              self._jfunc is not None, warm,
+                                              warmjac, work=work))
+        soln.nfev = self._nfev
+        soln.njev = self._njev
+        if work is not None:
+            soln._detach ()
+        return soln
+
+
+    def makeWorkspace (self, dtype=np.float):
+        """Return a Workspace for solving this problem with *dtype*.
+
+Assign the result to the 'workspace' field to have solve() reuse it."""
+        return Workspace (self, dtype)
+
+
+    def _workspace_key (self, dtype):
+        # Everything that determines the shapes and types of the work
+        # arrays of _solve_work(). _fixupCheck() must have been called.
+        return (self._npar, self._nout, np.dtype (dtype), self._jfunc is not None,
+                self._chunksize, self._jlayout[4], self._jlayout[5])
+
+
+    def _new_solution (self):
+        soln = self.solclass (self)
+
+        if self.trace is not None:
+            soln.trace = SolveTrace (None if self.trace is True else self.trace)
+
+        return soln
+
+
+    def _drive (self, soln, steps):
+        # Service all of the requests of a _solve_steps generator.
+
+        trace = soln.trace
+
+        if trace is None:
+            for req in steps:
+                self._serve (req)
+        else:
+            clock = trace.clock
+
+            for req in steps:
+                t0 = clock ()
+                self._serve (req)
+                trace._reqtime (req[0], clock () - t0)
+
+            trace._finish ()
+
+
+    def solveSequence (self, datasets, initial_params=None, dtype=np.float,
+                       warmjac=False):
+        """Solve a residual problem for a sequence of datasets.
+
+Parameters:
+datasets       - An iterable of (yobs, errinv) pairs.
+initial_params - The starting point for the first dataset, as in solve().
+dtype          - The data type to use for computations.
+warmjac        - Whether to carry Jacobians from one solve to the next.
+
+Returns: a generator yielding one Solution per dataset.
+
+This Problem must have been set up with setResidualFunc() (or be a
+ResidualProblem), and each dataset replaces its yobs and errinv in
+turn, so that after the sequence is finished, the Problem is left set
+up with the final one. Each dataset is solved with the previous
+Solution as a warm start (see solve()), and the problem configuration
+is only checked once, so the sequence is cheaper than a series of
+independent calls to solve() when consecutive datasets are similar.
+The 'nfev' and 'njev' fields of each Solution count the evaluations
+made for its dataset alone."""
+
+        if not isinstance (self._yfunc, _ResidualYFunc):
+            raise ValueError ('solveSequence() requires a problem set up '
+                              'with setResidualFunc()')
+
+        self._fixupCheck (dtype)
+        soln = None
+
+        for yobs, errinv in datasets:
+            self._setResidualData (yobs, errinv)
+            self._nfev = 0
+            self._njev = 0
+            soln = self._solve_warm (initial_params, dtype, soln, warmjac)
+            initial_params = None
+            yield soln
+
+
+    def solveMultiStart (self, nstart, executor=None, target_fnorm=None,
+                         seed=None, dedup_tol=1e-6, dtype=np.float):
+        """Search for the global minimum by solving from many starting points.
+
+Parameters:
+nstart       - The number of starting points.
+executor     - A concurrent.futures executor to run the solves on, or None
+               to run them here, one after another.
+target_fnorm - If not None, stop as soon as a solution with an fnorm at
+               most this large is found.
+seed         - The seed of the random numbers used to draw the starting
+               points.
+dedup_tol    - The tolerance for considering two solutions to be the same,
+               relative to the limits of each parameter.
+dtype        - The data type to use for computations.
+
+Returns: a list of distinct Solutions, best (lowest fnorm) first.
+
+The starting points are drawn from a Latin hypercube spanning the
+limits of the free parameters, which must all be finite (see
+pLimit()). Fixed parameters keep their values. Solves that fail with a
+RuntimeError, such as when the function returns nonfinite values, are
+skipped. Solutions whose free parameters all agree to within
+*dedup_tol* times the span of their limits are counted as one, the
+best of them being kept, and the 'nstarts' field of each returned
+Solution gives the number of starting points that led to it.
+
+Each solve uses its own copy of this Problem, so a thread pool can be
+used as the executor. With a process pool, the copies must be
+picklable; see the discussion of Problem.executor. When the target is
+reached, pending solves are cancelled, but ones that are already
+running are not waited for."""
+
+        from numpy import isfinite
+
+        self._fixupCheck (dtype)
+        nstart = int (nstart)
+        if nstart < 1:
+            raise ValueError ('nstart')
+
+        ifree = self._ifree
+        lower = self._pinfof[PI_F_LLIMIT,ifree]
+        upper = self._pinfof[PI_F_ULIMIT,ifree]
+
+        if not (isfinite (lower).all () and isfinite (upper).all ()):
+            raise ValueError ('all free parameters must have finite limits '
+                              'to draw starting points')
+
+        guesses = np.empty ((nstart, self._npar), dtype=dtype)
+        guesses[:] = self._pinfof[PI_F_VALUE]
+        guesses[:,ifree] = _latin_hypercube (nstart, lower, upper,
+                                             np.random.RandomState (seed))
+
+        results = []
+
+        def reached (soln):
+            return (soln is not None and target_fnorm is not None and
+                    soln.fnorm <= target_fnorm)
+
+        if executor is None:
+            for i in xrange (nstart):
+                soln = _multistart_solve (self.copy (), guesses[i], dtype)
+                results.append ((i, soln))
+                if reached (soln):
+                    break
+        else:
+            from concurrent.futures import wait, FIRST_COMPLETED
+
+            futures = dict ((executor.submit (_multistart_solve, self.copy (),
+                                              guesses[i], dtype), i)
+                            for i in xrange (nstart))
+            pending = set (futures)
+
+            try:
+                while len (pending):
+                    done, pending = wait (pending, return_when=FIRST_COMPLETED)
+                    for f in done:
+                        results.append ((futures[f], f.result ()))
+                    if any (reached (r[1]) for r in results):
+                        break
+            finally:
+                for f in pending:
+                    f.cancel ()
+
+        # Rank, then merge duplicates into the best of them. Ties in
+        # fnorm are broken by the order of the starting points, so that
+        # the answer doesn't depend on the order of completion.
+
+        results = sorted ((r for r in results if r[1] is not None),
+                          key=lambda r: (r[1].fnorm, r[0]))
+        tol = dedup_tol * (upper - lower)
+        distinct = []
+
+        for i, soln in results:
+            soln.prob = self
+
+            for d in distinct:
+                if np.all (np.abs (soln.params[ifree] - d.params[ifree]) <= tol):
+                    d.nstarts += 1
+                    break
+            else:
+                soln.nstarts = 1
+                distinct.append (soln)
+
+        return distinct
+
+
+    def freeze (self, dtype=np.float):
+        """Return a SolvePlan for repeated solves of this problem.
+
+The plan works on a copy of this Problem, so that later changes to
+this one do not affect it. The configuration is checked and the setup
+and work arrays of the solver are prepared once, up front, rather
+than on every solve."""
+        return SolvePlan (self.copy (), dtype)
+
+
+    def solveMany (self, initial_params, vyfunc=None, vjfunc=None, dtype=np.float):
+        """Solve many instances of this problem simultaneously.
+
+Parameters:
+initial_params - An nprob-by-npar array of initial parameter values,
+                 one row per problem.
+vyfunc         - A vectorized function vyfunc (iprob, params, vecs), or
+                 None to use this Problem's yfunc, which must then follow
+                 the batched protocol (see setFunc()).
+vjfunc         - A vectorized Jacobian function vjfunc (iprob, params, jacs),
+                 or None to compute derivatives automatically.
+dtype          - The data type to use for computations.
+
+Returns: a list of nprob Solution objects.
+
+All of the problems share this Problem's parameter configuration
+(limits, ties, steps, tolerances, etc.) and its nout, which must be
+set with setFunc() or setResidualFunc(). The iterations of every
+problem proceed together: at each round, all of the function
+evaluations needed by all of the unconverged problems are computed in
+one call to vyfunc. In that call, 'params' is a k-by-npar array of
+parameter vectors, 'vecs' is a k-by-nout array to be filled with the
+function outputs, and 'iprob' is a k-vector of integers giving the
+index of the problem (the row of 'initial_params') that each row of
+'params' belongs to. The model may therefore use different data for
+each problem. Likewise, vjfunc should fill the k-by-npar-by-nout array
+'jacs' with the Jacobians at each row of 'params'.
+
+Each problem keeps its own trust-region state and convergence test, so
+if vyfunc returns the same values as the yfunc used by solve(), the
+returned Solutions are identical to those that solve() gives for each
+row of initial_params. The 'nfev' and 'njev' fields of each Solution
+count the evaluations made for that problem alone."""
 
         self._fixupCheck (dtype)
+
+        if self._chunksize is not None:
+            raise ValueError ('solveMany() cannot be used in chunked mode')
+
+        if vyfunc is None:
+            if not self._ybatched:
+                raise ValueError ('vyfunc must be given unless yfunc is batched')
+            yfunc = self._yfunc
+            vyfunc = lambda iprob, params, vecs: yfunc (params, vecs)
+        elif not callable (vyfunc):
+            raise ValueError ('vyfunc')
+        if vjfunc is not None:
+            if not callable (vjfunc):
+                raise ValueError ('vjfunc')
+            if self.damp > 0:
+                raise ValueError ('damping factor not allowed when using '
+                                  'explicit derivatives')
+
+        initial_params = np.atleast_2d (np.asarray (initial_params, dtype=dtype))
+        nprob = initial_params.shape[0]
+
+        if initial_params.shape[1] != self._npar:
+            raise ValueError ('expected exactly %d parameters per problem, got %d'
+                              % (self._npar, initial_params.shape[1]))
+
+        solns = [self._new_solution () for i in xrange (nprob)]
+        steps = [self._solve_steps (solns[i], initial_params[i], dtype,
+                                    vjfunc is not None)
+                 for i in xrange (nprob)]
+        nfev = np.zeros (nprob, dtype=np.int)
+        njev = np.zeros (nprob, dtype=np.int)
+        active = range (nprob)
+
+        while len (active):
+            yreqs = []
+            cyreqs = []
+            jreqs = []
+            stillactive = []
+
+            for i in active:
+                try:
+                    kind, params, out = steps[i].next ()
+                except StopIteration:
+                    continue
+
+                stillactive.append (i)
+
+                if kind == _REQ_Y:
+                    yreqs.append ((i, params[np.newaxis], out[np.newaxis]))
+                elif kind == _REQ_YROWS and params.dtype.kind == 'c':
+                    cyreqs.append ((i, params, out)) # complex-step rows
+                elif kind == _REQ_YROWS:
+                    yreqs.append ((i, params, out))
+                else:
+                    jreqs.append ((i, params[np.newaxis], out[np.newaxis]))
+
+            active = stillactive
+
+            if len (yreqs):
+                self._serve_many (yreqs, vyfunc, nfev, True, solns)
+            if len (cyreqs):
+                with _complex_step_guard ():
+                    self._serve_many (cyreqs, vyfunc, nfev, True, solns)
+            if len (jreqs):
+                self._serve_many (jreqs, vjfunc, njev, False, solns)
+
+        for i in xrange (nprob):
+            solns[i].nfev = nfev[i]
+            solns[i].njev = njev[i]
+            if solns[i].trace is not None:
+                solns[i].trace._finish ()
+
+        return solns
+
+
+    def _serve_many (self, reqs, vfunc, counts, isy, solns):
+        # Service a group of requests from solveMany() with a single call
+        # to a vectorized function. Each item of 'reqs' is a tuple (iprob,
+        # params, out) where 'params' is 2D and 'out' has the matching
+        # number of rows. Tied parameter values are written back into
+        # each 'params', as _ycall() does. If tracing, the time of the
+        # call is attributed to all of the problems involved.
+
+        iprob = np.concatenate ([np.repeat (i, p.shape[0]) for i, p, o in reqs])
+        allparams = np.concatenate ([p for i, p, o in reqs])
+
+        if self._anytied:
+            self._apply_ties_rows (allparams)
+
+        out0 = reqs[0][2]
+        allout = np.empty ((iprob.size, ) + out0.shape[1:], dtype=out0.dtype)
+        trace = solns[reqs[0][0]].trace
+
+        if trace is None:
+            vfunc (iprob, allparams, allout)
+        else:
+            t0 = trace.clock ()
+            vfunc (iprob, allparams, allout)
+            dt = trace.clock () - t0
+
+            for i, params, out in reqs:
+                solns[i].trace._reqtime (_REQ_Y if isy else _REQ_J, dt)
+
+        if isy and self.damp > 0:
+            np.tanh (allout / self.damp, allout)
+
+        ofs = 0
+
+        for i, params, out in reqs:
+            k = params.shape[0]
+            params[:] = allparams[ofs:ofs+k]
+            out[:] = allout[ofs:ofs+k]
+            counts[i] += k
+            ofs += k
+
+
+    def _solve_setup (self):
+        # The parts of the setup of _solve_steps() that depend only on
+        # the problem configuration. _fixupCheck() must have been called
+        # already.
+
+        from numpy import any, isfinite, where
+
+        ifree = self._ifree
+
+        wfixed = where (self._pinfob & PI_M_FIXED)
+
+        # Steps for numerical derivatives
+        isrel = self._getBits (PI_M_RELSTEP)
+        dside = self._pinfob & PI_M_SIDE
+        maxstep = self._pinfof[PI_F_MAXSTEP,ifree]
+        whmaxstep = where (isfinite (maxstep))
+        anymaxsteps = whmaxstep[0].size > 0
+
+        # Which parameters have limits?
+
+        hasulim = isfinite (self._pinfof[PI_F_ULIMIT,ifree])
+        ulim = self._pinfof[PI_F_ULIMIT,ifree]
+        hasllim = isfinite (self._pinfof[PI_F_LLIMIT,ifree])
+        llim = self._pinfof[PI_F_LLIMIT,ifree]
+        anylimits = any (hasulim) or any (hasllim)
+
+        return (wfixed, isrel, dside, maxstep, whmaxstep, anymaxsteps,
+                hasulim, ulim, hasllim, llim, anylimits)
+
+
+    def _solve_work (self, dtype, explicitjac):
+        # Allocate the large work arrays used by _solve_steps(): two
+        # function vectors, the Jacobian, and for automatic
+        # derivatives, the perturbed parameter vectors and their
+        # function values. In chunked mode, the function vectors and
+        # Jacobian are the compressed ones (see _chunked_jacobian), the
+        # function values of the perturbed vectors are only computed a
+        # chunk at a time, and we add work arrays for the chunks.
+
+        if self._chunksize is None:
+            m = self._nout
+            fullfjac = np.zeros ((self._npar, m), dtype)
+            cwork = None
+        else:
+            m = self._ifree.size
+            fullfjac = np.zeros ((m, m), dtype)
+            chunk = min (self._chunksize, self._nout)
+            cwork = (np.empty (chunk, dtype=dtype),
+                     np.empty ((self._npar, chunk), dtype=dtype))
+
+        fvecs = (np.ndarray (m, dtype), np.ndarray (m, dtype))
+
+        if explicitjac:
+            rows = None
+        else:
+            rows = _jacobian_work (self._jlayout[4], self._jlayout[5], self._npar,
+                                   fullfjac.shape[1] if cwork is None
+                                   else cwork[0].size, dtype)
+
+        return fvecs, fullfjac, rows, cwork
+
+
+    def _solve_steps (self, soln, initial_params, dtype, explicitjac,
+                      warm=None, warmjac=False, setup=None, work=None):
+        # The implementation of solve(). _fixupCheck() must have been
+        # called already. The results are stored in 'soln', except
+        # for nfev and njev, which the caller fills in. 'setup' and
+        # 'work' are the results of _solve_setup() and _solve_work(),
+        # which are computed here if not given; with 'work', the
+        # returned fvec and fjac are views of its arrays.
+
+        from numpy import any, clip, dot, sqrt, where
+
+        if setup is None:
+            setup = self._solve_setup ()
+
+        (wfixed, isrel, dside, maxstep, whmaxstep, anymaxsteps,
+         hasulim, ulim, hasllim, llim, anylimits) = setup
+
         ifree = self._ifree
-        ycall = self._ycall
         n = ifree.size # number of free params; we try to allow n = 0
 
+        if warm is None or warm._warmstate is None:
+            wdelta = wdiag = wjac = None
+        else:
+            wdelta, wdiag, wjac = warm._warmstate
+
+            if wdiag.size != n:
+                raise ValueError ('warm-start solution has %d free parameters, '
+                                  'expected %d' % (wdiag.size, n))
+            if not warmjac or (wjac is not None and wjac.shape[1] != self._nout):
+                wjac = None
+
+            if initial_params is None:
+                initial_params = warm.params
+
         # Set up initial values. These can either be specified via the
         # arguments to this function, or set implicitly with calls to
         # pValue() and pLimit (). Former overrides the latter. (The
@@ -1595,8 +3252,7 @@ class Problem (object):
                               % (self._npar, initial_params.size))
 
         initial_params = initial_params.copy () # make sure not to modify arg
-        w = where (self._pinfob & PI_M_FIXED)
-        initial_params[w] = self._pinfof[PI_F_VALUE,w]
+        initial_params[wfixed] = self._pinfof[PI_F_VALUE,wfixed]
 
         if anynotfinite (initial_params):
             raise ValueError ('some nonfinite initial parameter values')
@@ -1606,30 +3262,33 @@ class Problem (object):
         params = initial_params.copy ()
         x = params[ifree] # x is the free subset of our parameters
 
-        # Steps for numerical derivatives
-        isrel = self._getBits (PI_M_RELSTEP)
-        dside = self._pinfob & PI_M_SIDE
-        maxstep = self._pinfof[PI_F_MAXSTEP,ifree]
-        whmaxstep = where (isfinite (maxstep))
-        anymaxsteps = whmaxstep[0].size > 0
-
-        # Which parameters have limits?
+        if work is None or work[1].dtype != dtype:
+            work = self._solve_work (dtype, explicitjac)
+        else:
+            work[1].fill (0)
 
-        hasulim = isfinite (self._pinfof[PI_F_ULIMIT,ifree])
-        ulim = self._pinfof[PI_F_ULIMIT,ifree]
-        hasllim = isfinite (self._pinfof[PI_F_LLIMIT,ifree])
-        llim = self._pinfof[PI_F_LLIMIT,ifree]
-        anylimits = any (hasulim) or any (hasllim)
+        (fvec, spare), fullfjac, rows, cwork = work
+        chunked = cwork is not None
+        nbuf = np.empty (1)
 
         # Init fnorm
 
         enorm = self.normfunc
+        qr_factor_packed, lm_solve = _linalg_backends[self.linalg]
+        trace = soln.trace
+
+        if trace is not None:
+            qr_factor_packed = trace._timed (qr_factor_packed, 2)
+            lm_solve = trace._timed (lm_solve, 3)
         fnorm1 = -1.
-        fvec = np.ndarray (self._nout, dtype)
-        fullfjac = np.zeros ((self._npar, self._nout), finfo.dtype)
         fjac = fullfjac[:n]
-        ycall (params, fvec)
-        fnorm = enorm (fvec, finfo)
+
+        if chunked:
+            yield (_REQ_NORM, params, nbuf)
+            fnorm = nbuf[0]
+        else:
+            yield (_REQ_Y, params, fvec)
+            fnorm = enorm (fvec, finfo)
 
         # Initialize Levenberg-Marquardt parameter and
         # iteration counter.
@@ -1639,6 +3298,28 @@ class Problem (object):
         fqt = x * 0.
         status = set ()
 
+        # Broyden-update state: the unfactored Jacobian, the number of
+        # consecutive updates applied to it, whether the next one must
+        # be computed in full, and the step to update it with. A
+        # Jacobian from a warm start is used as if it were an update.
+
+        keepjac = self.broyden > 0 or warmjac
+        jprev = None
+        nupdates = 0
+        needfull = True
+        bstep = None
+        soln.njfull = soln.njupdate = 0
+
+        if wjac is not None:
+            jprev = wjac.copy ()
+            needfull = False
+
+        # The largest trust region reached after a successful step,
+        # passed on to warm starts. (The final trust region is not
+        # useful for that since it shrinks as the iteration converges.)
+
+        maxdelta = wdelta or 0.
+
         # Outer loop top.
 
         while True:
@@ -1647,7 +3328,39 @@ class Problem (object):
             if self._anytied:
                 self._apply_ties (params)
 
-            self._get_jacobian (params, fvec, fullfjac, ulim, dside, maxstep, isrel, finfo)
+            if not needfull:
+                if bstep is not None:
+                    # "Good" Broyden update, transposed: J += (df - J s) s^T / s^T s
+                    jprev += np.outer (bstep, bdf - dot (bstep, jprev)) / dot (bstep, bstep)
+                    bstep = None
+                fjac[:] = jprev
+                nupdates += 1
+                soln.njupdate += 1
+            else:
+                if chunked:
+                    jinfo = None
+                    if not explicitjac:
+                        jinfo, rows = self._jacobian_rows (params, ulim, dside, maxstep,
+                                                           isrel, finfo, rows)
+                    yield (_REQ_CJAC, params, (fjac, fvec, jinfo, rows) + cwork)
+                elif explicitjac:
+                    yield (_REQ_J, params, fullfjac)
+                    self._condense_jacobian (fullfjac)
+                else:
+                    jinfo, rows = self._jacobian_rows (params, ulim, dside, maxstep,
+                                                       isrel, finfo, rows)
+                    yield (_REQ_YROWS, rows[0], rows[1])
+                    if rows[2].shape[0]:
+                        yield (_REQ_YROWS, rows[2], rows[3])
+                    self._jacobian_from_rows (fvec, rows, jinfo, fullfjac)
+
+                nupdates = 0
+                soln.njfull += 1
+
+                if keepjac:
+                    jprev = fjac.copy ()
+
+            needfull = nupdates >= self.broyden
 
             if anylimits:
                 # Check for parameters pegged at limits
@@ -1670,26 +3383,34 @@ class Problem (object):
             # wa1: "rdiag", diagonal part of R matrix, pivoting applied
             # wa2: "acnorm", unpermuted row norms of fjac
             # fjac: overwritten with Q and R matrix info, pivoted
-            pmut, wa1, wa2 = _qr_factor_packed (fjac, enorm, finfo)
+            pmut, wa1, wa2 = qr_factor_packed (fjac, enorm, finfo)
 
             if niter == 1:
                 # If "diag" unspecified, scale according to norms of rows
                 # of the initial jacobian
                 if self.diag is not None:
                     diag = self.diag.copy ()
+                elif wdiag is not None:
+                    diag = wdiag.copy ()
                 else:
                     diag = wa2.copy ()
                     diag[where (diag == 0)] = 1.
 
                 # Calculate norm of scaled x, initialize step bound delta
                 xnorm = enorm (diag * x, finfo)
-                delta = self.factor * xnorm
-                if delta == 0.:
-                    delta = self.factor
 
-            # Compute fvec * (q.T), store the first n components in fqt
+                if wdelta is not None:
+                    delta = wdelta
+                else:
+                    delta = self.factor * xnorm
+                    if delta == 0.:
+                        delta = self.factor
+
+            # Compute fvec * (q.T), store the first n components in fqt.
+            # wa4 alternates with fvec between two buffers.
 
-            wa4 = fvec.copy ()
+            wa4 = spare
+            wa4[:] = fvec
 
             for j in xrange (n):
                 temp3 = fjac[j,j]
@@ -1716,9 +3437,13 @@ class Problem (object):
                         s = dot (fqt[:j+1], fjac[j,:j+1]) / fnorm
                         gnorm = max (gnorm, abs (s / wa2[l]))
 
-            # Test for convergence of gradient norm
+            # Test for convergence of gradient norm. Don't trust an
+            # updated Jacobian for this.
 
             if gnorm <= self.gtol:
+                if nupdates:
+                    needfull = True
+                    continue
                 status.add ('gtol')
                 break
 
@@ -1728,8 +3453,8 @@ class Problem (object):
             # Inner loop
             while True:
                 # Get Levenberg-Marquardt parameter. fjac is modified in-place
-                par, wa1 = _lm_solve (fjac, pmut, diag, fqt, delta, par,
-                                      enorm, finfo)
+                par, wa1 = lm_solve (fjac, pmut, diag, fqt, delta, par,
+                                     enorm, finfo)
                 # "Store the direction p and x+p. Calculate the norm of p"
                 wa1 *= -1
                 alpha = 1.
@@ -1787,8 +3512,12 @@ class Problem (object):
 
                 # Evaluate func at x + p and calculate norm
 
-                ycall (params, wa4)
-                fnorm1 = enorm (wa4, finfo)
+                if chunked:
+                    yield (_REQ_NORM, params, nbuf)
+                    fnorm1 = nbuf[0]
+                else:
+                    yield (_REQ_Y, params, wa4)
+                    fnorm1 = enorm (wa4, finfo)
 
                 # Compute scaled actual reductions
 
@@ -1833,14 +3562,25 @@ class Problem (object):
                     delta = 2 * pnorm
                     par *= 0.5
 
+                if trace is not None:
+                    trace._record (niter, ratio >= 0.0001, fnorm, fnorm1, delta,
+                                   par, ratio, pnorm)
+
                 if ratio >= 0.0001:
                     # Successful iteration.
+                    if self.broyden > 0:
+                        bstep = wa2 - x
+                        bdf = wa4 - fvec
+                        if ratio < 0.25 or not any (bstep):
+                            needfull = True
                     x = wa2
                     wa2 = diag * x
+                    spare = fvec
                     fvec = wa4
                     xnorm = enorm (wa2, finfo)
                     fnorm = fnorm1
                     niter += 1
+                    maxdelta = max (maxdelta, delta)
 
                 # Check for convergence
 
@@ -1864,6 +3604,16 @@ class Problem (object):
                 if gnorm <= finfo.eps:
                     status.add ('geps')
 
+                # With an updated Jacobian, a failed step or an apparent
+                # convergence may just reflect its inaccuracy, so go back
+                # and compute it in full.
+
+                if nupdates and (ratio < 0.0001 or len (status)) \
+                        and 'maxiter' not in status:
+                    status.clear ()
+                    needfull = True
+                    break
+
                 # Repeat loop if iteration
                 # unsuccessful. "Unsuccessful" means that the ratio of
                 # actual to predicted norm reduction is less than 1e-4
@@ -1888,65 +3638,43 @@ class Problem (object):
         else:
             params[ifree] = x
 
-        ycall (params, fvec)
-        fnorm = enorm (fvec, finfo)
+        if chunked:
+            yield (_REQ_NORM, params, nbuf)
+            fnorm = nbuf[0]
+            fvec = None
+        else:
+            yield (_REQ_Y, params, fvec)
+            fnorm = enorm (fvec, finfo)
         fnorm = max (fnorm, fnorm1)
         fnorm **= 2
 
-        # Covariance matrix. Nonfree parameters get zeros. Fill in
-        # everything else if possible. TODO: I don't understand the
-        # "covar = None" branch
-
-        covar = np.zeros ((self._npar, self._npar), dtype)
-
-        if n > 0:
-            sz = fjac.shape
-
-            if sz[0] < n or sz[1] < n or len (pmut) < n:
-                covar = None
-            else:
-                cv = _calc_covariance (fjac[:,:n], pmut[:n])
-                cv.shape = (n, n)
-
-                for i in xrange (n): # can't do 2D fancy indexing
-                    covar[ifree[i],ifree] = cv[i]
-
-        # Errors in parameters from the diagonal of covar.
-
-        perror = None
-
-        if covar is not None:
-            perror = np.zeros (self._npar, dtype)
-            d = covar.diagonal ()
-            wh = where (d >= 0)
-            perror[wh] = sqrt (d[wh])
-
+        # Covariance matrix. Nonfree parameters get zeros. Fill in
+        # everything else if possible. This is done lazily by
+        # Solution.covar; we only save a copy of the factor, since fjac
+        # may be a reused work array (see SolvePlan). TODO: I don't
+        # understand the "covar = None" branch
+
+        if n == 0:
+            soln.covar = np.zeros ((self._npar, self._npar), dtype)
+        elif fjac.shape[0] < n or fjac.shape[1] < n or len (pmut) < n:
+            soln.covar = None
+        else:
+            soln._covarstate = (fjac[:,:n].copy (), pmut[:n].copy (), ifree,
+                                self._npar)
+
         # Export results and we're done.
 
-        soln = self.solclass (self)
-        soln.ndof = self.getNDOF ()
+        soln.ndof = self._nout - ifree.size
         soln.status = status
         soln.niter = niter
         soln.params = params
-        soln.covar = covar
-        soln.perror = perror
         soln.fnorm = fnorm
         soln.fvec = fvec
         soln.fjac = fjac
-        soln.nfev = self._nfev
-        soln.njev = self._njev
-        return soln
-
-
-    def _get_jacobian_explicit (self, params, fvec, fjacfull, ulimit, dside, maxstep, isrel, finfo):
-        self._njev += 1
+        soln._warmstate = (maxdelta or delta, diag, jprev if warmjac else None)
 
-        if self.debugCalls:
-            print 'Call: #%4d j(%s) ->' % (self._njev, params),
-        self._jfunc (params, fjacfull)
-        if self.debugCalls:
-            print fjacfull
 
+    def _condense_jacobian (self, fjacfull):
         # Condense down to contain only the rows relevant to the free
         # parameters. We actually copy the data here instead of using
         # fancy indexing since this condensed matrix will be used a
@@ -1959,11 +3687,29 @@ class Problem (object):
                 fjacfull[i] = fjacfull[ifree[i]]
 
 
-    def _get_jacobian_automatic (self, params, fvec, fjacfull, ulimit, dside, maxstep, isrel, finfo):
+    def _get_jacobian_explicit (self, params, fvec, fjacfull, ulimit, dside, maxstep, isrel, finfo):
+        self._jcall (params, fjacfull)
+        self._condense_jacobian (fjacfull)
+
+
+    def _jacobian_rows (self, params, ulimit, dside, maxstep, isrel, finfo,
+                        rows=None):
+        """Set up the function evaluations for an automatic Jacobian.
+
+Returns (jinfo, rows), where rows is a tuple (xps, fps, cxps, cfps).
+xps is a k-by-npar array of perturbed parameter vectors, fps is an
+uninitialized k-by-nout array to be filled with the function values
+at those vectors, and cxps and cfps are the same for the complex-step
+parameters (see pSide), with complex dtype. jinfo is opaque
+information to be passed to _jacobian_from_rows(). The rows of xps are
+ordered as the evaluations were historically made one at a time: for
+each free parameter, the positive step, followed by the negative step
+if the derivative is two-sided. If rows is given, its arrays are
+filled in and returned rather than newly allocated."""
+
         eps = np.sqrt (max (self.epsilon, finfo.eps))
         ifree = self._ifree
         x = params[ifree]
-        m = len (fvec)
         n = len (x)
         h = eps * np.abs (x)
 
@@ -1990,30 +3736,66 @@ class Problem (object):
         if self.debugJac:
             print 'Jac-:', h
 
-        # Compute derivative for each parameter
+        # Lay out the perturbed parameter vectors; see _fixupCheck.
 
-        fp = np.empty (self._nout, dtype=finfo.dtype)
-        fm = np.empty (self._nout, dtype=finfo.dtype)
+        rowp, two, cplx, spmask, nrows, ncrows = self._jlayout
 
-        for i in xrange (n):
-            xp = params.copy ()
-            xp[ifree[i]] += h[i]
-            self._ycall (xp, fp)
+        if rows is None:
+            rows = _jacobian_work (nrows, ncrows, params.size, self._nout, params.dtype)
 
-            if dside[i] != DSIDE_TWO:
-                # One-sided derivative
-                fjacfull[i] = (fp - fvec) / h[i]
-            else:
-                # Two-sided ... extra func call
-                xp[ifree[i]] = params[ifree[i]] - h[i]
-                self._ycall (xp, fm)
-                fjacfull[i] = (fp - fm) / (2 * h[i])
+        xps, fps, cxps, cfps = rows
+        real = ~cplx
+        xps[:] = params
+        xps[rowp[real],ifree[real]] += h[real]
+        xps[rowp[two] + 1,ifree[two]] -= h[two]
+
+        if ncrows:
+            # Complex steps involve no differencing, so they can be
+            # tiny and need not respect limits.
+            h[cplx] = finfo.eps * np.abs (x[cplx])
+            h[cplx & (h == 0)] = finfo.eps
+            cxps[:] = params
+            cxps[rowp[cplx],ifree[cplx]] += 1j * h[cplx]
+
+        return (h, rowp, two, cplx, spmask), rows
+
+
+    def _jacobian_from_rows (self, fvec, rows, jinfo, fjacfull, checkcplx=True):
+        h, rowp, two, cplx, spmask = jinfo
+        xps, fps, cxps, cfps = rows
+        one = ~(two | cplx)
+        fjac = fjacfull[:h.size]
+
+        # One-sided derivatives
+        fjac[one] = (fps[rowp[one]] - fvec) / h[one,np.newaxis]
+        # Two-sided derivatives
+        fjac[two] = ((fps[rowp[two]] - fps[rowp[two] + 1]) /
+                     (2 * h[two,np.newaxis]))
+
+        if cfps.shape[0]:
+            # Complex-step derivatives
+            if checkcplx and not np.any (cfps.imag):
+                raise _complex_step_error (_nonimag_detail)
+            fjac[cplx] = cfps.imag[rowp[cplx]] / h[cplx,np.newaxis]
+
+        if spmask is not None:
+            # Discard the effects of the other members of each group.
+            fjac[~spmask] = 0
 
         if self.debugJac:
-            for i in xrange (n):
+            for i in xrange (h.size):
                 print 'Jac :', fjacfull[i]
 
 
+    def _get_jacobian_automatic (self, params, fvec, fjacfull, ulimit, dside, maxstep, isrel, finfo):
+        jinfo, rows = self._jacobian_rows (params, ulimit, dside, maxstep,
+                                           isrel, finfo)
+        self._serve ((_REQ_YROWS, rows[0], rows[1]))
+        if rows[2].shape[0]:
+            self._serve ((_REQ_YROWS, rows[2], rows[3]))
+        self._jacobian_from_rows (fvec, rows, jinfo, fjacfull)
+
+
     def _manual_jacobian (self, params, dtype=np.float):
         self._fixupCheck (dtype)
 
@@ -2039,17 +3821,33 @@ class Problem (object):
 
 
     def _apply_ties (self, params):
-        funcs = self._pinfoo[PI_O_TIEFUNC]
+        for i, func, vectorized in self._ties:
+            if vectorized:
+                params[i] = func (params[np.newaxis])[0]
+            else:
+                params[i] = func (params)
+
 
-        for i in xrange (self._npar):
-            if funcs[i] is not None:
-                params[i] = funcs[i] (params)
+    def _apply_ties_rows (self, params):
+        # The same, for each row of the 2D array params. Each tie only
+        # looks at its own row, so applying them a column at a time
+        # gives the same results as applying them a row at a time.
+
+        for i, func, vectorized in self._ties:
+            if vectorized:
+                params[:,i] = func (params)
+            else:
+                for row in params:
+                    row[i] = func (row)
 
 
     def solve_scipy (self, initial_params=None, dtype=np.float, strict=True):
         from numpy import any, clip, dot, isfinite, sqrt, where
         self._fixupCheck (dtype)
 
+        if self._chunksize is not None:
+            raise RuntimeError ('cannot use scipy layer in chunked mode')
+
         if strict:
             if self._ifree.size != self._npar:
                 raise RuntimeError ('can only use scipy layer with no ties or fixed params')
@@ -2075,7 +3873,10 @@ class Problem (object):
 
         def sofunc (pars):
             y = np.empty (self._nout, dtype=dtype)
-            self._yfunc (pars, y)
+            if self._ybatched:
+                self._yfunc (pars[np.newaxis], y[np.newaxis])
+            else:
+                self._yfunc (pars, y)
             return y
 
         if self._jfunc is None:
@@ -2089,8 +3890,7 @@ class Problem (object):
         t = leastsq (sofunc, initial_params, Dfun=sojac, full_output=1,
                      ftol=self.ftol, xtol=self.xtol, gtol=self.gtol,
                      maxfev=self.maxiter, # approximate
-                     epsfcn=self.epsilon, factor=self.factor, diag=self.diag,
-                     warning=False)
+                     epsfcn=self.epsilon, factor=self.factor, diag=self.diag)
 
         covar = t[1]
         perror = None
@@ -2114,10 +3914,262 @@ class Problem (object):
         soln.fnorm = enorm_minpack (soln.fvec, finfo)**2
         soln.fjac = t[2]['fjac'].T
         soln.nfev = t[2]['nfev']
-        soln.njev = 0 # could compute when given explicit derivative ...
+        soln.njev = t[2].get ('njev', 0)
+        return soln
+
+
+class SolvePlan (object):
+    """A precomputed, unchangeable setup for solving a Problem many times.
+
+Create one with Problem.freeze(). Each call to solve() reuses the
+setup computed at that time and the same work arrays, so a plan must
+not be used by more than one thread at once. The 'fvec' and 'fjac'
+fields of the Solutions are copied out of the work arrays, and the
+'nfev' and 'njev' fields count the evaluations for that solve alone.
+If the problem was set up with setResidualFunc(), new data can be
+swapped in with setData()."""
+
+    def __init__ (self, prob, dtype=np.float):
+        prob._fixupCheck (dtype)
+        self._prob = prob
+        self._dtype = dtype
+        self._explicitjac = prob._jfunc is not None
+        self._setup = prob._solve_setup ()
+        self._work = Workspace (prob, dtype)
+
+
+    def setData (self, yobs, errinv):
+        self._prob._setResidualData (yobs, errinv)
+        return self
+
+
+    def solve (self, initial_params=None, warm=None, warmjac=False):
+        prob = self._prob
+        prob._nfev = 0
+        prob._njev = 0
+        soln = prob._new_solution ()
+        prob._drive (soln, prob._solve_steps (soln, initial_params, self._dtype,
+                                              self._explicitjac, warm, warmjac,
+                                              self._setup, self._work._arrays))
+
+        soln.nfev = prob._nfev
+        soln.njev = prob._njev
+        soln._detach ()
         return soln
 
 
+    def nbytes (self):
+        """Return the memory used by the plan's work arrays; see
+        Workspace.nbytes()."""
+        return self._work.nbytes ()
+
+
+class Workspace (object):
+    """Preallocated work arrays for solving a Problem.
+
+Create one with Problem.makeWorkspace(). The arrays are sized by the
+problem's npar and nout, the data type, and the way that the Jacobian
+is computed, and can be reused by any Problem for which all of those
+are the same; solve() raises a ValueError otherwise. Assign a
+Workspace to Problem.workspace to have every solve() of that Problem
+reuse its arrays: the function vectors, the Jacobian, and the
+perturbed parameter vectors of automatic derivatives. The 'fvec' and
+'fjac' fields of the Solutions are copied out of them. A Workspace
+must not be used by more than one solve at once."""
+
+    def __init__ (self, prob, dtype=np.float):
+        prob._fixupCheck (dtype)
+        self.npar = prob._npar
+        self.nout = prob._nout
+        self.dtype = np.dtype (dtype)
+        self._key = prob._workspace_key (dtype)
+        self._arrays = prob._solve_work (dtype, prob._jfunc is not None)
+
+
+    def _arrays_for (self, prob, dtype):
+        if prob._workspace_key (dtype) != self._key:
+            raise ValueError ('workspace does not match the problem: it was '
+                              'made for npar=%d, nout=%d, dtype=%s, and the '
+                              'same derivative configuration'
+                              % (self.npar, self.nout, self.dtype))
+        return self._arrays
+
+
+    def nbytes (self, detail=False):
+        """Return the number of bytes used by the work arrays. If *detail*
+        is True, return a dict giving the number for each kind of array
+        instead."""
+        (fvec, spare), fjac, rows, cwork = self._arrays
+        sizes = {'fvec': fvec.nbytes + spare.nbytes, 'fjac': fjac.nbytes}
+
+        if rows is not None:
+            sizes['jacrows'] = sum (a.nbytes for a in rows)
+        if cwork is not None:
+            sizes['chunks'] = sum (a.nbytes for a in cwork)
+
+        if detail:
+            return sizes
+        return sum (sizes.itervalues ())
+
+
+class FitService (object):
+    """Run solves of Problems on a shared pool of workers.
+
+Parameters:
+max_workers - The number of worker threads to create, if *executor* is
+              None.
+max_queue   - The largest number of fits that may be queued or running
+              at once; submit() blocks when it is reached.
+executor    - A concurrent.futures executor to use instead of creating
+              a thread pool. It is not shut down by shutdown().
+
+submit() returns a concurrent.futures.Future whose result is the
+Solution. Each fit works on its own copy of the Problem, so one
+Problem may be submitted many times, from many threads, and can have
+its data replaced for each fit. A fit that takes longer than its
+timeout fails with concurrent.futures.TimeoutError, and one stopped by
+cancel() while running fails with concurrent.futures.CancelledError;
+both are checked between function evaluations. With a process pool,
+the Problems must be picklable (see Problem.executor) and running fits
+cannot be cancelled, only pending ones. stats() reports aggregate
+statistics. A FitService can be used as a context manager, shutting
+down on exit."""
+
+    def __init__ (self, max_workers=4, max_queue=64, executor=None):
+        import threading
+        from time import time
+        from concurrent.futures import ThreadPoolExecutor
+
+        if max_queue < 1:
+            raise ValueError ('max_queue')
+
+        self._ownexecutor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor (max_workers)
+
+        self.executor = executor
+        self._threads = isinstance (executor, ThreadPoolExecutor)
+        self._slots = threading.BoundedSemaphore (max_queue)
+        self._lock = threading.Lock ()
+        self._cancels = {}
+        self._tstart = time ()
+        self._counts = dict (submitted=0, completed=0, failed=0, timedout=0,
+                             cancelled=0, nfev=0)
+
+
+    def submit (self, prob, initial_params=None, data=None, dtype=np.float,
+                timeout=None, block=True):
+        """Queue a solve of *prob* and return a Future for its Solution.
+
+*data*, if not None, is a tuple (yobs, errinv) of new data for a
+problem set up with setResidualFunc(); see SolvePlan.setData().
+*timeout* is the number of seconds that the fit may run for, or None
+for no limit. If *block* is False and the queue is full, a
+RuntimeError is raised rather than waiting."""
+
+        import threading
+
+        prob = prob.copy ()
+        if data is not None:
+            prob._setResidualData (*data)
+        prob._fixupCheck (dtype) # report configuration errors here
+
+        if not self._slots.acquire (block):
+            raise RuntimeError ('fit queue is full')
+
+        cancel = threading.Event () if self._threads else None
+
+        try:
+            fut = self.executor.submit (_service_solve, prob, initial_params,
+                                        dtype, timeout, cancel)
+        except:
+            self._slots.release ()
+            raise
+
+        with self._lock:
+            self._counts['submitted'] += 1
+            if cancel is not None:
+                self._cancels[fut] = cancel
+
+        fut.add_done_callback (self._done)
+        return fut
+
+
+    def _done (self, fut):
+        from concurrent.futures import CancelledError, TimeoutError
+
+        self._slots.release ()
+
+        with self._lock:
+            self._cancels.pop (fut, None)
+            c = self._counts
+
+            if fut.cancelled ():
+                c['cancelled'] += 1
+                return
+
+            exc = fut.exception ()
+
+            if exc is None:
+                c['completed'] += 1
+                c['nfev'] += fut.result ().nfev
+            elif isinstance (exc, CancelledError):
+                c['cancelled'] += 1
+            elif isinstance (exc, TimeoutError):
+                c['timedout'] += 1
+            else:
+                c['failed'] += 1
+
+
+    def cancel (self, fut):
+        """Cancel the fit of *fut*, stopping it if it is already running.
+        Returns False if it has already finished."""
+        if fut.cancel ():
+            return True
+
+        with self._lock:
+            cancel = self._cancels.get (fut)
+
+        if cancel is None:
+            return False
+        cancel.set ()
+        return True
+
+
+    def stats (self):
+        """Return a dict of statistics on the fits submitted so far:
+the numbers submitted, still pending (queued or running), completed,
+failed, timed out, and cancelled; the elapsed time since the service
+was created, in seconds; the number of completed fits per second; and
+the mean number of function evaluations per completed fit."""
+        from time import time
+
+        with self._lock:
+            s = dict (self._counts)
+
+        nfev = s.pop ('nfev')
+        s['pending'] = (s['submitted'] - s['completed'] - s['failed'] -
+                        s['timedout'] - s['cancelled'])
+        s['elapsed'] = time () - self._tstart
+        s['fits_per_second'] = s['completed'] / s['elapsed'] if s['elapsed'] > 0 else 0.
+        s['mean_nfev'] = nfev / s['completed'] if s['completed'] else 0.
+        return s
+
+
+    def shutdown (self, wait=True):
+        if self._ownexecutor:
+            self.executor.shutdown (wait)
+
+
+    def __enter__ (self):
+        return self
+
+
+    def __exit__ (self, etype, value, tb):
+        self.shutdown ()
+        return False
+
+
 def checkDerivative (npar, nout, yfunc, jfunc, guess):
     explicit = np.empty ((npar, nout))
     jfunc (guess, explicit)
@@ -2130,10 +4182,12 @@ def checkDerivative (npar, nout, yfunc, jfunc, guess):
 
 
 def ResidualProblem (npar, yobs, errinv, yfunc, jfunc,
-                     solclass=Solution, reckless=False):
+                     solclass=Solution, reckless=False, batched=False,
+                     chunksize=None):
     p = Problem (solclass=solclass)
     p.setNPar (npar)
-    p.setResidualFunc (yobs, errinv, yfunc, jfunc, reckless=reckless)
+    p.setResidualFunc (yobs, errinv, yfunc, jfunc, reckless=reckless,
+                       batched=batched, chunksize=chunksize)
     return p
 
 
@@ -2154,6 +4208,45 @@ def _solve_linear ():
     p = ResidualProblem (2, y, 100, f, None)
     return p.solve ([2.5, 1.5])
 
+@test
+def _solve_many ():
+    # solveMany() should give exactly the same results as solving each
+    # problem individually.
+
+    x = np.linspace (0, 3, 20)
+    ydata = np.asarray ([[1., 1.3], [2.5, 0.7], [0.3, 2.], [4., 1.]])
+    ydata = ydata[:,0,np.newaxis] * np.exp (-x / ydata[:,1,np.newaxis])
+    guesses = np.asarray ([[1., 1.], [2., 1.], [0.5, 1.5], [3., 0.8]])
+
+    def vyfunc (iprob, params, vecs):
+        vecs[:] = ydata[iprob] - params[:,0,np.newaxis] * np.exp (-x / params[:,1,np.newaxis])
+
+    def vjfunc (iprob, params, jacs):
+        e = np.exp (-x / params[:,1,np.newaxis])
+        jacs[:,0] = -e
+        jacs[:,1] = -params[:,0,np.newaxis] * x * e / params[:,1,np.newaxis]**2
+
+    for usejac in (False, True):
+        many = Problem (2, 20, lambda p, v: None, None).pLimit (1, 0.5, 1.9)
+        if usejac:
+            solns = many.solveMany (guesses, vyfunc, vjfunc)
+        else:
+            solns = many.solveMany (guesses, vyfunc)
+
+        for i in xrange (guesses.shape[0]):
+            iprob = np.asarray ([i])
+            yf = lambda p, v: vyfunc (iprob, p[np.newaxis], v[np.newaxis])
+            jf = lambda p, j: vjfunc (iprob, p[np.newaxis], j[np.newaxis])
+            one = Problem (2, 20, yf, jf if usejac else None).pLimit (1, 0.5, 1.9)
+            s = one.solve (guesses[i])
+
+            assert np.all (s.params == solns[i].params)
+            assert np.all (s.covar == solns[i].covar)
+            assert s.fnorm == solns[i].fnorm
+            assert s.status == solns[i].status
+            assert s.nfev == solns[i].nfev
+            assert s.njev == solns[i].njev
+
 @test
 def _simple_automatic_jac ():
     def f (pars, vec):
@@ -2206,6 +4299,578 @@ def _jac_sidedness ():
     p.pLimit (0, upper=0)
     Taaae (p._manual_jacobian (0), [[-1.]])
 
+@test
+def _batched_automatic_jac ():
+    # The batched protocol should make one call per Jacobian and give
+    # exactly the same derivatives as the one-at-a-time protocol,
+    # including the handling of sidedness, limits, and maxstep.
+
+    x = np.linspace (0, 3, 12)
+    ncalls = [0]
+
+    def f (pars, vec):
+        vec[:] = pars[0] * np.exp (-x / pars[1]) + pars[2] * x
+
+    def bf (pars, vecs):
+        ncalls[0] += 1
+        vecs[:] = (pars[:,0,np.newaxis] * np.exp (-x / pars[:,1,np.newaxis]) +
+                   pars[:,2,np.newaxis] * x)
+
+    def configure (p):
+        p.pSide (1, 'two')
+        p.pLimit (2, upper=0.5)
+        p.pStep (0, 0.01, 1e-3, isrel=True)
+        return p
+
+    guess = np.asarray ([2., 1.1, 0.5])
+    serial = configure (Problem (3, 12, f, None))
+    batched = configure (Problem (3).setFunc (12, bf, None, batched=True))
+
+    j1 = serial._manual_jacobian (guess)
+    ncalls[0] = 0
+    j2 = batched._manual_jacobian (guess)
+    assert np.all (j1 == j2)
+    assert ncalls[0] == 2 # one for fvec, one for all four perturbations
+    assert serial._nfev == batched._nfev
+
+    yobs = np.empty (12)
+    f ([1.5, 0.9, 0.2], yobs)
+    s1 = configure (ResidualProblem (3, yobs, 10., f, None)).solve (guess)
+    s2 = configure (ResidualProblem (3, yobs, 10., bf, None, batched=True)).solve (guess)
+    assert np.all (s1.params == s2.params)
+    assert s1.nfev == s2.nfev
+
+@test
+def _vectorized_ties ():
+    # Vectorized ties should tie all of the rows of a batched
+    # evaluation in one call, and agree exactly with scalar ties. The
+    # second tie depends on the first.
+
+    x = np.linspace (0, 3, 12)
+    ncalls = [0]
+
+    def bf (pars, vecs):
+        vecs[:] = (pars[:,0,np.newaxis] * np.exp (-x / pars[:,1,np.newaxis]) +
+                   pars[:,2,np.newaxis] * x - pars[:,3,np.newaxis])
+
+    def vtie (pars):
+        ncalls[0] += 1
+        return pars[:,2] - pars[:,1]
+
+    yobs = np.empty (12)
+    bf (np.array ([[1.5, 0.9, 3., 2.1]]), yobs[np.newaxis])
+    guess = np.asarray ([2., 1.1, 0., 0.])
+
+    def configure (vectorized):
+        p = ResidualProblem (4, yobs, 10., bf, None, batched=True)
+        p.pTie (2, lambda pars: 2 * pars[0])
+        if vectorized:
+            return p.pTie (3, vtie, vectorized=True)
+        return p.pTie (3, lambda pars: pars[2] - pars[1])
+
+    s1 = configure (False).solve (guess)
+    p = configure (True)
+    p._manual_jacobian (guess)
+    assert ncalls[0] == 2 # one for fvec, one for all perturbations
+    s2 = p.solve (guess)
+    assert np.all (s1.params == s2.params)
+    Taaae (s2.params, [1.5, 0.9, 3., 2.1])
+
+def _pooled_jac_func (pars, vec):
+    # Module-level so that it can be sent to a process pool.
+    vec[:] = pars[0] * np.exp (-np.arange (10.) / pars[1]) + pars[2]
+
+@test
+def _pooled_automatic_jac ():
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+    except ImportError:
+        return # the "futures" backport is not installed
+
+    p1 = ResidualProblem (3, np.linspace (5, 1, 10), 3., _pooled_jac_func, None)
+    p1.pSide (0, 'two')
+    p2 = p1.copy ()
+    p2.executor = ThreadPoolExecutor (3)
+
+    guess = [2., 3., 0.5]
+    assert np.all (p1._manual_jacobian (guess) == p2._manual_jacobian (guess))
+
+    s1 = p1.solve (guess)
+    s2 = p2.solve (guess)
+    p2.executor.shutdown ()
+    assert np.all (s1.params == s2.params)
+    assert s1.fnorm == s2.fnorm
+    assert s1.nfev == s2.nfev
+
+def _multistart_func (pars, vec):
+    # Module-level so that it can be pickled. Global minimum at
+    # pars[0] = 1, local minimum near pars[0] = -1.
+    vec[0] = pars[0]**2 - 1
+    vec[1] = 0.3 * (pars[0] - 1)
+
+@test
+def _multistart ():
+    import cPickle
+    p = Problem (1, 2, _multistart_func, None)
+    p.pLimit (0, -3., 3.)
+    p2 = cPickle.loads (cPickle.dumps (p, cPickle.HIGHEST_PROTOCOL))
+    assert p2.solve ([2.]).fnorm == p.solve ([2.]).fnorm
+
+    solns = p.solveMultiStart (20, seed=1)
+    assert len (solns) == 2
+    assert sum (s.nstarts for s in solns) == 20
+    assert solns[0].fnorm < solns[1].fnorm
+    Taae (solns[0].params[0], 1.)
+    assert solns[1].params[0] < -0.9
+    assert solns[0].prob is p
+
+    # Stop at the first global minimum.
+    solns = p.solveMultiStart (20, seed=1, target_fnorm=1e-10)
+    assert sum (s.nstarts for s in solns) < 20
+    assert solns[0].fnorm <= 1e-10
+
+    try:
+        from concurrent.futures import ThreadPoolExecutor
+    except ImportError:
+        return
+
+    # The same starting points give the same answer in any order.
+    solns = p.solveMultiStart (20, seed=1)
+    pool = ThreadPoolExecutor (3)
+    solns2 = p.solveMultiStart (20, executor=pool, seed=1)
+    pool.shutdown ()
+    assert [s.nstarts for s in solns2] == [s.nstarts for s in solns]
+    assert [s.fnorm for s in solns2] == [s.fnorm for s in solns]
+
+@test
+def _solve_trace ():
+    import json
+    x = np.linspace (0, 4, 20)
+
+    def f (pars, vec):
+        vec[:] = pars[0] * np.exp (-pars[1] * x)
+
+    yobs = 2 * np.exp (-0.7 * x)
+    p = ResidualProblem (2, yobs, 10., f, None)
+    s1 = p.solve ([1., 1.])
+    assert s1.trace is None
+
+    seen = []
+    p.trace = seen.append
+    s2 = p.solve ([1., 1.])
+    assert np.all (s2.params == s1.params)
+
+    recs = s2.trace.toRecArray ()
+    assert len (seen) == recs.size > 0
+    assert recs.accepted.sum () == s2.niter - 1
+    assert np.all (np.diff (recs.t_wall) >= 0)
+    assert recs.fnorm1[-1] == seen[-1]['fnorm1']
+    assert s2.trace.totals['jac'] >= recs.t_jac.sum ()
+
+    d = json.loads (s2.trace.toJSON ())
+    assert len (d['records']) == recs.size
+    assert set (d['totals']) == set (['yfunc', 'jac', 'qr', 'lmsolve', 'wall'])
+
+@test
+def _sparse_automatic_jac ():
+    # A chain: output i depends on parameters i and i - 1, so every
+    # other parameter can be perturbed at once.
+
+    n = 10
+    pattern = np.eye (n, dtype=np.bool)
+    pattern[np.arange (n - 1),np.arange (1, n)] = True
+    assert _cpr_groups (pattern, np.zeros (n, dtype=np.bool)).max () == 1
+
+    def f (pars, vec):
+        vec[:] = np.exp (pars)
+        vec[1:] -= 3 * pars[:-1]
+
+    guess = np.linspace (-1, 1, n)
+    dense = ResidualProblem (n, np.ones (n), 1., f, None)
+    sparse = dense.copy ().setJacSparsity (pattern)
+    dense.pSide (3, 'two')
+    sparse.pSide (3, 'two')
+
+    jd = dense._manual_jacobian (guess)
+    nd = dense._nfev
+    js = sparse._manual_jacobian (guess)
+    ns = sparse._nfev
+    assert np.all (jd == js)
+    assert nd == n + 2 # one for fvec, one per parameter, one more for 'two'
+    assert ns == 5 # fvec, two one-sided groups, a two-sided group
+
+    sd = dense.solve (guess)
+    ss = sparse.solve (guess)
+    assert np.all (sd.params == ss.params)
+    assert ss.nfev < sd.nfev
+
+@test
+def _complex_step_jac ():
+    x = np.linspace (0, 4, 30)
+
+    def f (pars, vec):
+        vec[:] = pars[0] * np.exp (-pars[1] * x) + np.sin (pars[2] * x)
+
+    def j (pars, jac):
+        jac[0] = np.exp (-pars[1] * x)
+        jac[1] = -x * pars[0] * np.exp (-pars[1] * x)
+        jac[2] = x * np.cos (pars[2] * x)
+
+    guess = np.array ([2., 0.7, 1.1])
+    explicit = np.empty ((3, x.size))
+    j (guess, explicit)
+
+    yobs = np.empty (x.size)
+    f (np.array ([1.5, 0.5, 1.2]), yobs)
+    p = ResidualProblem (3, yobs, 1., f, None)
+    p.pSide ([0, 1, 2], 'complex')
+    jc = p._manual_jacobian (guess)
+    assert p._nfev == 4 # one for fvec, one per parameter
+    Taaae (jc, -explicit, 14) # residuals are yobs - model
+
+    # Mixed with other sidedness and a sparsity pattern.
+    p2 = p.copy ().pSide (1, 'two').setJacSparsity (np.ones ((3, x.size), dtype=np.bool))
+    Taaae (p2._manual_jacobian (guess), -explicit, 6)
+    assert p2._nfev == 5
+
+    s = p.solve (guess)
+    Taaae (s.params, [1.5, 0.5, 1.2])
+
+    def vf (iprob, pars, vecs):
+        for k in xrange (pars.shape[0]):
+            f (pars[k], vecs[k])
+        np.subtract (yobs, vecs, vecs)
+
+    s2 = p.solveMany (guess[np.newaxis], vf)[0]
+    Taaae (s2.params, s.params)
+
+    # yfuncs that can't handle complex input should be detected.
+    import math
+
+    def f2 (pars, vec):
+        vec[:] = math.exp (pars[0]) * x
+
+    def f3 (pars, vec):
+        vec[:] = np.exp (pars[0].real) * x
+
+    for func in f2, f3:
+        p = ResidualProblem (1, np.zeros (x.size), 1., func, None).pSide (0, 'complex')
+        try:
+            p._manual_jacobian ([1.])
+        except ValueError:
+            pass
+        else:
+            assert False, 'should have raised'
+
+@test
+def _complex_residuals ():
+    # A decaying phasor, fit with complex residuals and with the real
+    # and imaginary parts interleaved by hand.
+    x = np.linspace (0, 3, 25)
+
+    def cf (pars, vec, start=0):
+        xx = x[start:start+vec.size]
+        vec[:] = pars[0] * np.exp ((1j * pars[1] - pars[2]) * xx)
+
+    def cj (pars, jac, start=0):
+        xx = x[start:start+jac.shape[1]]
+        e = np.exp ((1j * pars[1] - pars[2]) * xx)
+        jac[0] = e
+        jac[1] = 1j * xx * pars[0] * e
+        jac[2] = -xx * pars[0] * e
+
+    def rf (pars, vec):
+        c = np.empty (x.size, dtype=np.complex)
+        cf (pars, c)
+        vec[::2] = c.real
+        vec[1::2] = c.imag
+
+    yobs = np.empty (x.size, dtype=np.complex)
+    cf (np.array ([2., 1.5, 0.4]), yobs)
+    yobs += np.random.RandomState (3).normal (0, 0.02, (x.size, 2)).view (np.complex)[:,0]
+    errinv = np.linspace (40, 60, x.size) + 50j
+    guess = [1., 1.2, 0.2]
+
+    sr = ResidualProblem (3, yobs.view (np.double), errinv.view (np.double),
+                          rf, None).solve (guess)
+    sc = ResidualProblem (3, yobs, errinv, cf, None).solve (guess)
+    assert np.all (sc.params == sr.params)
+    assert np.all (sc.fvec == sr.fvec)
+    assert sc.fvec.view (np.complex).size == x.size
+
+    sj = ResidualProblem (3, yobs, errinv, cf, cj).solve (guess)
+    Taaae (sj.params, sc.params)
+    sk = ResidualProblem (3, yobs, errinv, cf, cj, chunksize=7).solve (guess)
+    Taaae (sk.params, sc.params)
+
+    p = ResidualProblem (3, yobs, 50., cf, None)
+    p._setResidualData (yobs, errinv)
+    assert np.all (p.solve (guess).params == sc.params)
+
+@test
+def _broyden_updates ():
+    x = np.linspace (0, 4, 60)
+
+    def f (pars, vec):
+        vec[:] = pars[0] * np.exp (-pars[1] * x) + pars[2] * np.cos (pars[3] * x) + pars[4]
+
+    yobs = np.empty (x.size)
+    f (np.array ([2., 1.3, 0.5, 0.2, 0.1]), yobs)
+    yobs += np.random.RandomState (1).normal (0, 0.01, x.size)
+    guess = [1., 1., 1., 0.5, 0.]
+
+    p = ResidualProblem (5, yobs, 100., f, None)
+    s1 = p.solve (guess)
+    assert s1.njfull == s1.niter - 1 and s1.njupdate == 0
+
+    p = p.copy () # reset the call counters
+    p.broyden = 2
+    s2 = p.solve (guess)
+    assert s2.njupdate > 0
+    assert s2.nfev < s1.nfev
+    assert abs (s2.fnorm - s1.fnorm) <= 1e-10 * s1.fnorm
+    Taaae (s2.params, s1.params, decimal=5)
+
+@test
+def _warm_sequence ():
+    x = np.linspace (-5, 5, 80)
+
+    def f (pars, vec):
+        vec[:] = pars[0] * np.exp (-0.5 * ((x - pars[1]) / pars[2])**2) + pars[3] + pars[4] * x
+
+    rs = np.random.RandomState (1)
+    datasets = []
+
+    for i in xrange (4):
+        yobs = np.empty (x.size)
+        f (np.array ([3., 0.2 + 0.05 * i, 1.1, 0.5, 0.1]) * (1 + 0.02 * i), yobs)
+        yobs += rs.normal (0, 0.05, x.size)
+        datasets.append ((yobs, np.ones (x.size) * 20))
+
+    guess = [2.5, 0., 1.5, 0., 0.]
+    cold = [ResidualProblem (5, y, e, f, None).solve (guess) for y, e in datasets]
+
+    p = ResidualProblem (5, datasets[0][0], 1., f, None)
+    warm = list (p.solveSequence (datasets, guess, warmjac=True))
+    assert len (warm) == len (datasets)
+
+    for w, c in zip (warm, cold):
+        assert 'ftol' in w.status
+        assert abs (w.fnorm - c.fnorm) <= 1e-10 * c.fnorm
+        Taaae (w.params, c.params, decimal=6)
+
+    for w, c in zip (warm[1:], cold[1:]):
+        assert w.nfev < c.nfev
+        assert w.njupdate == 1
+
+    # solve() with an explicit warm start is equivalent.
+
+    s = ResidualProblem (5, datasets[1][0], datasets[1][1], f, None).solve (
+        warm=cold[0])
+    assert s.njupdate == 0
+    Taaae (s.params, cold[1].params, decimal=6)
+
+@test
+def _frozen_plan ():
+    x = np.linspace (-1, 1, 30)
+
+    def f (pars, vec):
+        vec[:] = pars[0] * np.exp (pars[1] * x) + pars[2]
+
+    yobs1 = 2 * np.exp (0.5 * x) + 0.3
+    yobs2 = 1.5 * np.exp (-0.5 * x) + 0.1
+    p = ResidualProblem (3, yobs1, 10., f, None)
+    p.pLimit (2, -1., 1.)
+    plan = p.freeze ()
+    p.pValue (2, 0., fixed=True) # doesn't affect the plan
+
+    for yobs in yobs1, yobs2, yobs1:
+        ref = ResidualProblem (3, yobs, 10., f, None).pLimit (2, -1., 1.)
+        s1 = ref.solve ([1., 0., 0.])
+        s2 = plan.setData (yobs, 10.).solve ([1., 0., 0.])
+        assert s2.nfev == s1.nfev
+        assert np.all (s2.params == s1.params)
+        assert np.all (s2.fvec == s1.fvec)
+        assert np.all (s2.fjac == s1.fjac)
+        assert np.all (s2.covar == s1.covar)
+
+    # Solutions don't share the work arrays.
+    s3 = plan.solve ([1., 0., 0.])
+    assert s3.fvec is not s2.fvec
+    assert np.all (s3.fvec == s2.fvec)
+
+@test
+def _lazy_covariance ():
+    x = np.linspace (-1, 1, 30)
+    noise = np.random.RandomState (5).normal (0, 0.1, x.size)
+
+    def f (pars, vec):
+        vec[:] = pars[0] * np.exp (pars[1] * x) + pars[2] + pars[3]
+
+    def jac (pars):
+        return np.array ([np.exp (pars[1] * x), pars[0] * x * np.exp (pars[1] * x),
+                          np.ones (x.size)])
+
+    # pars[2] and pars[3] are degenerate: the covariance of one of
+    # them comes out as zero.
+
+    yobs = 2 * np.exp (0.5 * x) + 0.3 + noise
+    p = ResidualProblem (4, yobs, 10., f, None)
+    s = p.solve ([1., 0., 0., 0.])
+    assert s._covarstate is not None
+    assert np.sum (s.covar.diagonal () == 0) == 1
+    assert s._covarstate is None
+    assert np.all (s.perror == np.sqrt (s.covar.diagonal ()))
+
+    p.pValue (3, 0., fixed=True)
+    s = p.solve ([1., 0., 0., 0.])
+    j = 10 * jac (s.params)
+    Taaae (s.covar[:3,:3], np.linalg.inv (np.dot (j, j.T)), 6)
+    assert np.all (s.covar[3] == 0) and np.all (s.covar[:,3] == 0)
+
+    # Lazy covariances are unaffected by later solves with a plan.
+    plan = p.freeze ()
+    s1 = plan.solve ([1., 0., 0., 0.])
+    plan.setData (yobs + 1, 10.).solve ([1., 0., 0., 0.])
+    assert np.all (s1.covar == s.covar)
+
+@test
+def _workspace_reuse ():
+    x = np.linspace (-1, 1, 30)
+
+    def f (pars, vec):
+        vec[:] = pars[0] * np.exp (pars[1] * x) + pars[2]
+
+    yobs = 2 * np.exp (0.5 * x) + 0.3
+    p = ResidualProblem (3, yobs, 10., f, None).pSide (1, 'two')
+    s1 = p.solve ([1., 0., 0.])
+
+    ws = p.makeWorkspace ()
+    sizes = ws.nbytes (detail=True)
+    assert sizes['fjac'] == 3 * 30 * 8
+    assert sizes['jacrows'] == 4 * (3 + 30) * 8 # two-sided: 4 rows
+    assert ws.nbytes () == sum (sizes.values ())
+
+    p.workspace = ws
+    s2 = p.solve ([1., 0., 0.])
+    s3 = p.solve ([1., 0.1, 0.])
+    assert np.all (s2.params == s1.params)
+    assert np.all (s2.fvec == s1.fvec)
+    assert np.all (s2.fjac == s1.fjac)
+    assert s3.fvec is not s2.fvec
+
+    q = ResidualProblem (3, yobs, 10., f, None) # one-sided: 3 rows
+    q.workspace = ws
+    try:
+        q.solve ([1., 0., 0.])
+    except ValueError:
+        pass
+    else:
+        assert False, 'should have raised'
+
+@test
+def _fit_service ():
+    import time, threading
+    from concurrent.futures import CancelledError, TimeoutError
+
+    x = np.linspace (-1, 1, 30)
+    gate = threading.Event ()
+
+    def f (pars, vec):
+        vec[:] = pars[0] * np.exp (pars[1] * x) + pars[2]
+
+    def gated (pars, vec):
+        # Holds the only worker until the gate is opened.
+        gate.wait (30)
+        f (pars, vec)
+
+    def slow (pars, vec):
+        # Every evaluation outlasts the timeout used below, so the
+        # deadline has always passed by the second one.
+        time.sleep (0.02)
+        f (pars, vec)
+
+    p = ResidualProblem (3, np.zeros (x.size), 10., f, None)
+    datasets = [(a * np.exp (0.5 * x) + 0.3, 10.) for a in (1., 2., 3., 4.)]
+
+    with FitService (max_workers=1, max_queue=3) as svc:
+        futs = [svc.submit (p, [1., 0., 0.], data=d) for d in datasets]
+
+        for d, fut in zip (datasets, futs):
+            ref = ResidualProblem (3, d[0], d[1], f, None).solve ([1., 0., 0.])
+            s = fut.result ()
+            assert np.all (s.params == ref.params)
+            assert s.nfev == ref.nfev
+
+        # With one worker held by fb, fc is certain to still be queued
+        # when it is cancelled.
+        pg = ResidualProblem (3, datasets[0][0], 10., gated, None)
+        ps = ResidualProblem (3, datasets[0][0], 10., slow, None)
+        fb = svc.submit (pg, [1., 0., 0.])
+        ft = svc.submit (ps, [1., 0., 0.], timeout=0.01)
+        fc = svc.submit (ps, [1., 0., 0.])
+        assert svc.cancel (fc)
+        gate.set ()
+        assert fb.result ().nfev > 0
+
+        for fut, exc in (ft, TimeoutError), (fc, CancelledError):
+            try:
+                fut.result ()
+            except exc:
+                pass
+            else:
+                assert False, 'should have raised'
+
+    # The statistics are updated by callbacks that may run just after
+    # the results become available, so check them after shutting down.
+    st = svc.stats ()
+    assert st['submitted'] == 7
+    assert st['completed'] == 5
+    assert st['timedout'] == 1
+    assert st['cancelled'] == 1
+    assert st['pending'] == 0
+    assert st['mean_nfev'] > 0
+
+@test
+def _chunked_mode ():
+    x = np.linspace (-5, 5, 301)
+
+    def f (pars, vec, start=0):
+        xx = x[start:start+vec.size]
+        vec[:] = pars[0] * np.exp (-0.5 * ((xx - pars[1]) / pars[2])**2) + pars[3] + pars[4] * xx
+
+    def j (pars, jac, start=0):
+        xx = x[start:start+jac.shape[1]]
+        g = np.exp (-0.5 * ((xx - pars[1]) / pars[2])**2)
+        jac[0] = g
+        jac[1] = pars[0] * g * (xx - pars[1]) / pars[2]**2
+        jac[2] = pars[0] * g * (xx - pars[1])**2 / pars[2]**3
+        jac[3] = 1
+        jac[4] = xx
+
+    yobs = np.empty (x.size)
+    f (np.array ([3., 0.2, 1.1, 0.5, 0.1]), yobs)
+    yobs += np.random.RandomState (1).normal (0, 0.05, x.size)
+    errinv = np.linspace (15, 25, x.size)
+    guess = [2.5, 0., 1.5, 0.5, 0.]
+
+    for jfunc in None, j:
+        for chunksize in 1, 40, 1000:
+            ps = [ResidualProblem (5, yobs, errinv, f, jfunc, chunksize=cs)
+                  for cs in (None, chunksize)]
+
+            for p in ps:
+                p.pValue (3, 0.5, fixed=True)
+                p.pLimit (2, 0.5, 2.)
+
+            s1, s2 = [p.solve (guess) for p in ps]
+            assert s2.fvec is None
+            assert s2.fjac.shape == (4, 4)
+            assert s2.status == s1.status
+            assert abs (s2.fnorm - s1.fnorm) <= 1e-10 * s1.fnorm
+            Taaae (s2.params, s1.params, decimal=8)
+            Taaae (s2.perror, s1.perror, decimal=10)
+
 @test
 def _jac_stepsizes ():
     def f (expstep, pars, vec):
@@ -2249,6 +4914,10 @@ def _jac_stepsizes ():
 # lmder1 / lmdif1 test cases
 
 def _lmder1_test (nout, func, jac, guess):
+    if _bench_cases is not None:
+        _bench_cases.append ((nout, func, jac, np.asfarray (guess)))
+        return
+
     finfo = np.finfo (np.float)
     tol = np.sqrt (finfo.eps)
     guess = np.asfarray (guess)
@@ -2274,6 +4943,10 @@ def _lmder1_test (nout, func, jac, guess):
 
 def _lmder1_driver (nout, func, jac, guess, target_fnorm1,
                     target_fnorm2, target_params, decimal=10):
+    if _bench_cases is not None:
+        _bench_cases.append ((nout, func, jac, np.asfarray (guess)))
+        return
+
     finfo = np.finfo (np.float)
     tol = np.sqrt (finfo.eps)
     guess = np.asfarray (guess)
@@ -2307,6 +4980,24 @@ y: %s''' % (decimal, s.params, target_params)
     fnorm2 = enorm_mpfit_careful (y, finfo)
     Taae (fnorm2, target_fnorm2)
 
+    # The LAPACK backend should reach the same answer to within
+    # rounding. (When target_params is None, the problem is rank
+    # deficient and the parameters are not well-determined.)
+
+    try:
+        import scipy.linalg
+    except ImportError:
+        return
+
+    p.linalg = 'lapack'
+    s2 = p.solve (guess)
+    assert abs (s2.fnorm - s.fnorm) <= 1e-8 * s.fnorm, \
+        'backends disagree: fnorm %r != %r' % (s2.fnorm, s.fnorm)
+
+    if target_params is not None:
+        scale = np.maximum (np.abs (s.params), 1)
+        Taaae (s2.params / scale, s.params / scale, decimal=6)
+
 
 def _lmder1_linear_full_rank (n, m, factor, target_fnorm1, target_fnorm2):
     """A full-rank linear function (lmder test #1)"""
@@ -2769,7 +5460,205 @@ def _lmder1_watson ():
                       0.9074113646884637e+01, -0.4541375466608216e+01, 0.1012011888536897e+01])
 
 
+# Benchmarking. The MINPACK test problems double as benchmark
+# problems: while _bench_cases is a list, _lmder1_driver() and
+# _lmder1_test() append their arguments to it instead of solving.
+#
+# Usage: python lmmin.py bench <output.json> [baseline=<old.json>]
+#        [repeat=3] [timetol=1.25] [timefloor=0.001] [nfevtol=0]
+#        [fnormtol=1e-6]
+
+_bench_cases = None
+
+# Larger instances of the problems that take arbitrary sizes.
+_bench_sizes = [(10, 100), (40, 400)]
+
+def _bench_collect ():
+    """Return a list of benchmark cases (name, nout, func, jac, guess)."""
+
+    global _bench_cases
+    cases = []
+    named = []
+
+    def collect (name, f, *args):
+        del cases[:]
+        f (*args)
+        for i, case in enumerate (cases):
+            named.append (('%s_%d' % (name, i), ) + case)
+
+    try:
+        _bench_cases = cases
+
+        for f in _testfuncs:
+            if f.__name__.startswith ('_lmder1_'):
+                collect (f.__name__[8:], f)
+
+        collect ('powell_singular', _lmder1_powell_singular)
+
+        for n, m in _bench_sizes:
+            collect ('linear_full_rank_%dx%d' % (n, m),
+                     _lmder1_linear_full_rank, n, m, 1, None, None)
+            collect ('linear_rank1_%dx%d' % (n, m),
+                     _lmder1_linear_rank1, n, m, 1, None, None, None)
+            collect ('linear_r1zcr_%dx%d' % (n, m),
+                     _lmder1_linear_r1zcr, n, m, 1, None, None, None)
+    finally:
+        _bench_cases = None
+
+    return named
+
+
+def _bench_run (repeat=3, namefilt=None):
+    """Run the benchmark cases and return a list of result dicts.
+
+Each case is solved with the analytic and with automatic Jacobians,
+with both solve() and, if scipy is available, solve_scipy(), with
+the settings used by _lmder1_driver(). The time is the best of
+*repeat* runs."""
+
+    from time import time
+
+    try:
+        import scipy.optimize
+        paths = ('solve', 'solve_scipy')
+    except ImportError:
+        paths = ('solve', )
+
+    tol = np.sqrt (np.finfo (np.float).eps)
+    results = []
+
+    for name, nout, func, jac, guess in _bench_collect ():
+        if namefilt is not None and namefilt not in name:
+            continue
+
+        for path in paths:
+            for jname, jfunc in (('analytic', jac), ('automatic', None)):
+                r = dict (name=name, n=guess.size, m=nout, path=path, jac=jname)
+                times = []
+
+                try:
+                    for i in xrange (repeat):
+                        p = Problem (guess.size, nout, func, jfunc)
+                        p.xtol = p.ftol = tol
+                        p.gtol = 0
+                        p.maxiter = 100 * (guess.size + 1)
+                        t0 = time ()
+                        s = getattr (p, path) (guess)
+                        times.append (time () - t0)
+                except Exception as e:
+                    r['error'] = '%s: %s' % (e.__class__.__name__, e)
+                else:
+                    r.update (time=min (times), nfev=int (s.nfev),
+                              njev=int (s.njev), fnorm=float (s.fnorm),
+                              status=sorted (s.status))
+
+                results.append (r)
+
+    return results
+
+
+def _bench_compare (results, baseline, timetol=1.25, timefloor=1e-3,
+                    nfevtol=0, fnormtol=1e-6):
+    """Compare benchmark results to a baseline; return a list of regressions.
+
+A case has regressed if it failed where the baseline didn't; if its
+time is more than *timetol* times the baseline time and more than
+*timefloor* seconds longer; if it made more than *nfevtol* more
+function or Jacobian evaluations; or if its fnorm is worse by more
+than *fnormtol* times the larger of the baseline fnorm and 1. Cases
+not in the baseline are ignored."""
+
+    base = dict (((b['name'], b['path'], b['jac']), b) for b in baseline)
+    regressions = []
+
+    for r in results:
+        b = base.get ((r['name'], r['path'], r['jac']))
+        if b is None or 'error' in b:
+            continue
+
+        what = '%(name)s [%(path)s, %(jac)s]' % r
+
+        if 'error' in r:
+            regressions.append ('%s: failed: %s' % (what, r['error']))
+            continue
+
+        if r['time'] > timetol * b['time'] and r['time'] - b['time'] > timefloor:
+            regressions.append ('%s: time %.3g s vs. %.3g s' % (what, r['time'], b['time']))
+
+        for k in 'nfev', 'njev':
+            if r[k] > b[k] + nfevtol:
+                regressions.append ('%s: %s %d vs. %d' % (what, k, r[k], b[k]))
+
+        if r['fnorm'] > b['fnorm'] + fnormtol * max (b['fnorm'], 1):
+            regressions.append ('%s: fnorm %.8g vs. %.8g' % (what, r['fnorm'], b['fnorm']))
+
+    return regressions
+
+
+def _bench_main (args):
+    import json, sys
+
+    opts = dict (repeat=3, timetol=1.25, timefloor=1e-3, nfevtol=0, fnormtol=1e-6)
+    paths = []
+
+    for arg in args:
+        if '=' in arg:
+            key, value = arg.split ('=', 1)
+            opts[key] = value
+        else:
+            paths.append (arg)
+
+    if len (paths) != 1:
+        print >>sys.stderr, ('usage: lmmin.py bench <output.json> [baseline=<old.json>] '
+                             '[name=<substring>] [repeat=3] [timetol=1.25] '
+                             '[timefloor=0.001] [nfevtol=0] [fnormtol=1e-6]')
+        return 1
+
+    results = _bench_run (int (opts['repeat']), opts.get ('name'))
+
+    with open (paths[0], 'w') as f:
+        json.dump ({'numpy': np.__version__, 'results': results}, f,
+                   indent=1, sort_keys=True)
+
+    if 'baseline' not in opts:
+        return 0
+
+    with open (opts['baseline']) as f:
+        baseline = json.load (f)['results']
+
+    regressions = _bench_compare (results, baseline, float (opts['timetol']),
+                                  float (opts['timefloor']), int (opts['nfevtol']),
+                                  float (opts['fnormtol']))
+
+    for r in regressions:
+        print r
+
+    return 1 if len (regressions) else 0
+
+
+@test
+def _bench_infrastructure ():
+    cases = _bench_collect ()
+    names = [c[0] for c in cases]
+    assert len (set (names)) == len (names)
+    assert 'rosenbrock_2' in names and 'linear_full_rank_40x400_0' in names
+
+    results = _bench_run (1, 'rosenbrock_0')
+    assert len (results) in (2, 4)
+    assert _bench_compare (results, results) == []
+
+    worse = [dict (r) for r in results]
+    worse[0]['nfev'] += 1
+    worse[0]['time'] = 2 * worse[0]['time'] + 1
+    assert len (_bench_compare (worse, results)) == 2
+
+
 # Finally ...
 
 if __name__ == '__main__':
+    import sys
+
+    if len (sys.argv) > 1 and sys.argv[1] == 'bench':
+        sys.exit (_bench_main (sys.argv[2:]))
+
     _runtests ()
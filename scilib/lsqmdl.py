@@ -10,6 +10,18 @@ Usage:
     func = lambda x, p1, p2, p3: ...
   PolynomialModel(degree, x, y, [invsigma]).solve().plot()
   ScaleModel(x, y, [invsigma]).solve().showcov()
+  Model(func, x, y, [invsigma]).solve(guess).bootstrap(nreal, seed=1).bootlimits
+
+Batch fitting of the same model to many datasets:
+
+  BatchModel(func, x, ys, [invsigmas], [index]).solve(guess).params
+  BatchPolynomialModel(degree, x, ys, [invsigmas], [index]).solve().rchisq
+  BatchScaleModel(x, ys, [invsigmas], [index]).solve().perror
+
+Here ys is an nset-by-npts array of datasets sharing x (which may also
+be nset-by-npts), or, if index is given, the datasets are ragged: x,
+ys and invsigmas are flat arrays of all of the points, and index
+gives the dataset number of each point.
 
 The invsigma are *inverse sigmas*, NOT inverse *variances* (the usual
 statistical weights). Since most applications deal in sigmas, take
@@ -38,6 +50,10 @@ class _ModelBase (object):
     rchisq = None # reduced chi squared of the fit
     resids = None # resids = y - modely
 
+    bootparams = None # nreal-by-npar ndarray of params fit to realizations of the data
+    bootlimits = None # 2-by-npar ndarray of lower and upper percentiles of bootparams
+    bootcovar = None # sample covariance matrix of bootparams
+
     def __init__ (self, x, y, invsigma=None):
         self.setdata (x, y, invsigma)
 
@@ -116,6 +132,52 @@ class _ModelBase (object):
         ndshow.view (self.covar, title='Covariance Matrix')
 
 
+    def bootstrap (self, nreal=200, method='resample', seed=None,
+                   percentiles=(15.87, 84.13), executor=None, vectorized=False):
+        """Estimate the parameter uncertainties from fits to many
+        realizations of the data. solve() must have been called.
+
+        If *method* is 'resample', each realization is a random
+        resampling of the data points, with replacement (the
+        bootstrap). If it is 'noise', each is the best-fit model plus
+        Gaussian noise with the data uncertainties (Monte Carlo). All
+        of the realizations are drawn up front from a RandomState
+        seeded with *seed*, and then fit together with the
+        corresponding batch model class. Fits of a general Model start
+        from the nominal solution, with a copy of its lmmin Problem,
+        and use *executor* and *vectorized* as BatchModel.solve()
+        does.
+
+        Sets 'bootparams' to the nreal-by-npar fitted parameters,
+        'bootlimits' to the given *percentiles* of them, and
+        'bootcovar' to their sample covariance, and returns self."""
+
+        if self.params is None:
+            raise ValueError ('must solve() before bootstrapping')
+
+        rstate = np.random.RandomState (seed)
+        n = self.y.size
+        nreal = int (nreal)
+
+        if method == 'resample':
+            idx = rstate.randint (0, n, size=(nreal, n))
+            x, y, invsigma = self.x[idx], self.y[idx], self.invsigma[idx]
+        elif method == 'noise':
+            x = self.x
+            invsigma = self.invsigma
+            sigma = np.zeros (n)
+            wh = invsigma != 0
+            sigma[wh] = 1. / invsigma[wh]
+            y = self.modely + rstate.normal (size=(nreal, n)) * sigma
+        else:
+            raise ValueError ('unrecognized bootstrap method "%s"' % method)
+
+        self.bootparams = self._batchfit (x, y, invsigma, executor, vectorized)
+        self.bootlimits = np.percentile (self.bootparams, percentiles, axis=0)
+        self.bootcovar = np.atleast_2d (np.cov (self.bootparams, rowvar=False))
+        return self
+
+
 class Model (_ModelBase):
     def __init__ (self, func, x, y, invsigma=None):
         if func is not None:
@@ -156,6 +218,13 @@ class Model (_ModelBase):
         return self
 
 
+    def _batchfit (self, x, y, invsigma, executor, vectorized):
+        batch = BatchModel (None, x, y, invsigma)
+        batch.func = self.func
+        batch.lm_prob = self.lm_prob.copy ()
+        return batch.solve (self.params, vectorized, executor).params
+
+
 class PolynomialModel (_ModelBase):
     def __init__ (self, nterms, x, y, invsigma=None):
         self.nterms = nterms
@@ -182,6 +251,10 @@ class PolynomialModel (_ModelBase):
         return self
 
 
+    def _batchfit (self, x, y, invsigma, executor, vectorized):
+        return BatchPolynomialModel (self.nterms, x, y, invsigma).solve ().params
+
+
 class ScaleModel (_ModelBase):
     def solve (self):
         w2 = self.invsigma**2
@@ -199,3 +272,427 @@ class ScaleModel (_ModelBase):
         self.resids = self.y - self.modely
         self.rchisq = ((self.resids * self.invsigma)**2).sum () / (self.x.size - 1)
         return self
+
+
+    def _batchfit (self, x, y, invsigma, executor, vectorized):
+        return BatchScaleModel (x, y, invsigma).solve ().params
+
+
+# Batch fitting: the same model fit to many datasets at once.
+
+def _modelcall (func, x, params):
+    # Evaluate func on each row of params, which is k-by-npar, and the
+    # matching row of x, k-by-npts, assuming that func broadcasts.
+    return func (x, *[params[:,i,np.newaxis] for i in xrange (params.shape[1])])
+
+
+class _ModelYFunc (object):
+    # A yfunc for lmmin evaluating func at fixed x. A class rather
+    # than a closure so that it can be pickled, for process pools.
+
+    def __init__ (self, func, x):
+        self.func = func
+        self.x = x
+
+    def __call__ (self, params, vec):
+        vec[:] = self.func (self.x, *params)
+
+
+class _BatchResidFunc (object):
+    # The vectorized residual function for lmmin.Problem.solveMany.
+
+    def __init__ (self, func, x, y, invsigma, vectorized):
+        self.func = func
+        self.x = x
+        self.y = y
+        self.invsigma = invsigma
+        self.vectorized = vectorized
+
+    def __call__ (self, iprob, params, vecs):
+        if self.vectorized:
+            vecs[:] = _modelcall (self.func, self.x[iprob], params)
+        else:
+            for k in xrange (iprob.size):
+                vecs[k] = self.func (self.x[iprob[k]], *params[k])
+
+        np.subtract (self.y[iprob], vecs, vecs)
+        vecs *= self.invsigma[iprob]
+
+
+class _BatchModelBase (object):
+    """Data are stored as nset-by-npts arrays. Ragged datasets are
+    padded out to the length of the longest one with points of zero
+    weight, whose x values repeat the last real one of the dataset.
+    'npts' gives the number of real points of each dataset."""
+
+    x = None
+    y = None
+    invsigma = None
+    npts = None # number of data points in each dataset
+
+    params = None # nset-by-npar ndarray of solved model parameters
+    perror = None # nset-by-npar ndarray of 1-sigma uncertainties
+    paramnames = None # iterable of string names for parameters
+    covar = None # nset-by-npar-by-npar ndarray of covariance matrices
+    rchisq = None # nset-vector of reduced chi squared of the fits
+
+    def __init__ (self, x, y, invsigma=None, index=None):
+        self.setdata (x, y, invsigma, index)
+
+
+    def setdata (self, x, y, invsigma=None, index=None):
+        if invsigma is None:
+            invsigma = 1.
+
+        if index is None:
+            y = np.array (y, dtype=np.float, ndmin=2)
+            x, invsigma = [np.broadcast_arrays (np.asarray (v, dtype=np.float), y)[0]
+                           for v in (x, invsigma)]
+
+            if x.shape != y.shape or invsigma.shape != y.shape:
+                raise ValueError ('x and inverse-sigma values must broadcast '
+                                  'to the shape of the y values')
+
+            self.x, self.y, self.invsigma = x, y, invsigma
+            if y.shape[1] == 0:
+                raise ValueError ('datasets must not be empty')
+
+            self.npts = np.empty (y.shape[0], dtype=np.int)
+            self.npts.fill (y.shape[1])
+            return self
+
+        index = np.asarray (index, dtype=np.int)
+        x, y, invsigma = np.broadcast_arrays (np.asarray (x, dtype=np.float),
+                                              np.asarray (y, dtype=np.float),
+                                              np.asarray (invsigma, dtype=np.float))
+        if index.ndim != 1 or x.shape != index.shape:
+            raise ValueError ('ragged x, y, inverse-sigma, and index values '
+                              'must be 1D and of the same size')
+        if index.size and index.min () < 0:
+            raise ValueError ('dataset indices must be nonnegative')
+
+        order = np.argsort (index, kind='mergesort')
+        index = index[order]
+        self.npts = np.bincount (index)
+        nset = self.npts.size
+
+        if nset and self.npts.min () == 0:
+            raise ValueError ('dataset %d has no points'
+                              % np.flatnonzero (self.npts == 0)[0])
+
+        starts = np.cumsum (self.npts) - self.npts
+        col = np.arange (index.size) - starts[index]
+
+        shape = (nset, self.npts.max () if nset else 0)
+        self.x = np.empty (shape)
+        self.y = np.zeros (shape)
+        self.invsigma = np.zeros (shape)
+        self.y[index,col] = y[order]
+        self.invsigma[index,col] = invsigma[order]
+
+        # Padding repeats the last x value of the dataset, which
+        # hopefully is a safe place to evaluate the model.
+        last = np.zeros (nset, dtype=np.int)
+        last[index] = order
+        self.x[:] = x[last,np.newaxis]
+        self.x[index,col] = x[order]
+        return self
+
+
+    @property
+    def nsets (self):
+        return self.y.shape[0]
+
+
+    def _setrchisq (self, chisq, nfree):
+        # As in _ModelBase, there is no reduced chi squared for a fit
+        # without any degrees of freedom; those entries are NaN.
+        ndof = self.npts - nfree
+        self.rchisq = np.empty (self.nsets)
+        self.rchisq.fill (np.nan)
+        ok = ndof > 0
+        self.rchisq[ok] = chisq[ok] / ndof[ok]
+
+
+class BatchModel (_BatchModelBase):
+    """Fit one model function to many datasets with lmmin. By default
+    the fits are run in lockstep with lmmin.Problem.solveMany; if
+    *vectorized* is True, func is called just once per round, with x
+    and each parameter as 2D arrays, one row per dataset being
+    evaluated, so it must broadcast. Alternatively, the fits can be
+    run on a concurrent.futures executor with lmmin.FitService."""
+
+    lm_prob = None # lmmin.Problem whose parameter configuration (limits, etc.) the fits use
+    lm_solns = None # list of lmmin Solutions, one per dataset
+
+    def __init__ (self, func, x, y, invsigma=None, index=None):
+        if func is not None:
+            self.setfunc (func)
+        if x is not None:
+            self.setdata (x, y, invsigma, index)
+
+
+    def setfunc (self, func):
+        self.func = func
+        npar = func.func_code.co_argcount - 1
+        self.paramnames = func.func_code.co_varnames[1:npar+1]
+        import lmmin
+        self.lm_prob = lmmin.Problem (npar)
+        return self
+
+
+    def solve (self, guess, vectorized=False, executor=None):
+        """*guess* is one set of initial parameters for all of the
+        datasets, or an nset-by-npar array of them."""
+
+        nset = self.nsets
+        guess = np.array (guess, dtype=np.float, ndmin=2)
+        guess = np.array (np.broadcast_to (guess, (nset, guess.shape[1])))
+
+        # The fits work on copies of lm_prob, so that it keeps only the
+        # parameter configuration and stays reusable.
+
+        if executor is None:
+            prob = self.lm_prob.copy ()
+            prob.setResidualFunc (self.y[0], self.invsigma[0],
+                                  _ModelYFunc (self.func, self.x[0]), None)
+            vyfunc = _BatchResidFunc (self.func, self.x, self.y, self.invsigma,
+                                      vectorized)
+            solns = prob.solveMany (guess, vyfunc)
+        else:
+            import lmmin
+            svc = lmmin.FitService (executor=executor, max_queue=max (nset, 1))
+            futures = []
+
+            for i in xrange (nset):
+                prob = self.lm_prob.copy ()
+                prob.setResidualFunc (self.y[i], self.invsigma[i],
+                                      _ModelYFunc (self.func, self.x[i]), None)
+                futures.append (svc.submit (prob, guess[i]))
+
+            solns = [f.result () for f in futures]
+
+        self.lm_solns = solns
+        self.params = np.array ([s.params for s in solns])
+        self.perror = np.array ([s.perror for s in solns])
+        self.covar = np.array ([s.covar for s in solns])
+
+        # The padding of ragged datasets doesn't count toward the
+        # degrees of freedom.
+        nfree = np.array ([self.y.shape[1] - s.ndof for s in solns])
+        fnorm = np.array ([s.fnorm for s in solns])
+        self._setrchisq (fnorm, nfree)
+        return self
+
+
+class BatchPolynomialModel (_BatchModelBase):
+    """The batch version of PolynomialModel. The fits are computed
+    together, from the normal equations, and weighted as
+    PolynomialModel weights them (see the call to polyfit()
+    there). Unlike it, the parameter uncertainties and covariances are
+    provided, derived for that weighting."""
+
+    def __init__ (self, nterms, x, y, invsigma=None, index=None):
+        self.nterms = nterms
+        self.setdata (x, y, invsigma, index)
+
+
+    def solve (self):
+        self.paramnames = ['a%d' % i for i in xrange (self.nterms)]
+
+        a = self.x[:,:,np.newaxis]**np.arange (self.nterms)
+        w2 = self.invsigma**4 # PolynomialModel's polyfit weights, squared
+        ata = np.einsum ('sk,skj,skl->sjl', w2, a, a)
+        aty = np.einsum ('sk,skj,sk->sj', w2, a, self.y)
+
+        # Scale the columns of the design matrix to improve the
+        # conditioning of the normal equations, as polyfit() does.
+        scale = np.sqrt (np.einsum ('sjj->sj', ata))
+        scale[scale == 0] = 1
+        sata = ata / (scale[:,:,np.newaxis] * scale[:,np.newaxis,:])
+        self.params = np.linalg.solve (sata, (aty / scale)[:,:,np.newaxis])[:,:,0] / scale
+
+        # The covariance of a least-squares fit with weights that are
+        # not the inverse variances: inv(A^T W A) A^T W S W A inv(A^T W A).
+        ainv = np.linalg.inv (sata) / (scale[:,:,np.newaxis] * scale[:,np.newaxis,:])
+        mid = np.einsum ('sk,skj,skl->sjl', self.invsigma**6, a, a)
+        self.covar = np.einsum ('sij,sjk,skl->sil', ainv, mid, ainv)
+        self.perror = np.sqrt (np.einsum ('sjj->sj', self.covar))
+
+        resids = self.y - np.einsum ('skj,sj->sk', a, self.params)
+        self._setrchisq (((resids * self.invsigma)**2).sum (axis=1), self.nterms)
+        return self
+
+
+class BatchScaleModel (_BatchModelBase):
+    """The batch version of ScaleModel."""
+
+    def solve (self):
+        w2 = self.invsigma**2
+        sxx = (self.x**2 * w2).sum (axis=1)
+        sxy = (self.x * self.y * w2).sum (axis=1)
+        m = sxy / sxx
+
+        self.paramnames = ['m']
+        self.params = m[:,np.newaxis]
+        self.perror = 1. / np.sqrt (sxx)[:,np.newaxis]
+        self.covar = self.perror[:,:,np.newaxis]**2
+        resids = self.y - m[:,np.newaxis] * self.x
+        self._setrchisq (((resids * self.invsigma)**2).sum (axis=1), 1)
+        return self
+
+
+# Quickie testing infrastructure
+
+_testfuncs = []
+
+def test (f): # a decorator
+    _testfuncs.append (f)
+    return f
+
+def _runtests (namefilt=None):
+    for f in _testfuncs:
+        if namefilt is not None and f.__name__ != namefilt:
+            continue
+        n = f.__name__
+        if n[0] == '_':
+            n = n[1:]
+        print n, '...'
+        f ()
+
+
+def _testline (x, a, b):
+    return a * x + b
+
+
+def _testdata (seed, npts):
+    # Noisy straight lines with nonuniform uncertainties, one per entry
+    # of npts.
+    rng = np.random.RandomState (seed)
+    data = []
+
+    for i, n in enumerate (npts):
+        x = np.sort (rng.uniform (0.5, 3, size=n))
+        u = rng.uniform (0.05, 0.2, size=n)
+        y = _testline (x, 1. + i, 0.5 - i) + u * rng.normal (size=n)
+        data.append ((x, y, 1. / u))
+
+    return data
+
+
+def _checkbatch (batch, singles, tol=None):
+    # With tol, lmmin fits only have to agree to a small fraction of
+    # their uncertainties: zero-weight padding and reordering change
+    # the roundoff, and so where the iterations stop.
+    for i, single in enumerate (singles):
+        if tol is None:
+            assert np.allclose (batch.params[i], single.params, rtol=1e-8, atol=1e-12)
+        else:
+            assert np.all (np.abs (batch.params[i] - single.params) < tol * single.perror)
+        assert np.allclose (batch.rchisq[i], single.rchisq, rtol=1e-6, atol=0)
+        if single.perror is not None:
+            assert np.allclose (batch.perror[i], single.perror, rtol=1e-6, atol=0)
+
+
+@test
+def _batch_stacked ():
+    from concurrent.futures import ThreadPoolExecutor
+
+    data = _testdata (1, [20] * 4)
+    x = data[0][0]
+    ys = np.array ([d[1] for d in data])
+    invsigmas = np.array ([d[2] for d in data])
+
+    singles = [Model (_testline, x, y, invsigma).solve ([1., 0.])
+               for y, invsigma in zip (ys, invsigmas)]
+    _checkbatch (BatchModel (_testline, x, ys, invsigmas).solve ([1., 0.]), singles)
+    _checkbatch (BatchModel (_testline, x, ys, invsigmas).solve ([1., 0.], vectorized=True),
+                 singles)
+
+    with ThreadPoolExecutor (2) as ex:
+        batch = BatchModel (_testline, x, ys, invsigmas)
+        lm_prob = batch.lm_prob
+        _checkbatch (batch.solve ([1., 0.], executor=ex), singles)
+        assert batch.lm_prob is lm_prob and lm_prob._yfunc is None
+
+    singles = [PolynomialModel (2, x, y, invsigma).solve ()
+               for y, invsigma in zip (ys, invsigmas)]
+    _checkbatch (BatchPolynomialModel (2, x, ys, invsigmas).solve (), singles)
+
+    singles = [ScaleModel (x, y, invsigma).solve ()
+               for y, invsigma in zip (ys, invsigmas)]
+    _checkbatch (BatchScaleModel (x, ys, invsigmas).solve (), singles)
+
+
+@test
+def _batch_ragged ():
+    data = _testdata (2, [7, 15, 3, 10])
+    x, y, invsigma = [np.concatenate (v) for v in zip (*data)]
+    index = np.concatenate ([np.repeat (i, d[0].size) for i, d in enumerate (data)])
+
+    # Shuffle the points, since setdata() must sort them out.
+    order = np.random.RandomState (3).permutation (index.size)
+    x, y, invsigma, index = x[order], y[order], invsigma[order], index[order]
+
+    batch = BatchModel (_testline, x, y, invsigma, index).solve ([1., 0.])
+    assert list (batch.npts) == [7, 15, 3, 10]
+    _checkbatch (batch, [Model (_testline, *d).solve ([1., 0.]) for d in data], 1e-5)
+    _checkbatch (BatchPolynomialModel (2, x, y, invsigma, index).solve (),
+                 [PolynomialModel (2, *d).solve () for d in data])
+    _checkbatch (BatchScaleModel (x, y, invsigma, index).solve (),
+                 [ScaleModel (*d).solve () for d in data])
+
+    # A dataset number with no points is an error.
+    try:
+        BatchScaleModel (x, y, invsigma, np.where (index > 1, index + 1, index))
+    except ValueError:
+        pass
+    else:
+        assert False, 'empty dataset should be rejected'
+
+
+@test
+def _batch_no_dof ():
+    # The second dataset has no degrees of freedom left for a line,
+    # and the third none for a scale factor.
+    data = _testdata (4, [6, 2, 1])
+    x, y, invsigma = [np.concatenate (v) for v in zip (*data)]
+    index = np.repeat ([0, 1, 2], [6, 2, 1])
+
+    r = BatchScaleModel (x, y, invsigma, index).solve ().rchisq
+    assert np.isfinite (r[:2]).all () and np.isnan (r[2])
+
+    for batch in (BatchModel (_testline, x[:8], y[:8], invsigma[:8], index[:8]).solve ([1., 0.]),
+                  BatchPolynomialModel (2, x[:8], y[:8], invsigma[:8], index[:8]).solve ()):
+        assert np.isfinite (batch.rchisq[0]) and np.isnan (batch.rchisq[1])
+
+
+@test
+def _bootstrap ():
+    from concurrent.futures import ThreadPoolExecutor
+
+    x, y, invsigma = _testdata (5, [60])[0]
+    m = Model (_testline, x, y, invsigma).solve ([1., 0.])
+
+    for method in 'resample', 'noise':
+        b1 = m.bootstrap (100, method, seed=7).bootparams
+        b2 = m.bootstrap (100, method, seed=7).bootparams
+        assert np.all (b1 == b2)
+
+        with ThreadPoolExecutor (2) as ex:
+            b3 = m.bootstrap (100, method, seed=7, executor=ex).bootparams
+        assert np.all (np.abs (b3 - b1) < 1e-5 * m.perror)
+
+        # For a well-conditioned linear model whose uncertainties are
+        # right, the spread of the realizations should match perror.
+        m.bootstrap (400, method, seed=11)
+        spread = np.sqrt (np.diag (m.bootcovar))
+        assert np.all (np.abs (spread / m.perror - 1) < 0.2)
+        assert np.all (m.bootlimits[0] < m.params) and np.all (m.params < m.bootlimits[1])
+
+    s = ScaleModel (x, y - 0.5, invsigma).solve ().bootstrap (400, 'noise', seed=3)
+    assert abs (np.sqrt (s.bootcovar[0,0]) / s.perror[0] - 1) < 0.2
+
+
+if __name__ == '__main__':
+    _runtests ()